@@ -1,10 +1,14 @@
 from typing import Type, Callable
+import json
 import statistics
+import numpy as np
+import onnx
 import torch
 
 import pytest
 
-from zkstats.computation import State, computation_to_model
+from zkstats.computation import State, computation_to_model, batch_computations_to_model
+from zkstats.core import VALIDITY_MASK_COLUMN, generate_data_commitment, prover_define_calculation, prover_gen_settings, prover_gen_proof, setup, verifier_define_calculation, verifier_verify
 from zkstats.ops import (
     Mean,
     Median,
@@ -18,10 +22,12 @@ from zkstats.ops import (
     Covariance,
     Correlation,
     Regression,
-    Operation
+    Operation,
+    MagicNumber,
 )
+from zkstats.witness import PrecalWitness
 
-from .helpers import assert_result, compute, ERROR_CIRCUIT_DEFAULT, ERROR_CIRCUIT_STRICT, ERROR_CIRCUIT_RELAXED
+from .helpers import assert_result, compute, data_to_json_file, ERROR_CIRCUIT_DEFAULT, ERROR_CIRCUIT_STRICT, ERROR_CIRCUIT_RELAXED
 
 
 def nested_computation(state: State, args: list[torch.Tensor]):
@@ -63,13 +69,13 @@ def nested_computation(state: State, args: list[torch.Tensor]):
     [ERROR_CIRCUIT_DEFAULT],
 )
 def test_nested_computation(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, column_2: torch.Tensor, error, scales):
-    precal_witness_path = tmp_path / "precal_witness_path.json"
+    precal_witness_path = tmp_path / "precal_witness.bin"
     state, model = computation_to_model(nested_computation, precal_witness_path,True, error)
     x, y, z = column_0, column_1, column_2
     compute(tmp_path, [x, y, z], model, scales)
     # There are 11 ops in the computation
 
-    assert state.current_op_index == 12
+    assert len(state.ops) == len(state.graph.operation_nodes) == 12
 
     ops = state.ops
     op_0 = ops[0]
@@ -159,7 +165,7 @@ def test_computation_with_where_1d(tmp_path, error, column_0, op_type: Callable[
     def where_and_op(state: State, args: list[torch.Tensor]):
         x = args[0]
         return op_type(state, state.where(condition(x), x))
-    precal_witness_path = tmp_path / "precal_witness_path.json"
+    precal_witness_path = tmp_path / "precal_witness.bin"
     state, model = computation_to_model(where_and_op, precal_witness_path,True,  error)
     compute(tmp_path, [column], model, scales)
 
@@ -187,7 +193,7 @@ def test_computation_with_where_2d(tmp_path, error, column_0, column_1, op_type:
         filtered_x = state.where(condition_x, x)
         filtered_y = state.where(condition_x, y)
         return op_type(state, filtered_x, filtered_y)
-    precal_witness_path = tmp_path / "precal_witness_path.json"
+    precal_witness_path = tmp_path / "precal_witness.bin"
     state, model = computation_to_model(where_and_op, precal_witness_path, True ,error)
     compute(tmp_path, [column_0, column_1], model, scales)
 
@@ -197,3 +203,528 @@ def test_computation_with_where_2d(tmp_path, error, column_0, column_1, op_type:
     filtered_y = column_1[condition_x]
     expected_res = expected_func(filtered_x.tolist(), filtered_y.tolist())
     assert_result(res_op.result.data, expected_res)
+
+
+def test_repeated_operations(tmp_path, column_0: torch.Tensor, error, scales):
+    def computation(state: State, args: list[torch.Tensor]):
+        x = args[0]
+        out_0 = state.mean(x)
+        # Same operation on the same tensor: shares the operation above
+        out_1 = state.mean(x)
+        # Same operation on another tensor: a new operation
+        out_2 = state.mean(state.where(x < 4, x))
+        return state.mean(torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0), out_2.unsqueeze(0))).reshape(-1,1))
+
+    precal_witness_path = tmp_path / "precal_witness.bin"
+    state, model = computation_to_model(computation, precal_witness_path, True, error)
+    compute(tmp_path, [column_0], model, scales)
+
+    # 4 calls, 3 operations recorded
+    assert len(state.ops) == len(state.graph.operation_nodes) == 3
+    assert len(PrecalWitness.load(precal_witness_path)) == 3
+    mean_x = statistics.mean(column_0.tolist())
+    mean_filtered = statistics.mean(column_0[column_0 < 4].tolist())
+    assert_result(state.ops[0].result.data, mean_x)
+    assert_result(state.ops[-1].result.data, statistics.mean([mean_x, mean_x, mean_filtered]))
+
+
+def test_shared_moments(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error, scales):
+    def computation(state: State, args: list[torch.Tensor]):
+        x, y = args[0], args[1]
+        out_0 = state.stdev(x)
+        out_1 = state.variance(x)
+        out_2 = state.pvariance(y)
+        out_3 = state.covariance(x, y)
+        out_4 = state.correlation(x, y)
+        return state.mean(torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0), out_2.unsqueeze(0), out_3.unsqueeze(0), out_4.unsqueeze(0))).reshape(-1,1))
+
+    precal_witness_path = tmp_path / "precal_witness.bin"
+    state, model = computation_to_model(computation, precal_witness_path, True, ERROR_CIRCUIT_RELAXED)
+    compute(tmp_path, [column_0, column_1], model, scales)
+
+    x, y = column_0.tolist(), column_1.tolist()
+    expected = [
+        statistics.stdev(x),
+        statistics.variance(x),
+        statistics.pvariance(y),
+        statistics.covariance(x, y),
+        statistics.correlation(x, y),
+    ]
+    for op, expected_res in zip(state.ops, expected):
+        assert_result(op.result.data, expected_res)
+    assert_result(state.ops[-1].result.data, statistics.mean(expected))
+
+
+def test_shared_filter_masks(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error, scales):
+    def computation(state: State, args: list[torch.Tensor]):
+        x, y = args[0], args[1]
+        _filter = x > 2
+        filtered_x = state.where(_filter, x)
+        filtered_y = state.where(_filter, y)
+        out_0 = state.mean(filtered_x)
+        out_1 = state.stdev(filtered_x)
+        out_2 = state.geometric_mean(filtered_x)
+        out_3 = state.covariance(filtered_x, filtered_y)
+        return torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0), out_2.unsqueeze(0), out_3.unsqueeze(0)))
+
+    state, model = computation_to_model(computation, None, True, ERROR_CIRCUIT_RELAXED)
+    compute(tmp_path, [column_0, column_1], model, scales)
+
+    x, y = column_0.tolist(), column_1.tolist()
+    kept = [i for i, v in enumerate(x) if v > 2]
+    filtered_x, filtered_y = [x[i] for i in kept], [y[i] for i in kept]
+    expected = [
+        statistics.mean(filtered_x),
+        statistics.stdev(filtered_x),
+        statistics.geometric_mean(filtered_x),
+        statistics.covariance(filtered_x, filtered_y),
+    ]
+    for op, expected_res in zip(state.ops, expected):
+        assert_result(op.result.data, expected_res)
+
+    # With the mask of the rows given, both columns share one mask of the filter, and the filtered columns
+    # are not materialized
+    _, model = computation_to_model(computation, None, True, ERROR_CIRCUIT_RELAXED, validity_mask=True)
+    prover_define_calculation(tmp_path / "data.json", ["columns_0", "columns_1"], tmp_path / "mask_data.json", model, tmp_path / "mask_model.onnx")
+    graph = onnx.load(str(tmp_path / "mask_model.onnx")).graph
+    assert sum(node.op_type == "Where" for node in graph.node) == 1
+
+
+def test_batch_computations(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error, scales):
+    data_path = tmp_path / "data.json"
+    data_json = data_to_json_file(data_path, [column_0, column_1])
+    selected_columns = list(data_json.keys())
+    generate_data_commitment(data_path, scales, tmp_path / "commitments.json")
+
+    def computation_0(state: State, args: list[torch.Tensor]):
+        return state.mean(args[0])
+
+    def computation_1(state: State, args: list[torch.Tensor]):
+        return state.linear_regression(args[0], args[1])
+
+    def computation_2(state: State, args: list[torch.Tensor]):
+        # shares the operation with computation_0
+        out_0 = state.mean(args[0])
+        out_1 = state.median(args[1])
+        return state.mean(torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0))).reshape(-1,1))
+
+    computations = [computation_0, computation_1, computation_2]
+    prover_state, prover_model = batch_computations_to_model(computations, tmp_path / "precal_witness.bin", True, error)
+    prover_gen_settings(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx", scales, "resources", tmp_path / "settings.json")
+    setup(tmp_path / "model.onnx", tmp_path / "model.compiled", tmp_path / "settings.json", tmp_path / "model.vk", tmp_path / "model.pk")
+    prover_gen_proof(tmp_path / "model.onnx", tmp_path / "comb_data.json", tmp_path / "witness.json", tmp_path / "model.compiled", tmp_path / "settings.json", tmp_path / "model.pf", tmp_path / "model.pk")
+    assert len(prover_state.ops) == 4
+
+    verifier_state, verifier_model = batch_computations_to_model(computations, tmp_path / "precal_witness.bin", False, error)
+    verifier_define_calculation(data_path, selected_columns, tmp_path / "sel_dummy_data.json", verifier_model, tmp_path / "verifier_model.onnx")
+    assert verifier_state.output_sizes == [1, 2, 1]
+    results = verifier_verify(tmp_path / "model.pf", tmp_path / "settings.json", tmp_path / "model.vk", selected_columns, tmp_path / "commitments.json", verifier_state.output_sizes)
+
+    x, y = column_0.tolist(), column_1.tolist()
+    regression = statistics.linear_regression(x, y)
+    # The results are quantized with the scale, so compare them within the error
+    assert results == [
+        [pytest.approx(statistics.mean(x), rel=error)],
+        [pytest.approx(regression.slope, rel=error), pytest.approx(regression.intercept, rel=error)],
+        [pytest.approx(statistics.mean([statistics.mean(x), statistics.median(y)]), rel=error)],
+    ]
+
+
+def test_multiple_linear_regression(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, column_2: torch.Tensor, error, scales):
+    def computation(state: State, args: list[torch.Tensor]):
+        _filter = args[2] < 8
+        x_0, x_1, y = (state.where(_filter, arg) for arg in args)
+        return state.linear_regression([x_0, x_1], y)
+
+    state, model = computation_to_model(computation, tmp_path / "precal_witness.bin", True, error)
+    compute(tmp_path, [column_0, column_1, column_2], model, scales)
+    kept = column_2 < 8
+    x_one = np.column_stack((column_0[kept].numpy(), column_1[kept].numpy(), np.ones(int(kept.sum()))))
+    expected, *_ = np.linalg.lstsq(x_one, column_2[kept].numpy(), rcond=None)
+    assert len(state.ops) == 1
+    assert state.ops[0].result.reshape(-1).tolist() == pytest.approx(expected.tolist(), rel=1e-4)
+
+
+def test_verifier_in_memory_witness(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error, scales):
+    data_path = tmp_path / "data.json"
+    data_json = data_to_json_file(data_path, [column_0, column_1])
+    selected_columns = list(data_json.keys())
+    precal_witness_path = tmp_path / "precal_witness.bin"
+
+    def computation(state: State, args: list[torch.Tensor]):
+        out_0 = state.median(args[0])
+        out_1 = state.mean(args[1])
+        return state.mean(torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0))).reshape(-1,1))
+
+    prover_state, prover_model = computation_to_model(computation, precal_witness_path, True, error)
+    prover_gen_settings(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx", scales, "resources", tmp_path / "settings.json")
+    precal_witness = PrecalWitness.load(precal_witness_path)
+    assert precal_witness == PrecalWitness.from_ops(prover_state.ops)
+
+    # Verifier receives the witness in memory, so it never reads `precal_witness_path`
+    verifier_state, verifier_model = computation_to_model(computation, None, False, error, precal_witness=precal_witness)
+    verifier_define_calculation(data_path, selected_columns, tmp_path / "sel_dummy_data.json", verifier_model, tmp_path / "verifier_model.onnx")
+    assert [op.result.data for op in verifier_state.ops] == [op.result.data for op in prover_state.ops]
+    # Witness is loaded once and can't be modified
+    witness = verifier_state.get_precal_witness()
+    assert witness is verifier_state.get_precal_witness()
+    with pytest.raises(ValueError):
+        witness[0].values[0][...] = 0.0
+
+
+def test_mode_within(tmp_path, column_0: torch.Tensor, error):
+    data_path = tmp_path / "data.json"
+    data_json = data_to_json_file(data_path, [column_0])
+    selected_columns = list(data_json.keys())
+    precal_witness_path = tmp_path / "precal_witness.bin"
+
+    def computation(state: State, args: list[torch.Tensor]):
+        x = state.where(args[0] < 7, args[0])
+        out_0 = state.mode_within(x, 0.2)
+        out_1 = state.mode_within(x, 0.5)
+        out_2 = state.mode(x)
+        return torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0), out_2.unsqueeze(0)))
+
+    prover_state, prover_model = computation_to_model(computation, precal_witness_path, True, error)
+    prover_define_calculation(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx")
+    # The error of `mode_within` is the tolerance of the values, not of the state
+    assert [op.error for op in prover_state.ops] == [0.2, 0.5, error]
+    assert [op.result.item() for op in prover_state.ops] == pytest.approx([5.5, 4.5, 6.4])
+
+    verifier_state, verifier_model = computation_to_model(computation, precal_witness_path, False, error)
+    verifier_define_calculation(data_path, selected_columns, tmp_path / "sel_dummy_data.json", verifier_model, tmp_path / "verifier_model.onnx")
+    assert [op.error for op in verifier_state.ops] == [0.2, 0.5, error]
+    for prover_op, verifier_op in zip(prover_state.ops, verifier_state.ops):
+        for name in prover_op.witness_fields:
+            assert torch.equal(getattr(prover_op, name).data, getattr(verifier_op, name).data)
+
+
+def test_quantiles(tmp_path, column_0: torch.Tensor, error):
+    data_path = tmp_path / "data.json"
+    data_json = data_to_json_file(data_path, [column_0])
+    selected_columns = list(data_json.keys())
+    precal_witness_path = tmp_path / "precal_witness.bin"
+
+    def computation_with(qs):
+        def computation(state: State, args: list[torch.Tensor]):
+            x = state.where(args[0] < 7, args[0])
+            return torch.cat((state.quantiles(x, qs), state.median(x).unsqueeze(0)))
+        return computation
+
+    prover_state, prover_model = computation_to_model(computation_with([0.25, 0.5, 0.75]), precal_witness_path, True, error)
+    prover_define_calculation(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx")
+    # All quantiles are one operation
+    assert len(prover_state.ops) == 2
+    filtered = [v for v in column_0.tolist() if v < 7]
+    expected = statistics.quantiles(filtered, n=4, method="inclusive")
+    for expected_value, result in zip(expected, prover_state.ops[0].result):
+        assert_result(expected_value, result)
+    assert_result(torch.tensor(statistics.median(filtered)), prover_state.ops[1].result)
+
+    verifier_state, verifier_model = computation_to_model(computation_with([0.25, 0.5, 0.75]), precal_witness_path, False, error)
+    verifier_define_calculation(data_path, selected_columns, tmp_path / "sel_dummy_data.json", verifier_model, tmp_path / "verifier_model.onnx")
+    assert verifier_state.ops[0].qs == (0.25, 0.5, 0.75)
+    assert torch.equal(verifier_state.ops[0].ranks.data, prover_state.ops[0].ranks.data)
+    assert verifier_state.fingerprint() == prover_state.fingerprint()
+
+    # Other probabilities change the circuit even with the same number of quantiles
+    other_state, other_model = computation_to_model(computation_with([0.25, 0.5, 0.9]), None, True, error)
+    prover_define_calculation(data_path, selected_columns, tmp_path / "comb_data.json", other_model, tmp_path / "other_model.onnx")
+    assert other_state.fingerprint() != prover_state.fingerprint()
+
+
+def test_histogram(tmp_path, column_0: torch.Tensor, error):
+    data_path = tmp_path / "data.json"
+    data_json = data_to_json_file(data_path, [column_0])
+    selected_columns = list(data_json.keys())
+    precal_witness_path = tmp_path / "precal_witness.bin"
+
+    def computation_with(edges):
+        def computation(state: State, args: list[torch.Tensor]):
+            x = state.where(args[0] < 7, args[0])
+            return torch.cat((state.histogram(x, edges), state.median(x).unsqueeze(0)))
+        return computation
+
+    prover_state, prover_model = computation_to_model(computation_with([0.0, 2.5, 5.0, 7.5]), precal_witness_path, True, error)
+    prover_define_calculation(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx")
+    filtered = [v for v in column_0.tolist() if v < 7]
+    assert prover_state.ops[0].result.tolist() == np.histogram(filtered, bins=[0.0, 2.5, 5.0, 7.5])[0].tolist()
+
+    verifier_state, verifier_model = computation_to_model(computation_with([0.0, 2.5, 5.0, 7.5]), precal_witness_path, False, error)
+    verifier_define_calculation(data_path, selected_columns, tmp_path / "sel_dummy_data.json", verifier_model, tmp_path / "verifier_model.onnx")
+    assert verifier_state.ops[0].edges == (0.0, 2.5, 5.0, 7.5)
+    assert torch.equal(verifier_state.ops[0].ranks.data, prover_state.ops[0].ranks.data)
+    assert verifier_state.fingerprint() == prover_state.fingerprint()
+
+    # Other edges change the circuit even with the same number of bins
+    other_state, other_model = computation_to_model(computation_with([0.0, 2.5, 5.0, 8.0]), None, True, error)
+    prover_define_calculation(data_path, selected_columns, tmp_path / "comb_data.json", other_model, tmp_path / "other_model.onnx")
+    assert other_state.fingerprint() != prover_state.fingerprint()
+
+
+def test_group_by(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error):
+    data_path = tmp_path / "data.json"
+    data_json = data_to_json_file(data_path, [column_0, column_1])
+    selected_columns = list(data_json.keys())
+    precal_witness_path = tmp_path / "precal_witness.bin"
+
+    def computation(state: State, args: list[torch.Tensor]):
+        # The integer part of column_1 is the key
+        keys = torch.floor(args[1])
+        x = state.where(args[0] < 7, args[0])
+        out_0 = state.group_by(keys, x, "count")
+        out_1 = state.group_by(keys, x, "mean")
+        out_2 = state.group_by(keys, args[0], "sum", keys=[3.0, 8.0])
+        return torch.cat((out_0, out_1, out_2))
+
+    prover_state, prover_model = computation_to_model(computation, precal_witness_path, True, error)
+    prover_define_calculation(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx")
+    # The row with 7.5 and key 3 is filtered out, except for the sum of the unfiltered column
+    assert [op.keys.tolist() for op in prover_state.ops] == [[1.0, 2.0, 3.0, 4.0, 8.0], [1.0, 2.0, 3.0, 4.0, 8.0], [3.0, 8.0]]
+    assert prover_state.ops[0].result.tolist() == [1.0, 2.0, 2.0, 1.0, 1.0]
+    assert prover_state.ops[1].result.tolist() == pytest.approx([1.0, 2.5, 5.45, 5.5, 6.4])
+    assert prover_state.ops[2].result.tolist() == pytest.approx([18.4, 6.4])
+
+    verifier_state, verifier_model = computation_to_model(computation, precal_witness_path, False, error)
+    verifier_define_calculation(data_path, selected_columns, tmp_path / "sel_dummy_data.json", verifier_model, tmp_path / "verifier_model.onnx")
+    assert [op.given_keys for op in verifier_state.ops] == [None, None, (3.0, 8.0)]
+    for prover_op, verifier_op in zip(prover_state.ops, verifier_state.ops):
+        for name in prover_op.witness_fields:
+            assert torch.equal(getattr(prover_op, name).data, getattr(verifier_op, name).data)
+    assert verifier_state.fingerprint() == prover_state.fingerprint()
+
+    def unsupported(state: State, args: list[torch.Tensor]):
+        return state.group_by(args[1], args[0], "median")
+    _, unsupported_model = computation_to_model(unsupported, None, True, error)
+    with pytest.raises(ValueError, match="unsupported aggregate"):
+        prover_define_calculation(data_path, selected_columns, tmp_path / "comb_data.json", unsupported_model, tmp_path / "unsupported_model.onnx")
+
+
+def test_precal_witness_from_memory_mapped_columns(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error):
+    def computation(state: State, args: list[torch.Tensor]):
+        x = state.where(args[1] < 8, args[0])
+        return torch.cat((state.median(args[0]).unsqueeze(0), state.variance(x).unsqueeze(0), state.correlation(args[0], args[1]).unsqueeze(0)))
+
+    columns = [column_0.reshape(-1, 1), column_1.reshape(-1, 1)]
+    state, _ = computation_to_model(computation, tmp_path / "precal_witness.bin", True, error)
+    state.trace(computation, columns)
+    # The prover traces the computation on memory-mapped columns, without loading them, to write the witness
+    mapped = []
+    for i, column in enumerate(columns):
+        np.save(tmp_path / f"column_{i}.npy", column.numpy())
+        mapped.append(torch.from_numpy(np.load(tmp_path / f"column_{i}.npy", mmap_mode="c")))
+    mapped_state, _ = computation_to_model(computation, tmp_path / "mapped_precal_witness.bin", True, error)
+    mapped_state.trace(computation, mapped)
+    assert PrecalWitness.load(tmp_path / "mapped_precal_witness.bin") == PrecalWitness.load(tmp_path / "precal_witness.bin")
+
+
+def test_float64(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error, scales):
+    data_path = tmp_path / "data.json"
+    data_json = data_to_json_file(data_path, [column_0, column_1])
+    selected_columns = list(data_json.keys())
+    precal_witness_path = tmp_path / "precal_witness.bin"
+
+    def computation(state: State, args: list[torch.Tensor]):
+        x = state.where(args[1] < 8, args[0])
+        return torch.cat((state.median(args[0]).unsqueeze(0), state.variance(x).unsqueeze(0), state.correlation(args[0], args[1]).unsqueeze(0)))
+
+    prover_state, prover_model = computation_to_model(computation, precal_witness_path, True, error)
+    prover_gen_settings(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx", scales, "resources", tmp_path / "settings.json", float64=True)
+    assert all(witness.dtype == torch.float64 for op in prover_state.ops for witness in op.get_witness())
+    assert all(graph_input.type.tensor_type.elem_type == onnx.TensorProto.DOUBLE for graph_input in onnx.load(str(tmp_path / "model.onnx")).graph.input)
+
+    # Verifier exports the same model in float64 from the precalculated witness
+    verifier_state, verifier_model = computation_to_model(computation, precal_witness_path, False, error)
+    verifier_define_calculation(data_path, selected_columns, tmp_path / "sel_dummy_data.json", verifier_model, tmp_path / "verifier_model.onnx", float64=True)
+    assert verifier_state.fingerprint() == prover_state.fingerprint()
+    setup(tmp_path / "verifier_model.onnx", tmp_path / "model.compiled", tmp_path / "settings.json", tmp_path / "model.vk", tmp_path / "model.pk")
+
+    generate_data_commitment(data_path, scales, tmp_path / "commitments.json")
+    prover_gen_proof(tmp_path / "model.onnx", tmp_path / "comb_data.json", tmp_path / "witness.json", tmp_path / "prover_model.compiled", tmp_path / "settings.json", tmp_path / "model.pf", tmp_path / "model.pk")
+    results = verifier_verify(tmp_path / "model.pf", tmp_path / "settings.json", tmp_path / "model.vk", selected_columns, tmp_path / "commitments.json")
+    x, y = column_0.tolist(), column_1.tolist()
+    assert results == [
+        pytest.approx(statistics.median(x), rel=error),
+        pytest.approx(statistics.variance([v for v, w in zip(x, y) if w < 8]), rel=error),
+        pytest.approx(statistics.correlation(x, y), rel=error),
+    ]
+
+
+def test_private_witness(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error, scales):
+    selected_columns = ["columns_0", "columns_1"]
+
+    def computation(state: State, args: list[torch.Tensor]):
+        out_0 = state.median(args[0])
+        out_1 = state.correlation(args[0], args[1])
+        return torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0)))
+
+    def graph_structure(model_path):
+        # Everything but the values of the constants
+        graph = onnx.load(str(model_path)).graph
+        return [(node.op_type, list(node.input), list(node.output)) for node in graph.node]
+
+    data_path = tmp_path / "data.json"
+    data_to_json_file(data_path, [column_0, column_1])
+    _, prover_model = computation_to_model(computation, None, True, error, private_witness=True)
+    prover_gen_settings(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx", scales, "resources", tmp_path / "settings.json")
+    # Only the witness is private, as one input after the data. Other parameters stay fixed, so the vk binds them
+    with open(tmp_path / "settings.json") as f:
+        assert json.load(f)["run_args"]["param_visibility"] == "Fixed"
+    assert [graph_input.name for graph_input in onnx.load(str(tmp_path / "model.onnx")).graph.input][-1] == "witness"
+
+    # Verifier builds the same model from dummy data, without the precalculated witness, and sets up once
+    _, verifier_model = computation_to_model(computation, None, False, error, private_witness=True)
+    verifier_define_calculation(data_path, selected_columns, tmp_path / "sel_dummy_data.json", verifier_model, tmp_path / "verifier_model.onnx")
+    assert graph_structure(tmp_path / "verifier_model.onnx") == graph_structure(tmp_path / "model.onnx")
+    setup(tmp_path / "verifier_model.onnx", tmp_path / "verifier_model.compiled", tmp_path / "settings.json", tmp_path / "model.vk", tmp_path / "model.pk")
+
+    # Prove another dataset of the same shape with the same settings, pk and vk
+    new_column_0, new_column_1 = column_0 + 1, column_1 * 2
+    new_data_path = tmp_path / "new_data.json"
+    data_to_json_file(new_data_path, [new_column_0, new_column_1])
+    generate_data_commitment(new_data_path, scales, tmp_path / "commitments.json")
+    _, prover_model = computation_to_model(computation, None, True, error, private_witness=True)
+    prover_define_calculation(new_data_path, selected_columns, tmp_path / "new_comb_data.json", prover_model, tmp_path / "new_model.onnx")
+    assert graph_structure(tmp_path / "new_model.onnx") == graph_structure(tmp_path / "model.onnx")
+    prover_gen_proof(tmp_path / "new_model.onnx", tmp_path / "new_comb_data.json", tmp_path / "witness.json", tmp_path / "new_model.compiled", tmp_path / "settings.json", tmp_path / "model.pf", tmp_path / "model.pk")
+    results = verifier_verify(tmp_path / "model.pf", tmp_path / "settings.json", tmp_path / "model.vk", selected_columns, tmp_path / "commitments.json")
+
+    x, y = new_column_0.tolist(), new_column_1.tolist()
+    assert results == [
+        pytest.approx(statistics.median(x), rel=error),
+        pytest.approx(statistics.correlation(x, y), rel=error),
+    ]
+
+    # A forged witness, here the median, is rejected by the circuit
+    with open(tmp_path / "new_comb_data.json") as f:
+        input_data = json.load(f)
+    input_data["input_data"][-1][0] += 1
+    with open(tmp_path / "forged_comb_data.json", "w") as f:
+        json.dump(input_data, f)
+    prover_gen_proof(tmp_path / "new_model.onnx", tmp_path / "forged_comb_data.json", tmp_path / "forged_witness.json", tmp_path / "new_model.compiled", tmp_path / "settings.json", tmp_path / "forged_model.pf", tmp_path / "model.pk")
+    with pytest.raises(AssertionError, match="result is not within error"):
+        verifier_verify(tmp_path / "forged_model.pf", tmp_path / "settings.json", tmp_path / "model.vk", selected_columns, tmp_path / "commitments.json")
+
+
+def test_row_buckets(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error, scales):
+    selected_columns = ["columns_0", "columns_1"]
+    row_buckets = "power_of_two"
+
+    def computation(state: State, args: list[torch.Tensor]):
+        out_0 = state.mean(state.where(args[0] > 2, args[0]))
+        out_1 = state.covariance(args[0], args[1])
+        return torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0)))
+
+    def graph_structure(model_path):
+        graph = onnx.load(str(model_path)).graph
+        return [(node.op_type, list(node.input), list(node.output)) for node in graph.node]
+
+    # Setup once with 6 rows, padded to 8. Calibrating on padded data covers the range of the padding.
+    assert len(column_0) == 8
+    data_path = tmp_path / "data.json"
+    data_to_json_file(data_path, [column_0[:6], column_1[:6]])
+    _, prover_model = computation_to_model(computation, None, True, error, private_witness=True)
+    prover_gen_settings(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx", scales, "resources", tmp_path / "settings.json", row_buckets=row_buckets)
+    setup(tmp_path / "model.onnx", tmp_path / "model.compiled", tmp_path / "settings.json", tmp_path / "model.vk", tmp_path / "model.pk")
+
+    # 7 rows are padded to the same bucket, so the keys are reused
+    new_column_0, new_column_1 = column_0[:7], column_1[:7]
+    new_data_path = tmp_path / "new_data.json"
+    data_to_json_file(new_data_path, [new_column_0, new_column_1])
+    generate_data_commitment(new_data_path, scales, tmp_path / "commitments.json", row_buckets)
+    _, prover_model = computation_to_model(computation, None, True, error, private_witness=True)
+    prover_define_calculation(new_data_path, selected_columns, tmp_path / "new_comb_data.json", prover_model, tmp_path / "new_model.onnx", row_buckets=row_buckets)
+    assert graph_structure(tmp_path / "new_model.onnx") == graph_structure(tmp_path / "model.onnx")
+    prover_gen_proof(tmp_path / "new_model.onnx", tmp_path / "new_comb_data.json", tmp_path / "witness.json", tmp_path / "new_model.compiled", tmp_path / "settings.json", tmp_path / "model.pf", tmp_path / "model.pk")
+    results = verifier_verify(tmp_path / "model.pf", tmp_path / "settings.json", tmp_path / "model.vk", selected_columns, tmp_path / "commitments.json")
+
+    x, y = new_column_0.tolist(), new_column_1.tolist()
+    assert results == [
+        pytest.approx(statistics.mean([v for v in x if v > 2]), rel=error),
+        pytest.approx(statistics.covariance(x, y), rel=error),
+    ]
+
+
+def test_validity_mask(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, error, scales):
+    selected_columns = ["columns_0", "columns_1"]
+    row_buckets = "power_of_two"
+
+    def computation(state: State, args: list[torch.Tensor]):
+        out_0 = state.mean(state.where(args[0] > 2, args[0]))
+        out_1 = state.median(args[0])
+        out_2 = state.covariance(args[0], args[1])
+        return torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0), out_2.unsqueeze(0)))
+
+    def num_equal_nodes(model_path):
+        return sum(node.op_type == "Equal" for node in onnx.load(str(model_path)).graph.node)
+
+    # 7 rows padded to 8
+    x, y = column_0[:7], column_1[:7]
+    data_path = tmp_path / "data.json"
+    data_to_json_file(data_path, [x, y])
+    generate_data_commitment(data_path, scales, tmp_path / "commitments.json", row_buckets, validity_mask=True)
+    _, prover_model = computation_to_model(computation, None, True, error, validity_mask=True)
+    prover_gen_settings(data_path, selected_columns, tmp_path / "comb_data.json", prover_model, tmp_path / "model.onnx", scales, "resources", tmp_path / "settings.json", row_buckets=row_buckets)
+    setup(tmp_path / "model.onnx", tmp_path / "model.compiled", tmp_path / "settings.json", tmp_path / "model.vk", tmp_path / "model.pk")
+    prover_gen_proof(tmp_path / "model.onnx", tmp_path / "comb_data.json", tmp_path / "witness.json", tmp_path / "model.compiled", tmp_path / "settings.json", tmp_path / "model.pf", tmp_path / "model.pk")
+    # The mask is the last input of the circuit
+    results = verifier_verify(tmp_path / "model.pf", tmp_path / "settings.json", tmp_path / "model.vk", selected_columns + [VALIDITY_MASK_COLUMN], tmp_path / "commitments.json")
+
+    x, y = x.tolist(), y.tolist()
+    assert results == [
+        pytest.approx(statistics.mean([v for v in x if v > 2]), rel=error),
+        pytest.approx(statistics.median(x), rel=error),
+        pytest.approx(statistics.covariance(x, y), rel=error),
+    ]
+
+    # The columns are not compared with MagicNumber when the mask is given
+    _, prover_model = computation_to_model(computation, None, True, error)
+    prover_define_calculation(data_path, selected_columns, tmp_path / "no_mask_data.json", prover_model, tmp_path / "no_mask_model.onnx", row_buckets=row_buckets)
+    assert num_equal_nodes(tmp_path / "model.onnx") < num_equal_nodes(tmp_path / "no_mask_model.onnx")
+
+
+def test_validity_mask_magic_number(error):
+    # A real 99.999 is data when the mask is given: the witness is calculated from the same mask as the circuit
+    def computation(state: State, args: list[torch.Tensor]):
+        out_0 = state.mean(args[0])
+        out_1 = state.median(state.where(args[0] > 1, args[0]))
+        return torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0)))
+
+    x = torch.tensor([1.0, 2.0, MagicNumber, 4.0, 0.0]).reshape(-1, 1)
+    # The last row is padding
+    mask = torch.tensor([1.0, 1.0, 1.0, 1.0, 0.0]).reshape(-1, 1)
+    _, model_type = computation_to_model(computation, None, True, error, validity_mask=True)
+    model = model_type()
+    model.preprocess([x, mask])
+    is_precise, result = model.forward(x, mask)
+    assert bool(is_precise)
+    assert result.tolist() == [
+        pytest.approx(statistics.mean([1.0, 2.0, MagicNumber, 4.0]), rel=error),
+        pytest.approx(statistics.median([2.0, MagicNumber, 4.0]), rel=error),
+    ]
+
+def test_precal_witness_format(column_0: torch.Tensor, column_1: torch.Tensor, error):
+    ops = [
+        Median.create([column_0], error),
+        Correlation.create([column_0, column_1], error),
+        Regression.create([column_0, column_1], error),
+    ]
+    precal_witness = PrecalWitness.from_ops(ops)
+    data = precal_witness.to_bytes()
+    # header, op table and one float64 per value: 3 for median, 6 for correlation and 2 for regression
+    assert data[:4] == b"ZKSW"
+    assert len(data) < 100 + 8 * (3 + 6 + 2)
+    loaded = PrecalWitness.from_bytes(data)
+    assert loaded == precal_witness
+    assert [entry.op_type for entry in loaded] == [Median, Correlation, Regression]
+    for op, entry in zip(ops, loaded):
+        restored = entry.op_type.from_witness(entry.to_tensors(), error)
+        for name in op.witness_fields:
+            assert torch.equal(getattr(restored, name).data, getattr(op, name).data)
+    # Unknown versions are rejected instead of misread
+    with pytest.raises(ValueError):
+        PrecalWitness.from_bytes(data[:4] + b"\xff\xff" + data[6:])
+    # Truncated files are rejected at any point
+    for size in range(len(data)):
+        with pytest.raises(ValueError):
+            PrecalWitness.from_bytes(data[:size])
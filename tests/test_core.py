@@ -1,8 +1,11 @@
 import json
 
+import onnx
 import torch
 
-from zkstats.core import generate_data_commitment, prover_gen_settings, _preprocess_data_file_to_json, verifier_define_calculation
+import pytest
+
+from zkstats.core import generate_data_commitment, get_bucket_size, prover_gen_settings, _preprocess_data_file_to_json, verifier_define_calculation, _export_onnx
 from zkstats.computation import computation_to_model
 
 from .helpers import data_to_json_file, compute
@@ -71,7 +74,7 @@ def test_integration_select_partial_columns(tmp_path, column_0, column_1, error,
 
     def simple_computation(state, x):
         return state.mean(x[0])
-    precal_witness_path = tmp_path / "precal_witness_path.json"
+    precal_witness_path = tmp_path / "precal_witness.bin"
     _, model = computation_to_model(simple_computation,precal_witness_path, True, error)
     # gen settings, setup, prove, verify
     compute(tmp_path, [column_0, column_1], model, scales, selected_columns)
@@ -92,7 +95,7 @@ def test_csv_data(tmp_path, column_0, column_1, error, scales):
     model_path = tmp_path / "model.onnx"
     settings_path = tmp_path / "settings.json"
     data_commitment_path = tmp_path / "commitments.json"
-    precal_witness_path = tmp_path / "precal_witness.json"
+    precal_witness_path = tmp_path / "precal_witness.bin"
 
     # Test: `generate_data_commitment` works with csv
     generate_data_commitment(data_csv_path, scales, data_commitment_path)
@@ -115,6 +118,55 @@ def test_csv_data(tmp_path, column_0, column_1, error, scales):
     _, model_for_verification = computation_to_model(simple_computation, precal_witness_path, False,error)
     verifier_define_calculation(data_csv_path, selected_columns, str(sel_data_path), model_for_verification, str(model_path))
 
+def test_onnx_cache(tmp_path, column_0, column_1, error):
+    def computation(state, x):
+        out_0 = state.median(state.where(x[0] > 2, x[0]))
+        out_1 = state.correlation(x[0], x[1])
+        return torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0)))
+
+    cache_dir = tmp_path / "cache"
+    _, model = computation_to_model(computation, None, True, error)
+    _export_onnx(model, [column_0.reshape(-1, 1), column_1.reshape(-1, 1)], str(tmp_path / "model_0.onnx"), str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # Same shape, different data: the cached model is used with the new witness
+    new_column_0, new_column_1 = column_0 * 2 + 1, column_1 - 1
+    _, model = computation_to_model(computation, None, True, error)
+    _export_onnx(model, [new_column_0.reshape(-1, 1), new_column_1.reshape(-1, 1)], str(tmp_path / "model_1.onnx"), str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 1
+    _, model = computation_to_model(computation, None, True, error)
+    _export_onnx(model, [new_column_0.reshape(-1, 1), new_column_1.reshape(-1, 1)], str(tmp_path / "model_2.onnx"), str(tmp_path / "other_cache"))
+    cached = onnx.load(str(tmp_path / "model_1.onnx"))
+    exported = onnx.load(str(tmp_path / "model_2.onnx"))
+    assert cached.graph.SerializeToString() == exported.graph.SerializeToString()
+    assert cached.graph.SerializeToString() != onnx.load(str(tmp_path / "model_0.onnx")).graph.SerializeToString()
+
+    # Without cache, the witness is folded into other constants
+    _, model = computation_to_model(computation, None, True, error)
+    _export_onnx(model, [new_column_0.reshape(-1, 1), new_column_1.reshape(-1, 1)], str(tmp_path / "model_4.onnx"))
+    not_cached = onnx.load(str(tmp_path / "model_4.onnx"))
+    def num_computed(onnx_model):
+        return sum(node.op_type != "Constant" for node in onnx_model.graph.node)
+    assert num_computed(not_cached) < num_computed(cached)
+
+    # Different shape: exported again
+    _, model = computation_to_model(computation, None, True, error)
+    _export_onnx(model, [column_0[:-1].reshape(-1, 1), column_1[:-1].reshape(-1, 1)], str(tmp_path / "model_3.onnx"), str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 2
+
+
+def test_get_bucket_size():
+    assert get_bucket_size(5, None) == 5
+    assert get_bucket_size(1, "power_of_two") == 1
+    assert get_bucket_size(5, "power_of_two") == 8
+    assert get_bucket_size(8, "power_of_two") == 8
+    assert get_bucket_size(9, "power_of_two") == 16
+    assert get_bucket_size(5, [100, 10, 50]) == 10
+    assert get_bucket_size(50, [100, 10, 50]) == 50
+    with pytest.raises(ValueError):
+        get_bucket_size(101, [100, 10, 50])
+
+
 def json_file_to_csv(data_json_path, data_csv_path):
     with open(data_json_path, "r") as f:
         data_from_json = json.load(f)
@@ -0,0 +1,58 @@
+import torch
+
+from zkstats.computation import State
+from zkstats.explain import explain
+
+
+def computation(state: State, args: list[torch.Tensor]):
+    x = args[0]
+    y = args[1]
+    out_0 = state.median(x)
+    out_1 = state.mode(y)
+    out_2 = state.geometric_mean(x)
+    return state.mean(torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0), out_2.unsqueeze(0))).reshape(-1,1))
+
+
+def test_explain():
+    estimate = explain(computation, (20, 2))
+    assert estimate.num_rows == 20
+    assert estimate.num_columns == 2
+    assert [op.op for op in estimate.ops] == ["Median", "Mode", "GeometricMean", "Mean"]
+    median, mode, geomean, mean = estimate.ops
+    # Only geometric mean takes logarithms
+    assert geomean.logs > 0
+    assert median.logs == mode.logs == mean.logs == 0
+    # Totals are the sums over all operations
+    assert estimate.comparisons == sum(op.comparisons for op in estimate.ops)
+    assert estimate.lookups == sum(op.lookups for op in estimate.ops)
+    assert estimate.lookups >= estimate.comparisons + estimate.divisions + estimate.logs
+    assert estimate.logrows >= max(op.logrows for op in estimate.ops)
+    assert estimate.proving_time > 0
+
+
+def test_explain_is_repeatable():
+    first = explain(computation, (20, 2))
+    assert explain(computation, (20, 2)) == first
+
+
+def test_explain_scales_with_rows():
+    small = explain(computation, (20, 2))
+    large = explain(computation, (40, 2))
+    assert large.rows > small.rows
+    assert large.logrows >= small.logrows
+    for small_op, large_op in zip(small.ops[:-1], large.ops[:-1]):
+        # Geometric mean shares the validity mask of x with median, so only its logarithms grow
+        assert large_op.lookups > small_op.lookups
+
+
+def test_explain_shared_moments():
+    def dispersion(state: State, args: list[torch.Tensor]):
+        x = args[0]
+        out_0 = state.stdev(x)
+        out_1 = state.variance(x)
+        return state.mean(torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0))).reshape(-1,1))
+
+    stdev, variance, _ = explain(dispersion, (20, 1)).ops
+    # Count, mean constraint and sum of squared deviations of the column are only constrained by stdev
+    assert variance.onnx_nodes < stdev.onnx_nodes
+    assert variance.comparisons < stdev.comparisons
@@ -0,0 +1,40 @@
+import torch
+
+from zkstats.computation import State, computation_to_model, MagicNumber
+from zkstats.ir import NodeKind
+
+
+def test_trace_and_run():
+    offset = torch.tensor([1.0])
+
+    def computation(state: State, args: list[torch.Tensor]):
+        x, y = args[0], args[1]
+        filtered = state.where(x > 2, x)
+        out_0 = state.mean(filtered)
+        # Shares the operation above
+        out_1 = state.mean(filtered)
+        out_2 = state.median(y * 2 + offset)
+        return torch.cat((out_0.unsqueeze(0), out_1.unsqueeze(0), out_2.unsqueeze(0)))
+
+    x = torch.tensor([1.0, 2.0, 3.0, 4.0, 5.0]).reshape(-1, 1)
+    y = torch.tensor([5.0, 1.0, 3.0, 2.0, 4.0]).reshape(-1, 1)
+    state, model_type = computation_to_model(computation, None, True)
+    model = model_type()
+    model.preprocess([x, y])
+
+    graph = state.graph
+    kinds = [node.kind for node in graph.nodes]
+    assert kinds.count(NodeKind.INPUT) == 2
+    assert kinds.count(NodeKind.WHERE) == 1
+    assert kinds.count(NodeKind.CONSTANT) == 1
+    assert len(graph.operation_nodes) == len(state.ops) == 2
+    # The witness is not calculated again when replaying
+    assert all(node.kind != NodeKind.CALL or node.func.__name__ not in ("mean", "median") for node in graph.nodes)
+
+    is_precise, result = model.forward(x, y)
+    assert bool(is_precise)
+    assert torch.allclose(result, torch.tensor([4.0, 4.0, 7.0]))
+
+    # The operation is recorded on the filtered column
+    filtered = torch.where(x > 2, x, x - x + MagicNumber)
+    assert torch.equal(graph.value(graph.operation_nodes[0].args[0]), filtered)
@@ -0,0 +1,127 @@
+import numpy as np
+import onnx
+from onnx import helper, TensorProto
+from onnx.reference import ReferenceEvaluator
+
+from zkstats.onnx_optimizer import optimize_graph
+
+
+def _constant(name: str, value) -> onnx.NodeProto:
+    return helper.make_node("Constant", [], [name], value=helper.make_tensor(name, TensorProto.FLOAT, [], [value]))
+
+
+def _index(name: str, value: int) -> onnx.NodeProto:
+    return helper.make_node("Constant", [], [name], value=helper.make_tensor(name, TensorProto.INT64, [], [value]))
+
+
+def test_optimize_graph_connector():
+    nodes = [
+        _constant("result", 3.5),
+        _index("index_0", 0),
+        _index("index_1", 0),
+        # result + (x-x)[0][0], connecting the result to the input
+        helper.make_node("Sub", ["x", "x"], ["zeros"]),
+        helper.make_node("Gather", ["zeros", "index_0"], ["zeros_row"], axis=0),
+        helper.make_node("Gather", ["zeros_row", "index_1"], ["zero"], axis=0),
+        helper.make_node("Add", ["result", "zero"], ["connected"]),
+        helper.make_node("Mul", ["connected", "x"], ["out"]),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "test",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, [3, 1])],
+        [helper.make_tensor_value_info("out", TensorProto.FLOAT, [3, 1]), helper.make_tensor_value_info("connected", TensorProto.FLOAT, [])],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 11)])
+    x = np.array([[1.0], [2.0], [3.0]], dtype=np.float32)
+    expected = ReferenceEvaluator(model).run(None, {"x": x})
+
+    optimized = onnx.ModelProto()
+    optimized.CopyFrom(model)
+    report = optimize_graph(optimized.graph)
+
+    # The graph output keeps its name
+    assert [node.op_type for node in optimized.graph.node] == ["Constant", "Identity", "Mul"]
+    assert report.nodes_after == 3
+    onnx.checker.check_model(optimized)
+    for actual, expected_output in zip(ReferenceEvaluator(optimized).run(None, {"x": x}), expected):
+        np.testing.assert_allclose(actual, expected_output)
+
+
+def test_optimize_graph_connector_on_filtered_column():
+    nodes = [
+        _constant("two", 2.0),
+        _constant("magic", 99.999),
+        _constant("result", 3.5),
+        _index("index_0", 0),
+        _index("index_1", 0),
+        # a filtered column only used to connect the result to the inputs
+        helper.make_node("Greater", ["x", "two"], ["filter"]),
+        helper.make_node("Where", ["filter", "x", "magic"], ["filtered"]),
+        helper.make_node("Sub", ["filtered", "filtered"], ["zeros"]),
+        helper.make_node("Gather", ["zeros", "index_0"], ["zeros_row"], axis=0),
+        helper.make_node("Gather", ["zeros_row", "index_1"], ["zero"], axis=0),
+        helper.make_node("Add", ["result", "zero"], ["out"]),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "test",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, [3, 1])],
+        [helper.make_tensor_value_info("out", TensorProto.FLOAT, [])],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 11)])
+    optimize_graph(model.graph)
+
+    # The rank of the filtered column is known, so (filtered-filtered)[0][0] is a scalar 0
+    assert [node.op_type for node in model.graph.node] == ["Constant", "Identity"]
+
+
+def test_optimize_graph():
+    nodes = [
+        _constant("magic_0", 99.999),
+        _constant("magic_1", 99.999),
+        _constant("zero", 0.0),
+        _constant("one", 1.0),
+        # the same comparison twice, against constants with the same value
+        helper.make_node("Equal", ["x", "magic_0"], ["is_magic_0"]),
+        helper.make_node("Equal", ["x", "magic_1"], ["is_magic_1"]),
+        helper.make_node("Not", ["is_magic_0"], ["not_magic"]),
+        # count of elements that are not filtered out
+        helper.make_node("Where", ["not_magic", "one", "zero"], ["ones"]),
+        helper.make_node("ReduceSum", ["ones"], ["size"], keepdims=0),
+        # where nested in where with the same condition
+        helper.make_node("Where", ["is_magic_1", "zero", "x"], ["x_fil_0"]),
+        helper.make_node("Where", ["is_magic_0", "one", "x_fil_0"], ["x_fil_1"]),
+        helper.make_node("ReduceSum", ["x_fil_1"], ["sum"], keepdims=0),
+        # identity arithmetic
+        helper.make_node("Add", ["sum", "zero"], ["sum_plus_0"]),
+        helper.make_node("Mul", ["one", "sum_plus_0"], ["sum_times_1"]),
+        helper.make_node("Div", ["sum_times_1", "size"], ["mean"]),
+        # not used by any output
+        helper.make_node("Abs", ["x"], ["unused"]),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "test",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, [6, 1])],
+        [helper.make_tensor_value_info("mean", TensorProto.FLOAT, [])],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 11)])
+    x = np.array([[1.0], [2.0], [99.999], [4.0], [99.999], [8.0]], dtype=np.float32)
+    expected = ReferenceEvaluator(model).run(None, {"x": x})
+
+    optimized = onnx.ModelProto()
+    optimized.CopyFrom(model)
+    report = optimize_graph(optimized.graph)
+
+    assert report.nodes_before == len(nodes)
+    assert report.nodes_after == len(optimized.graph.node)
+    op_counts = report.op_counts_after
+    assert op_counts["Constant"] == 3
+    assert op_counts["Equal"] == 1
+    assert op_counts["Where"] == 2
+    assert "Not" not in op_counts
+    assert "Add" not in op_counts and "Mul" not in op_counts
+    assert "Abs" not in op_counts
+    onnx.checker.check_model(optimized)
+    np.testing.assert_allclose(ReferenceEvaluator(optimized).run(None, {"x": x}), expected)
@@ -1,11 +1,15 @@
 from typing import Type, Callable
 import statistics
 
+import numpy as np
 import pytest
 
 import torch
-from zkstats.ops import Mean, Median, GeometricMean, HarmonicMean, Mode, PStdev, PVariance, Stdev, Variance, Covariance, Correlation, Operation, Regression
-from zkstats.computation import IModel, IsResultPrecise, State, computation_to_model
+from zkstats.ops import Mean, Median, GeometricMean, HarmonicMean, Mode, ModeWithin, Quantiles, Histogram, PStdev, PVariance, Stdev, Variance, Covariance, Correlation, Operation, Regression, Moments
+from zkstats.ops import GroupBy, GroupCount, GroupSum, GroupMean, GroupVariance
+from zkstats.ops import mode_within, RunningMoments, order_statistics_f64
+import zkstats.ops
+from zkstats.computation import IModel, IsResultPrecise, MagicNumber, State, computation_to_model
 
 from .helpers import compute, assert_result, ERROR_CIRCUIT_DEFAULT, ERROR_CIRCUIT_STRICT, ERROR_CIRCUIT_RELAXED
 
@@ -61,6 +65,279 @@ def test_linear_regression(tmp_path, column_0: torch.Tensor, column_1: torch.Ten
     compute(tmp_path, columns, Model, scales)
 
 
+def test_multiple_linear_regression(tmp_path, column_0: torch.Tensor, column_1: torch.Tensor, column_2: torch.Tensor, error: float, scales: list[float]):
+    columns = [column_0, column_1, column_2]
+    regression = Regression.create(columns, error)
+    x_one = np.column_stack((column_0.numpy(), column_1.numpy(), np.ones(len(column_0))))
+    expected_res, *_ = np.linalg.lstsq(x_one, column_2.numpy(), rcond=None)
+    # shape = [3, 1]: the slopes of both regressors, then the intercept
+    assert regression.result.reshape(-1).tolist() == pytest.approx(expected_res.tolist(), rel=1e-4)
+    class Model(IModel):
+        def forward(self, *x: list[torch.Tensor]) -> tuple[IsResultPrecise, torch.Tensor]:
+            return regression.ezkl(x), regression.result
+    compute(tmp_path, columns, Model, scales)
+
+
+def test_linear_regression_centered(tmp_path, error: float, scales: list[float]):
+    # Xᵀy is about 0 for the intercept of centered data, so the error can't be relative to it
+    x = torch.linspace(-1, 1, 11)
+    y = 2*x
+    columns = [x, y]
+    regression = Regression.create(columns, error)
+    assert regression.result.reshape(-1).tolist() == pytest.approx([2.0, 0.0], abs=1e-6)
+    assert regression.ezkl([x.reshape(-1, 1), y.reshape(-1, 1)]) == 1.0
+    # The error is still relative to the data, so a wrong intercept is rejected
+    forged = Regression(columns[:-1], y, error)
+    forged.result = torch.nn.Parameter(torch.tensor([[2.0], [0.1]]), requires_grad=False)
+    assert forged.ezkl([x.reshape(-1, 1), y.reshape(-1, 1)]) == 0.0
+    class Model(IModel):
+        def forward(self, *x: list[torch.Tensor]) -> tuple[IsResultPrecise, torch.Tensor]:
+            return regression.ezkl(x), regression.result
+    compute(tmp_path, columns, Model, scales)
+
+def test_covariance_correlation_float64(error: float):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.rand(100_000, generator=generator) * 1000 + 1e4
+    y = x * 0.5 + torch.rand(100_000, generator=generator) * 10
+    x_list, y_list = x.tolist(), y.tolist()
+    covariance = Covariance.create([x, y], error)
+    correlation = Correlation.create([x, y], error)
+    assert covariance.result.item() == pytest.approx(statistics.covariance(x_list, y_list), rel=1e-6)
+    assert correlation.result.item() == pytest.approx(statistics.correlation(x_list, y_list), rel=1e-6)
+    assert correlation.x_std.item() == pytest.approx(statistics.stdev(x_list), rel=1e-6)
+    # Operations on the same column have the same mean witness
+    assert covariance.x_mean == correlation.x_mean == Stdev.create([x], error).data_mean
+    with pytest.raises(statistics.StatisticsError):
+        Correlation.create([x, torch.ones_like(x)], error)
+
+
+def test_streaming_witness(tmp_path, monkeypatch, error: float):
+    generator = torch.Generator().manual_seed(0)
+    # Ties, and elements filtered out in the middle of the chunks
+    x = (torch.rand(1001, generator=generator) * 100).round(decimals=1)
+    y = x * 0.3 + torch.rand(1001, generator=generator)
+    x[::7] = MagicNumber
+    y[::7] = MagicNumber
+    x_list = [v for v in x.tolist() if v != np.float32(MagicNumber)]
+    y_list = [v for v in y.tolist() if v != np.float32(MagicNumber)]
+    expected = {
+        Mean: statistics.mean(x_list),
+        Median: statistics.median(x_list),
+        PVariance: statistics.pvariance(x_list),
+        Stdev: statistics.stdev(x_list),
+        Variance: statistics.variance(x_list),
+    }
+    in_memory = {op_type: op_type.create([x], error) for op_type in expected}
+    # The witness is calculated from a few rows of memory-mapped columns at a time
+    np.save(tmp_path / "x.npy", x.numpy())
+    np.save(tmp_path / "y.npy", y.numpy())
+    x_mapped = torch.from_numpy(np.load(tmp_path / "x.npy", mmap_mode="c"))
+    y_mapped = torch.from_numpy(np.load(tmp_path / "y.npy", mmap_mode="c"))
+    monkeypatch.setattr(zkstats.ops, "CHUNK_SIZE", 10)
+    for op_type, expected_res in expected.items():
+        op = op_type.create([x_mapped], error)
+        assert op.result.item() == pytest.approx(expected_res, rel=1e-6)
+        assert op.result.item() == pytest.approx(in_memory[op_type].result.item(), rel=1e-6)
+    median = Median.create([x_mapped], error)
+    assert median.lower.item() == sorted(x_list)[(len(x_list) - 1) // 2]
+    assert Covariance.create([x_mapped, y_mapped], error).result.item() == pytest.approx(statistics.covariance(x_list, y_list), rel=1e-6)
+    assert Correlation.create([x_mapped, y_mapped], error).result.item() == pytest.approx(statistics.correlation(x_list, y_list), rel=1e-6)
+    regression = Regression.create([x_mapped, y_mapped], error)
+    expected_regression = statistics.linear_regression(x_list, y_list)
+    assert regression.result.reshape(-1).tolist() == pytest.approx([expected_regression.slope, expected_regression.intercept], rel=1e-5)
+    # Moments of a column don't depend on the other columns
+    assert RunningMoments.of([x_mapped]).mean[0] == RunningMoments.of([x_mapped, y_mapped]).mean[0]
+    # Selection narrows down to equal elements
+    assert order_statistics_f64(torch.full((50,), 3.0), [0, 25, 49], chunk_size=4) == [3.0, 3.0, 3.0]
+
+
+def test_float64_witness(error: float):
+    # 1.0 apart at this magnitude in float32, so float32 data would round every element
+    x_list = [10000000.25, 10000000.5, 10000000.75]
+    x = torch.tensor(x_list + [MagicNumber], dtype=torch.float64).reshape(-1, 1)
+    keys = torch.tensor([1.0, 2.0, 1.0, MagicNumber], dtype=torch.float64).reshape(-1, 1)
+    expected = {
+        Mean: statistics.mean(x_list),
+        Median: statistics.median(x_list),
+        Variance: statistics.variance(x_list),
+        Quantiles: statistics.quantiles(x_list, n=4, method="inclusive"),
+    }
+    for op_type, expected_res in expected.items():
+        op = op_type.create([x], error, qs=(0.25, 0.5, 0.75)) if op_type is Quantiles else op_type.create([x], error)
+        assert all(witness.dtype == torch.float64 for witness in op.get_witness())
+        assert op.result.tolist() == pytest.approx(expected_res, rel=1e-12)
+        assert op.ezkl([x])
+    group_sum = GroupSum.create([keys, x], error)
+    assert group_sum.result.dtype == torch.float64
+    assert group_sum.result.tolist() == pytest.approx([20000001.0, 10000000.5], rel=1e-12)
+    assert Mean.create([x.float()], error).result.item() != pytest.approx(expected[Mean], rel=1e-12)
+
+
+def test_shared_mean_is_checked(column_0: torch.Tensor, error: float):
+    x = column_0.reshape(-1, 1)
+    stdev = Stdev.create([x], error)
+    variance = Variance.create([x], error)
+    moments = Moments(error)
+    assert stdev.ezkl([x], moments)
+    assert variance.ezkl([x], moments)
+    # The mean witness of the second operation isn't used for the deviations, but it's still checked
+    variance.data_mean = torch.nn.Parameter(variance.data_mean.data * 2, requires_grad=False)
+    assert not variance.ezkl([x], moments)
+
+
+def test_order_statistic(error: float):
+    x = torch.tensor([3.0, MagicNumber, 1.0, 2.0, MagicNumber, 5.0, 4.0]).reshape(-1, 1)
+    moments = Moments(error)
+    # Elements filtered out come first
+    assert moments.sorted(x).tolist() == [0.0, 0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
+    assert [moments.order_statistic(x, torch.tensor(float(rank))).item() for rank in range(5)] == [1.0, 2.0, 3.0, 4.0, 5.0]
+    # The middle elements are the same for an odd count
+    median = Median.create([x], error)
+    assert median.lower == median.upper == median.result == 3.0
+    assert median.ezkl([x], moments)
+    median.lower = torch.nn.Parameter(torch.tensor(2.0), requires_grad=False)
+    median.result = torch.nn.Parameter(torch.tensor(2.5), requires_grad=False)
+    assert not median.ezkl([x], moments)
+
+
+def test_quantiles(tmp_path, column_0: torch.Tensor, error: float, scales: list[float]):
+    qs = [0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+    op = Quantiles.create([column_0], error, qs)
+    for q, result in zip(qs, op.result):
+        assert_result(np.quantile(column_0.numpy(), q), result)
+    for expected, result in zip(statistics.quantiles(column_0.tolist(), n=4, method="inclusive"), op.result[1:4]):
+        assert_result(expected, result)
+    x = column_0.reshape(-1, 1)
+    assert op.ezkl([x])
+    # The ranks are checked, not only the interpolation between the elements at the ranks
+    wrong = Quantiles.create([column_0], error, qs)
+    wrong.ranks = torch.nn.Parameter(wrong.ranks.data + torch.tensor([0.0, 0.0, 1.0, 0.0, 0.0, 0.0]), requires_grad=False)
+    # 5.5 is the element at the wrong rank
+    wrong.result = torch.nn.Parameter(torch.tensor([1.7, 2.75, 5.5, 6.4, 6.73, 7.423]), requires_grad=False)
+    assert not wrong.ezkl([x])
+    with pytest.raises(statistics.StatisticsError):
+        Quantiles.create([torch.full_like(column_0, MagicNumber)], error, qs)
+    # The lookup range grows with the denominators of the probabilities, so prove with small ones
+    op = Quantiles.create([column_0], error, [0.1, 0.25, 0.5, 0.75])
+    class Model(IModel):
+        def forward(self, *x: list[torch.Tensor]) -> tuple[IsResultPrecise, torch.Tensor]:
+            return op.ezkl(x), op.result
+    compute(tmp_path, [column_0], Model, scales)
+
+
+def test_histogram(tmp_path, column_0: torch.Tensor, error: float, scales: list[float]):
+    # 7.5 is on the last edge, 1.0 below the first one
+    edges = [1.5, 3.0, 4.5, 6.4, 7.5]
+    op = Histogram.create([column_0], error, edges)
+    assert op.result.tolist() == np.histogram(column_0.numpy(), bins=edges)[0].tolist() == [1, 1, 2, 3]
+    x = column_0.reshape(-1, 1)
+    assert op.ezkl([x])
+    # Counts consistent with the ranks are still checked against the data: 4.5 moved to the first bin
+    wrong = Histogram.create([column_0], error, edges)
+    wrong.ranks = torch.nn.Parameter(torch.tensor([1.0, 3.0, 3.0, 4.0, 7.0]), requires_grad=False)
+    wrong.result = torch.nn.Parameter(torch.tensor([2.0, 0.0, 1.0, 3.0]), requires_grad=False)
+    assert not wrong.ezkl([x])
+    # Elements filtered out are not counted, and bins can be empty
+    filtered = torch.cat((column_0, torch.tensor([MagicNumber, MagicNumber])))
+    op_filtered = Histogram.create([filtered], error, [0.0, 1.0, 2.0, 100.0])
+    assert op_filtered.result.tolist() == [0, 1, 7]
+    assert op_filtered.ezkl([filtered.reshape(-1, 1)])
+    with pytest.raises(ValueError):
+        Histogram.create([column_0], error, [1.0, 1.0])
+    class Model(IModel):
+        def forward(self, *x: list[torch.Tensor]) -> tuple[IsResultPrecise, torch.Tensor]:
+            return op.ezkl(x), op.result
+    compute(tmp_path, [column_0], Model, scales)
+
+
+def test_mode_certificate(error: float):
+    x = torch.tensor([3.0, 1.0, 2.0, 3.0, 2.0, 3.0, MagicNumber, MagicNumber]).reshape(-1, 1)
+    mode = Mode.create([x], error)
+    assert mode.result == 3.0
+    # Elements filtered out come first, then the runs of 1.0, 2.0 and 3.0
+    assert mode.runs.reshape(-1).tolist() == [1, 2, 1, 1, 2, 1, 2, 3]
+    assert mode.ezkl([x])
+    # 2.0 occurs less often than 3.0
+    mode.result = torch.nn.Parameter(torch.tensor(2.0), requires_grad=False)
+    assert not mode.ezkl([x])
+    # Runs can't be cut short to hide how often a value occurs
+    mode = Mode.create([x], error)
+    mode.result = torch.nn.Parameter(torch.tensor(2.0), requires_grad=False)
+    mode.runs = torch.nn.Parameter(torch.tensor([1, 2, 1, 1, 2, 1, 2, 1.0]).reshape(-1, 1), requires_grad=False)
+    assert not mode.ezkl([x])
+
+
+@pytest.mark.parametrize("error", [0, 0.01, 0.2])
+def test_mode_within(error: float):
+    data = torch.tensor([5.0, 1.0, 2.0, 1.01, 3.0, 2.0, 5.0, 0.99, 3.5, 4.9])
+    # The first data point with the most data points within the error wins
+    max_sum_freq, expected = 0, None
+    for check_val in data.tolist():
+        sum_freq = sum(1 for ele in data.tolist() if abs(ele - check_val) <= abs(error * check_val))
+        if sum_freq > max_sum_freq:
+            max_sum_freq, expected = sum_freq, check_val
+    assert mode_within(data, error).item() == pytest.approx(expected)
+
+
+def test_mode_within_op(tmp_path, scales: list[float]):
+    error = 0.02
+    column = torch.tensor([1.0, 2.0, 2.03, 3.0, 3.0, 2.05, 1.5])
+    op = ModeWithin.create([column], error)
+    # 2.0 and 2.05 are both within 2% of 2.03, while 3.0 occurs only twice
+    assert op.result == torch.tensor(2.03)
+    assert op.ezkl([column.reshape(-1, 1)])
+    wrong = ModeWithin.create([column], error)
+    wrong.result = torch.nn.Parameter(torch.tensor(3.0), requires_grad=False)
+    assert not wrong.ezkl([column.reshape(-1, 1)])
+    # Elements filtered out are not counted
+    filtered = torch.cat((column, torch.tensor([MagicNumber, MagicNumber])))
+    assert ModeWithin.create([filtered], error).ezkl([filtered.reshape(-1, 1)])
+    # Elements filtered out don't count for a wrong result within the error of the filler, min(x)-1
+    x = torch.tensor([1.0, 5.0, 5.0, MagicNumber, MagicNumber, MagicNumber]).reshape(-1, 1)
+    forged = ModeWithin.create([x], 1.0)
+    assert forged.result == torch.tensor(5.0)
+    assert forged.ezkl([x])
+    forged.result = torch.nn.Parameter(torch.tensor(1.0), requires_grad=False)
+    assert not forged.ezkl([x])
+    class Model(IModel):
+        def forward(self, *x: list[torch.Tensor]) -> tuple[IsResultPrecise, torch.Tensor]:
+            return op.ezkl(x), op.result
+    compute(tmp_path, [column], Model, scales)
+
+
+@pytest.mark.parametrize(
+    "op_type, expected_func",
+    [
+        (GroupCount, len),
+        (GroupSum, sum),
+        (GroupMean, statistics.mean),
+        (GroupVariance, statistics.variance),
+    ]
+)
+def test_group_by(tmp_path, column_0: torch.Tensor, error: float, op_type: Type[GroupBy], expected_func: Callable[[list[float]], float], scales: list[float]):
+    key_column = torch.tensor([1.0, 2.0, 1.0, 3.0, 2.0, 1.0, 3.0, 2.0])
+    op = op_type.create([key_column, column_0], error)
+    assert op.keys.tolist() == [1.0, 2.0, 3.0]
+    for key, result in zip(op.keys.tolist(), op.result):
+        assert_result(expected_func([v for k, v in zip(key_column.tolist(), column_0.tolist()) if k == key]), result)
+    args = [key_column.reshape(-1, 1), column_0.reshape(-1, 1)]
+    assert op.ezkl(args)
+    # Every row must be in a group
+    wrong = op_type.create([key_column, column_0], error)
+    wrong.keys = torch.nn.Parameter(torch.tensor([1.0, 2.0, 4.0]), requires_grad=False)
+    assert not wrong.ezkl(args)
+    # Given keys leave out the rows with other keys, here the rows filtered out and key 3
+    filtered = torch.where(column_0 < 7, column_0, MagicNumber)
+    given = op_type.create([key_column, filtered], error, keys=[2.0, 1.0])
+    assert given.keys.tolist() == [2.0, 1.0]
+    for key, result in zip([2.0, 1.0], given.result):
+        assert_result(expected_func([v for k, v in zip(key_column.tolist(), column_0.tolist()) if k == key and v < 7]), result)
+    assert given.ezkl([key_column.reshape(-1, 1), filtered.reshape(-1, 1)])
+    class Model(IModel):
+        def forward(self, *x: list[torch.Tensor]) -> tuple[IsResultPrecise, torch.Tensor]:
+            return op.ezkl(x), op.result
+    compute(tmp_path, [key_column, column_0], Model, scales)
+
 
 def run_test_ops(tmp_path, op_type: Type[Operation], expected_func: Callable[[list[float]], float], error: float, scales: list[float], columns: list[torch.Tensor]):
     op = op_type.create(columns, error)
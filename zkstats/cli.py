@@ -9,6 +9,7 @@ import torch
 
 from .core import prover_gen_proof, prover_gen_settings, setup, verifier_verify, generate_data_commitment
 from .computation import computation_to_model
+from .explain import explain as explain_computation, DEFAULT_EXPLAIN_SCALE
 
 cwd = os.getcwd()
 # TODO: Should make this configurable
@@ -35,7 +36,8 @@ def cli():
 @click.command()
 @click.argument('computation_path')
 @click.argument('data_path')
-def prove(computation_path: str, data_path: str):
+@click.option('--float64', is_flag=True, help='Calculate the witness and export the model in float64.')
+def prove(computation_path: str, data_path: str, float64: bool):
     computation = load_computation(computation_path)
     _, model = computation_to_model(computation)
     generate_data_commitment(data_path, default_possible_scales, data_commitment_path)
@@ -52,6 +54,7 @@ def prove(computation_path: str, data_path: str):
         "default",
         "resources",
         settings_path,
+        float64=float64,
     )
     setup(
         model_onnx_path,
@@ -102,6 +105,20 @@ def commit(data_path: str, scale_str: str):
     print("Commitment maps:", data_commitment)
 
 
+@click.command()
+@click.argument('computation_path')
+@click.argument('num_rows', type=int)
+@click.argument('num_columns', type=int)
+@click.option('--scale', type=int, default=DEFAULT_EXPLAIN_SCALE, help='Scale expected to encode the data.')
+def explain(computation_path: str, num_rows: int, num_columns: int, scale: int):
+    """
+    Estimate the cost of proving the computation on data with the given shape, without generating the circuit.
+    """
+    computation = load_computation(computation_path)
+    estimate = explain_computation(computation, (num_rows, num_columns), scale=scale)
+    print(estimate)
+
+
 def main():
     cli()
 
@@ -129,6 +146,7 @@ def load_computation(module_path: str) -> Type[torch.nn.Module]:
 cli.add_command(prove)
 cli.add_command(verify)
 cli.add_command(commit)
+cli.add_command(explain)
 
 
 if __name__ == "__main__":
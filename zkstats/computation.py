@@ -1,17 +1,25 @@
+import copy
+import hashlib
+import importlib
+import inspect
 from abc import abstractmethod
-from typing import Callable, Type, Optional, Union
+from typing import Any, Callable, Sequence, Type, Optional, Union
 
+import onnx
 import torch
 from torch import nn
-import json
 
 from .ops import (
     Operation,
+    Moments,
     Mean,
     Median,
     GeometricMean,
     HarmonicMean,
     Mode,
+    ModeWithin,
+    Quantiles,
+    Histogram,
     PStdev,
     PVariance,
     Stdev,
@@ -19,38 +27,171 @@ from .ops import (
     Covariance,
     Correlation,
     Regression,
+    GroupBy,
+    GroupCount,
+    GroupSum,
+    GroupMean,
+    GroupVariance,
     IsResultPrecise,
 )
+from .ir import Graph, Node, NodeKind, Ref
+from .witness import PrecalWitness
 
 
 DEFAULT_ERROR = 0.01
 MagicNumber = 99.999
+# Aggregates of `State.group_by`
+GROUP_BY_OPS: dict[str, Type[GroupBy]] = {
+    "count": GroupCount,
+    "sum": GroupSum,
+    "mean": GroupMean,
+    "variance": GroupVariance,
+}
 
 
 class State:
     """
     State is a container for intermediate results of computation.
 
-    Stage 1 (current_op_index is None): for every call to State (mean, median, etc.), result
-        is calculated and temporarily stored in the state. Call `set_ready_for_exporting_onnx` to indicate
-    Stage 2: all operations are calculated and results are ready to be used. Call `set_ready_for_exporting_onnx`
-        to indicate it's ready to generate settings.
-    Stage 3 (current_op_index is not None): when exporting to onnx, when the operations are called, the results and
-        the conditions are popped from the state and filled in the onnx graph.
+    The computation is traced once with `trace`: for every call to State (mean, median, etc.), the operation is
+    created with its witness (calculated by the prover, or read from the precalculated witness by the verifier) and
+    recorded in `graph` together with the torch calls, the `where` masks and the dataflow between them.
+    When exporting to onnx, `run` replays `graph` on the input tensors and adds the constraints of the operations,
+    without running the computation again.
+
+    Calling the same operation on the same input tensors more than once only records one operation. The later calls
+    reuse its result, and its constraints are only added to the onnx graph once.
     """
     def __init__(self, error: float) -> None:
         self.ops: list[Operation] = []
-        self.bools: list[Callable[[], torch.Tensor]] = []
         self.error: float = error
-        # Pointer to the current operation index. If None, it's in stage 1. If not None, it's in stage 3.
-        self.current_op_index: Optional[int] = None
+        # The traced computation. None before tracing.
+        self.graph: Optional[Graph] = None
+        # (operation type, refs of the input tensors) -> the recorded operation node
+        self._op_nodes: dict[tuple[Type[Operation], tuple[Ref, ...]], Node] = {}
+        # Ref of a traced tensor -> its validity mask, the same as the circuit uses. Tensors without one are compared
+        # with `MagicNumber` when creating the operations.
+        self._masks: dict[Ref, torch.Tensor] = {}
+        # Batch only: number of output elements of each computation, in order
+        self.output_sizes: Optional[list[int]] = None
         self.precal_witness_path: str = None
-        self.precal_witness:dict = {}
+        # Verifier: the witness read from `precal_witness_path` or given in memory. Loaded at most once.
+        self.precal_witness: Optional[PrecalWitness] = None
         self.isProver:bool = None
-        self.op_dict:dict={}
+        # The witness is given to the circuit as a private input instead of constants. See `computation_to_model`.
+        self.private_witness: bool = False
+        # The last input is the validity mask of the rows of all columns. See `computation_to_model`.
+        self.validity_mask: bool = False
 
-    def set_ready_for_exporting_onnx(self) -> None:
-        self.current_op_index = 0
+    def trace(self, computation: 'TComputation', x: list[torch.Tensor]) -> None:
+        """
+        Run the computation once on `x`, creating the operations and recording them in `graph`.
+        The prover writes the precalculated witness to `precal_witness_path` afterwards, if given.
+        """
+        if self.graph is not None:
+            raise Exception("computation is already traced")
+        self.graph = Graph()
+        # The computation doesn't see the validity mask
+        num_columns = len(x) - 1 if self.validity_mask else len(x)
+        def traced(args: list[torch.Tensor]) -> Any:
+            if self.validity_mask:
+                for column in args[:num_columns]:
+                    self._masks[self.graph.ref(column)] = args[-1]
+            return computation(self, args[:num_columns])
+        self.graph.trace(traced, x)
+        if self.isProver and self.precal_witness_path is not None:
+            PrecalWitness.from_ops(self.ops).dump(self.precal_witness_path)
+
+    def run(self, x: list[torch.Tensor], witness: Sequence[torch.Tensor] = ()) -> tuple[IsResultPrecise, torch.Tensor]:
+        """
+        Replay the traced computation on `x` and return whether all operations are precise, and the result.
+
+        :param witness: if not empty, the values of `witness_inputs` used instead of the witness of the operations,
+            so that the witness can be given as graph inputs when exporting
+        """
+        if self.graph is None:
+            raise Exception("computation is not traced yet")
+        ops = self.ops if len(witness) == 0 else self._ops_with_witness(witness)
+        moments = Moments(self.error)
+        if self.validity_mask:
+            for column in x[:-1]:
+                moments.set_mask(column, x[-1])
+        bools: list[IsResultPrecise] = []
+        def call_operation(node: Node, args: list[torch.Tensor]) -> torch.Tensor:
+            op = ops[node.op_index]
+            bools.append(op.ezkl(args, moments))
+            # Depend on the input so that the result is connected to the inputs in the onnx graph
+            return op.result+(args[0]-args[0])[0][0]
+        def call_where(_filter: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+            # Operations on the result use the filter rather than comparing it with `MagicNumber` again
+            return moments.filter(_filter, x)
+        result = self.graph.run(x, call_operation, call_where)
+        is_precise_aggregated = (x[0]-x[0])[0][0]+torch.tensor(1.0, dtype=x[0].dtype)
+        for res in bools:
+            is_precise_aggregated = torch.logical_and(is_precise_aggregated, res)
+        return is_precise_aggregated, result
+
+    def witness_inputs(self) -> list[tuple[str, torch.Tensor]]:
+        """
+        Names and values of the witness of all operations, in order. With `private_witness`, one flattened input
+        holding all of them, so that the circuit hashes the witness once.
+        """
+        inputs = [
+            (f"witness_{i}_{name}", value)
+            for i, op in enumerate(self.ops)
+            for name, value in zip(op.witness_fields, op.get_witness())
+        ]
+        if self.private_witness and len(inputs) > 0:
+            return [("witness", torch.cat([value.reshape(-1) for _, value in inputs]))]
+        return inputs
+
+    def fingerprint(self) -> str:
+        """
+        Hash of everything the exported onnx graph depends on, except the values of the witness: the traced
+        computation, the shapes of the data and the witness, the operations and the error, and the code and
+        versions of the libraries exporting it.
+        """
+        if self.graph is None:
+            raise Exception("computation is not traced yet")
+        h = hashlib.sha256()
+        h.update(self.graph.fingerprint().encode())
+        h.update(repr((self.error, [op.error for op in self.ops], self.private_witness, self.validity_mask)).encode())
+        for op_type in dict.fromkeys(type(op) for op in self.ops):
+            # The constraints of the operation change with the implementation
+            h.update(_source(op_type).encode())
+        for module_name in _EXPORT_MODULES:
+            h.update(_source(importlib.import_module(module_name)).encode())
+        h.update(repr((torch.__version__, onnx.__version__)).encode())
+        h.update(repr([(name, tuple(value.shape)) for name, value in self.witness_inputs()]).encode())
+        return h.hexdigest()
+
+    def _ops_with_witness(self, witness: Sequence[torch.Tensor]) -> list[Operation]:
+        if self.private_witness:
+            # Split the flattened witness into the fields
+            shapes = [getattr(op, name).shape for op in self.ops for name in op.witness_fields]
+            values = torch.split(witness[0], [shape.numel() for shape in shapes])
+            witness = [value.reshape(shape) for value, shape in zip(values, shapes)]
+        num_fields = sum(len(op.witness_fields) for op in self.ops)
+        if len(witness) != num_fields:
+            raise Exception(f"witness length mismatch: {len(witness)=} != {num_fields=}")
+        ops = []
+        values = iter(witness)
+        for op in self.ops:
+            # Plain tensors rather than parameters, which would not be connected to the inputs when tracing
+            op = copy.copy(op)
+            for name in op.witness_fields:
+                setattr(op, name, next(values))
+            ops.append(op)
+        return ops
+
+    def get_precal_witness(self) -> PrecalWitness:
+        """
+        Get the precalculated witness for the verifier. It's loaded from `precal_witness_path` on the first call
+        and cached, so all operations share one immutable copy.
+        """
+        if self.precal_witness is None:
+            self.precal_witness = PrecalWitness.load(self.precal_witness_path)
+        return self.precal_witness
 
     def mean(self, x: torch.Tensor) -> torch.Tensor:
         """
@@ -66,6 +207,32 @@ class State:
         """
         return self._call_op([x], Median)
 
+    def quantiles(self, x: torch.Tensor, qs: Sequence[float]) -> torch.Tensor:
+        """
+        Calculate the quantiles of the input tensor at the probabilities `qs`, interpolated linearly between the
+        data points. The behavior should conform to `numpy.quantile`, and to
+        [statistics.quantiles](https://docs.python.org/3/library/statistics.html#statistics.quantiles) in Python
+        standard library with `method="inclusive"`, e.g. `qs=[0.25, 0.5, 0.75]` for `n=4`. All quantiles are one
+        operation, sharing the sort of the input.
+
+        :param x: the input tensor
+        :param qs: the probabilities, between 0 and 1
+        :return: 1d tensor of the quantiles, in the order of `qs`
+        """
+        return self._call_op([x], Quantiles, qs=tuple(qs))
+
+    def histogram(self, x: torch.Tensor, edges: Sequence[float]) -> torch.Tensor:
+        """
+        Count the elements of the input tensor in each bin between consecutive `edges`. The behavior should conform
+        to `numpy.histogram` with `bins=edges`: a bin includes its lower edge, and the last bin its upper edge too.
+        All bins are one operation, sharing the sort of the input with the other order statistics.
+
+        :param x: the input tensor
+        :param edges: the edges of the bins, increasing
+        :return: 1d tensor of the counts of the bins, with one element less than `edges`
+        """
+        return self._call_op([x], Histogram, edges=tuple(edges))
+
     def geometric_mean(self, x: torch.Tensor) -> torch.Tensor:
         """
         Calculate the geometric mean of the input tensor. The behavior should conform to
@@ -87,6 +254,17 @@ class State:
         """
         return self._call_op([x], Mode)
 
+    def mode_within(self, x: torch.Tensor, error: float) -> torch.Tensor:
+        """
+        Calculate the mode of the input tensor, counting values within `error` of a value, relative to the value,
+        as the same value. Like `mode`, the first value encountered wins if there are more than 1 value possible.
+
+        :param x: the input tensor
+        :param error: the error that allows the values to be considered the same, e.g. 0.01 for 1% value range.
+            Used instead of the error of the state
+        """
+        return self._call_op([x], ModeWithin, error)
+
     def pstdev(self, x: torch.Tensor) -> torch.Tensor:
         """
         Calculate the population standard deviation of the input tensor. The behavior should conform to
@@ -129,13 +307,36 @@ class State:
         """
         return self._call_op([x, y], Correlation)
 
-    def linear_regression(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    def linear_regression(self, x: Union[torch.Tensor, Sequence[torch.Tensor]], y: torch.Tensor) -> torch.Tensor:
         """
         Calculate the linear regression of x and y. The behavior should conform to
         [statistics.linear_regression](https://docs.python.org/3/library/statistics.html#statistics.linear_regression) in Python standard library.
+        Several regressors can be given as a sequence of columns for the ordinary least squares fit on all of them.
+
+        :param x: the regressor column, or a sequence of regressor columns
+        :param y: the dependent column
+        :return: the slopes of the regressors in order, then the intercept, with the shape [len(x)+1, 1]
         """
-        # hence support only one x for now
-        return self._call_op([x, y], Regression)
+        xs = [x] if isinstance(x, torch.Tensor) else list(x)
+        return self._call_op([*xs, y], Regression)
+
+    def group_by(self, key_column: torch.Tensor, values: torch.Tensor, agg: str, keys: Optional[Sequence[float]] = None) -> torch.Tensor:
+        """
+        Aggregate `values` for every group of rows with the same key in `key_column`, all groups in one operation.
+        Rows filtered out in either column are left out. The mean and the variance of a group conform to
+        `statistics.mean` and `statistics.variance` on its values.
+
+        :param key_column: the keys of the rows, e.g. the categories of a categorical column
+        :param values: the values to aggregate
+        :param agg: "count", "sum", "mean" or "variance"
+        :param keys: the keys of the groups. If None, the distinct keys in `key_column` in ascending order, and every
+            row must have one of them. If given, rows with other keys are left out, and the circuit doesn't depend
+            on the data, e.g. for `private_witness`
+        :return: 1d tensor of the aggregates of the groups, in the order of the keys
+        """
+        if agg not in GROUP_BY_OPS:
+            raise ValueError(f"unsupported aggregate: {agg=}, expected one of {list(GROUP_BY_OPS)}")
+        return self._call_op([key_column, values], GROUP_BY_OPS[agg], keys=None if keys is None else tuple(keys))
 
     # WHERE operation
     def where(self, _filter: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
@@ -146,127 +347,61 @@ class State:
         :param x: A tensor to be filtered
         :return: filtered tensor
         """
-        return torch.where(_filter, x, x-x+MagicNumber)
-
-    def _call_op(self, x: list[torch.Tensor], op_type: Type[Operation]) -> Union[torch.Tensor, tuple[IsResultPrecise, torch.Tensor]]:
-        if self.current_op_index is None:
-            # for prover
-            if self.isProver:
-                # print('Prover side create')
-                op = op_type.create(x, self.error)
-
-                # Single witness aka result
-                if isinstance(op,Mean) or isinstance(op,GeometricMean) or isinstance(op, HarmonicMean) or isinstance(op, Mode):
-                    op_class_str =str(type(op)).split('.')[-1].split("'")[0]
-                    if op_class_str not in self.op_dict:
-                        self.precal_witness[op_class_str+"_0"] = [op.result.data.item()]
-                        self.op_dict[op_class_str] = 1
-                    else: 
-                        self.precal_witness[op_class_str+"_"+str(self.op_dict[op_class_str])] = [op.result.data.item()]
-                        self.op_dict[op_class_str]+=1
-                elif isinstance(op, Median):
-                    if 'Median' not in self.op_dict:
-                        self.precal_witness['Median_0'] = [op.result.data.item(), op.lower.data.item(), op.upper.data.item()]
-                        self.op_dict['Median']=1
-                    else:
-                        self.precal_witness['Median_'+str(self.op_dict['Median'])] = [op.result.data.item(), op.lower.data.item(), op.upper.data.item()]
-                        self.op_dict['Median']+=1
-                # std + variance stuffs
-                elif isinstance(op, PStdev) or isinstance(op, PVariance) or isinstance(op, Stdev) or isinstance(op, Variance):
-                    op_class_str =str(type(op)).split('.')[-1].split("'")[0]
-                    if op_class_str not in self.op_dict:
-                        self.precal_witness[op_class_str+"_0"] = [op.result.data.item(), op.data_mean.data.item()]
-                        self.op_dict[op_class_str] = 1
-                    else: 
-                        self.precal_witness[op_class_str+"_"+str(self.op_dict[op_class_str])] = [op.result.data.item(), op.data_mean.data.item()]
-                        self.op_dict[op_class_str]+=1
-                elif isinstance(op, Covariance):
-                    if 'Covariance' not in self.op_dict:
-                        self.precal_witness['Covariance_0'] = [op.result.data.item(), op.x_mean.data.item(), op.y_mean.data.item()]
-                        self.op_dict['Covariance']=1
-                    else:
-                        self.precal_witness['Covariance_'+str(self.op_dict['Covariance'])] = [op.result.data.item(), op.x_mean.data.item(), op.y_mean.data.item()]
-                        self.op_dict['Covariance']+=1
-                elif isinstance(op, Correlation):
-                    if 'Correlation' not in self.op_dict:
-                        self.precal_witness['Correlation_0'] = [op.result.data.item(), op.x_mean.data.item(), op.y_mean.data.item(), op.x_std.data.item(), op.y_std.data.item(), op.cov.data.item()]
-                        self.op_dict['Correlation']=1
-                    else:
-                        self.precal_witness['Correlation_'+str(self.op_dict['Correlation'])] = [op.result.data.item(), op.x_mean.data.item(), op.y_mean.data.item(), op.x_std.data.item(), op.y_std.data.item(), op.cov.data.item()]
-                        self.op_dict['Correlation']+=1
-                elif isinstance(op, Regression):
-                    result_array = []
-                    for ele in op.result.data:
-                        result_array.append(ele[0].item())
-                    if 'Regression' not in self.op_dict:
-                        self.precal_witness['Regression_0'] = [result_array]
-                        self.op_dict['Regression']=1
-                    else:
-                        self.precal_witness['Regression_'+str(self.op_dict['Regression'])] = [result_array]
-                        self.op_dict['Regression']+=1
-                    # for ele in op.result.data[0]:
-                    #     result_array.append(ele[0].item())
-                    # if 'Regression' not in self.op_dict:
-                    #     self.precal_witness['Regression_0'] = [result_array]
-                    #     self.op_dict['Regression']=1
-                    # else:
-                    #     self.precal_witness['Regression_'+str(self.op_dict['Regression'])] = [result_array]
-                    #     self.op_dict['Regression']+=1
+        graph = self._get_recording_graph()
+        x_mask = self._masks.get(graph.ref(x))
+        with graph.paused():
+            result = torch.where(_filter, x, x-x+MagicNumber)
+            if x_mask is not None:
+                # Like `Moments.filter`: rows filtered out of `x` stay filtered out
+                mask = torch.logical_and(_filter, x_mask.reshape(x.shape)!=0).to(x.dtype)
+        graph.add_node(NodeKind.WHERE, [result], (_filter, x))
+        if x_mask is not None:
+            self._masks[graph.ref(result)] = mask
+        return result
+
+    def _get_recording_graph(self) -> Graph:
+        if self.graph is None or not self.graph.recording:
+            raise Exception("operations can only be called in the computation traced by `State.trace`")
+        return self.graph
+
+    def _call_op(self, x: list[torch.Tensor], op_type: Type[Operation], error: Optional[float] = None, **params: Any) -> torch.Tensor:
+        graph = self._get_recording_graph()
+        error = self.error if error is None else error
+        # Identity rather than content, so that prover and verifier (with dummy data) record the same operations
+        key = (op_type, tuple(graph.ref(t) for t in x), error, tuple(sorted(params.items())))
+        if key in self._op_nodes:
+            return graph.value(self._op_nodes[key].outputs[0])
+        with graph.paused():
+            # for prover, and for verifier if the witness is private: the circuit doesn't depend on the witness
+            # values, so the verifier's witness from dummy data gives the same circuit
+            if self.isProver or self.private_witness:
+                masks = [self._masks.get(graph.ref(t)) for t in x]
+                op = op_type.create(x, error, **params, masks=masks)
             # for verifier
             else:
-                # print('Verifier side create')
-                precal_witness = json.loads(open(self.precal_witness_path, "r").read())
-                op = op_type.create(x, self.error, precal_witness, self.op_dict)
-                op_class_str =str(type(op)).split('.')[-1].split("'")[0]
-                if op_class_str not in self.op_dict:
-                    self.op_dict[op_class_str] = 1
-                else:
-                    self.op_dict[op_class_str]+=1
-            self.ops.append(op)
-            return op.result
-        else:
-            # Copy the current op index to a local variable since self.current_op_index will be incremented.
-            current_op_index = self.current_op_index
-            # Sanity check that current op index is not out of bound
-            len_ops = len(self.ops)
-            if current_op_index >= len(self.ops):
-                raise Exception(f"current_op_index out of bound: {current_op_index=} >= {len_ops=}")
-
-            op = self.ops[current_op_index]
-            # Sanity check that the operation type matches the current op type
-            if not isinstance(op, op_type):
-                raise Exception(f"operation type mismatch: {op_type=} != {type(op)=}")
-
-            # Increment the current op index
-            self.current_op_index += 1
-
-            # Push the ezkl condition, which is checked only in the last operation
-            def is_precise() -> IsResultPrecise:
-                return op.ezkl(x)
-            self.bools.append(is_precise)
-
-            # If this is the last operation, aggregate all `is_precise` in `self.bools`, and return (is_precise_aggregated, result)
-            # else, return only result
-
-            if current_op_index == len_ops - 1:
-                # print('final op: ', op)
-                # Sanity check for length of self.ops and self.bools
-                len_bools = len(self.bools)
-                if len_ops != len_bools:
-                    raise Exception(f"length mismatch: {len_ops=} != {len_bools=}")
-                is_precise_aggregated = torch.tensor(1.0)
-                for i in range(len_bools):
-                    res = self.bools[i]()
-                    is_precise_aggregated = torch.logical_and(is_precise_aggregated, res)
-                if self.isProver:
-                    json.dump(self.precal_witness, open(self.precal_witness_path, 'w'))
-                return is_precise_aggregated, op.result+(x[0]-x[0])[0][0]
-
-            elif current_op_index > len_ops - 1:
-                # Sanity check that current op index does not exceed the length of ops
-                raise Exception(f"current_op_index out of bound: {current_op_index=} > {len_ops=}")
-            else:
-                return op.result+(x[0]-x[0])[0][0]
+                precal_witness = self.get_precal_witness()
+                op_index = len(self.ops)
+                if op_index >= len(precal_witness):
+                    raise Exception(f"precalculated witness has too few operations: {op_index=} >= {len(precal_witness)=}")
+                entry = precal_witness[op_index]
+                if entry.op_type is not op_type:
+                    raise Exception(f"precalculated witness type mismatch: {op_type=} != {entry.op_type=}")
+                op = op_type.from_witness(entry.to_tensors(x[0].dtype), error, **params)
+        # Parameters of the operation are node kwargs, so that they're part of the fingerprint
+        self._op_nodes[key] = graph.add_node(NodeKind.OPERATION, [op.result], tuple(x), params, op_index=len(self.ops))
+        self.ops.append(op)
+        return op.result
+
+
+# Modules building the exported onnx graph, besides the operations used
+_EXPORT_MODULES = ("zkstats.ops", "zkstats.computation", "zkstats.ir", "zkstats.onnx_optimizer", "zkstats.core")
+
+
+def _source(obj: object) -> str:
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return obj.__qualname__ if hasattr(obj, "__qualname__") else obj.__name__
 
 
 class IModel(nn.Module):
@@ -278,6 +413,33 @@ class IModel(nn.Module):
     def forward(self, *x: list[torch.Tensor]) -> tuple[IsResultPrecise, torch.Tensor]:
         ...
 
+    def witness_inputs(self) -> list[tuple[str, torch.Tensor]]:
+        """
+        Names and values of the witness, which `forward` takes after the data when exporting to onnx, so that
+        the witness is not folded into other constants and can be replaced in the exported model.
+        Empty by default, i.e. the witness is part of the model.
+        """
+        return []
+
+    def fingerprint(self) -> Optional[str]:
+        """
+        Hash of everything the exported onnx graph depends on, except the values of `witness_inputs`, after
+        `preprocess`. Models with the same fingerprint export the same graph. None if it can't be cached.
+        """
+        return None
+
+    def private_witness(self) -> bool:
+        """
+        Whether `witness_inputs` stay a private input of the exported model, after the data, rather than constants.
+        """
+        return False
+
+    def validity_mask(self) -> bool:
+        """
+        Whether the model takes the validity mask of the rows as its last input, after the columns.
+        """
+        return False
+
 
 # An computation function. Example:
 # def computation(state: State, x: list[torch.Tensor]):
@@ -287,11 +449,23 @@ class IModel(nn.Module):
 TComputation = Callable[[State, list[torch.Tensor]], torch.Tensor]
 
 
-def computation_to_model(computation: TComputation, precal_witness_path:str, isProver:bool ,error: float = DEFAULT_ERROR ) -> tuple[State, Type[IModel]]:
+def computation_to_model(computation: TComputation, precal_witness_path: Optional[str], isProver:bool ,error: float = DEFAULT_ERROR, precal_witness: Optional[PrecalWitness] = None, private_witness: bool = False, validity_mask: bool = False) -> tuple[State, Type[IModel]]:
     """
     Create a torch model from a `computation` function defined by user
     :param computation: A function that takes a State and a list of torch.Tensor, and returns a torch.Tensor
+    :param precal_witness_path: Path to the precalculated witness. Prover writes it and verifier reads it.
+        Prover can pass None to skip writing it.
+    :param isProver: Whether the model is for the prover or the verifier.
     :param error: The error tolerance for the computation.
+    :param precal_witness: Verifier only. The precalculated witness in memory, e.g. received from the prover,
+        so that it's not read from `precal_witness_path`.
+    :param private_witness: Give the witness to the circuit as a private input after the data instead of fixed
+        constants, so that the circuit only depends on the computation and the shape of the data: one setup (pk/vk)
+        serves every dataset of the same shape. Verifier doesn't need the precalculated witness then. All other
+        parameters of the circuit, e.g. the error tolerances, stay fixed, so they're bound by the vk.
+    :param validity_mask: The model takes the validity mask of the rows (1.0 for data, 0.0 for padding) as a
+        committed input after the columns, and operations use it instead of comparing the columns with
+        `MagicNumber`. The computation still only gets the columns.
     :return: A tuple of State and Model. The Model is a torch model that can be used for exporting to onnx.
     State is a container for intermediate results of computation, which can be useful when debugging.
     """
@@ -300,19 +474,55 @@ def computation_to_model(computation: TComputation, precal_witness_path:str, isP
     
     state.precal_witness_path= precal_witness_path
     state.isProver = isProver
+    state.private_witness = private_witness
+    state.validity_mask = validity_mask
+    if precal_witness is not None:
+        if isProver:
+            raise ValueError("precal_witness is only for the verifier, prover calculates it")
+        state.precal_witness = precal_witness
 
     class Model(IModel):
         def preprocess(self, x: list[torch.Tensor]) -> None:
-            computation(state, x)
-            state.set_ready_for_exporting_onnx()
+            state.trace(computation, x)
 
         def forward(self, *x: list[torch.Tensor]) -> tuple[IsResultPrecise, torch.Tensor]:
-            # print('x sy: ')
-            result =  computation(state, x)
-            if len(result) ==1:
-                return (x[0]-x[0])[0][0]+torch.tensor(1.0), result
-            else:
-                return result
+            num_inputs = len(state.graph.input_nodes)
+            return state.run(list(x[:num_inputs]), x[num_inputs:])
+
+        def witness_inputs(self) -> list[tuple[str, torch.Tensor]]:
+            return state.witness_inputs()
+
+        def fingerprint(self) -> Optional[str]:
+            return state.fingerprint()
+
+        def private_witness(self) -> bool:
+            return state.private_witness
+
+        def validity_mask(self) -> bool:
+            return state.validity_mask
     # print('state:: ', state.aggregate_witness_path)
     return state, Model
 
+
+
+def batch_computations_to_model(computations: Sequence[TComputation], precal_witness_path: Optional[str], isProver:bool, error: float = DEFAULT_ERROR, precal_witness: Optional[PrecalWitness] = None, private_witness: bool = False, validity_mask: bool = False) -> tuple[State, Type[IModel]]:
+    """
+    Create one torch model from several computations over the same columns, so that they are proven together
+    with one proof and the data is only hashed once. Operations repeated in different computations are shared.
+
+    The results of all computations are flattened and concatenated into the output, in order. After the model
+    is traced, `State.output_sizes` holds the number of output elements of each computation, which can be given
+    to `verifier_verify` to split the results by computation.
+
+    The parameters are the same as `computation_to_model`, except `computations` is a list of computations.
+    :return: A tuple of State and Model, same as `computation_to_model`.
+    """
+    if len(computations) == 0:
+        raise ValueError("computations must not be empty")
+
+    def batch_computation(state: State, args: list[torch.Tensor]) -> torch.Tensor:
+        results = [computation(state, args).reshape(-1) for computation in computations]
+        state.output_sizes = [result.numel() for result in results]
+        return torch.cat(results)
+
+    return computation_to_model(batch_computation, precal_witness_path, isProver, error, precal_witness, private_witness, validity_mask)
@@ -1,19 +1,49 @@
 import csv
 from pathlib import Path
-from typing import Type, Sequence, Mapping, Union, Literal, Callable
+from typing import Type, Sequence, Mapping, Union, Literal, Callable, Optional
 from enum import Enum
 import os
 import numpy as np
 import json
+import tempfile
 import time
 
 import torch
 import ezkl
+import onnx
+from onnx import numpy_helper
 
-from zkstats.computation import IModel
+from zkstats.computation import IModel, MagicNumber
+from zkstats.onnx_optimizer import optimize_onnx
 
 
 
+# Sizes the number of rows is padded to, so that datasets of different sizes share circuits and keys.
+# Either "power_of_two" (pad to the next power of two) or a list of allowed sizes (pad to the smallest one that fits).
+TRowBuckets = Union[Literal["power_of_two"], Sequence[int]]
+# Name of the validity mask of the rows in the data commitments, for models with `validity_mask`. Verifiers append it
+# to the selected columns when verifying, since the mask is the last input of the circuit.
+VALIDITY_MASK_COLUMN = "validity_mask"
+
+
+def get_bucket_size(num_rows: int, row_buckets: Optional[TRowBuckets]) -> int:
+  """
+  Get the number of rows that data with `num_rows` rows is padded to.
+
+  :param num_rows: number of rows of the data
+  :param row_buckets: the buckets. No padding if None
+  :return: the padded number of rows
+  """
+  if row_buckets is None:
+    return num_rows
+  if row_buckets == "power_of_two":
+    return 1 << max(num_rows - 1, 0).bit_length()
+  fitting = [size for size in row_buckets if size >= num_rows]
+  if len(fitting) == 0:
+    raise ValueError(f"no bucket fits {num_rows} rows: {row_buckets=}")
+  return min(fitting)
+
+
 # ===================================================================================================
 # ===================================================================================================
 
@@ -24,6 +54,9 @@ def verifier_define_calculation(
   dummy_sel_data_path: str,
   verifier_model: Type[IModel],
   verifier_model_path: str,
+  onnx_cache_dir: Optional[str] = None,
+  row_buckets: Optional[TRowBuckets] = None,
+  float64: bool = False,
 ) -> None:
   """
   Export the verifier model to an ONNX file.
@@ -32,10 +65,15 @@ def verifier_define_calculation(
   :param dummy_sel_data_path: path to store generated preprocessed dummy data file
   :param verifier_model: the verifier model class
   :param verifier_model_path: path to store the generated verifier model file in onnx format
+  :param onnx_cache_dir: directory to cache the exported model in. A model exported before from the same
+      computation on data with the same shape is reused, only replacing the witness, instead of exporting again
+  :param row_buckets: pad the columns with `MagicNumber` to a bucket size. Must be the same as the prover's
+  :param float64: export the model in float64. Must be the same as the prover's
   """
-  dummy_data_tensor_array = _process_data(dummy_data_path, selected_columns, dummy_sel_data_path)
+  dummy_data_tensor_array = _process_data(dummy_data_path, selected_columns, dummy_sel_data_path, row_buckets, _has_validity_mask(verifier_model), float64)
   # export onnx file
-  _export_onnx(verifier_model, dummy_data_tensor_array, verifier_model_path)
+  private_witness = _export_onnx(verifier_model, dummy_data_tensor_array, verifier_model_path, onnx_cache_dir)
+  _append_input_data(dummy_sel_data_path, private_witness)
 
 
 # TODO: Should only need the shape of data instead of the real dataset, since
@@ -63,6 +101,40 @@ def create_dummy(data_path: str, dummy_data_path: str) -> None:
 # ===================================================================================================
 
 
+def prover_define_calculation(
+    data_path: str,
+    selected_columns: list[str],
+    sel_data_path: str,
+    prover_model: Type[IModel],
+    prover_model_path: str,
+    onnx_cache_dir: Optional[str] = None,
+    row_buckets: Optional[TRowBuckets] = None,
+    float64: bool = False,
+) -> None:
+    """
+    Export the prover model to an ONNX file and store the input data of the circuit. `prover_gen_settings` calls it,
+    but with a model using `private_witness`, it's enough to call it for new data of the same shape and reuse
+    the settings and pk generated before.
+    :param data_path: path to the data file
+    :param selected_columns: column names selected for computation
+    :param sel_data_path: path to store generated preprocessed data file, i.e. the input of the circuit
+    :param prover_model: the prover model class
+    :param prover_model_path: path to store the generated prover model file in onnx format
+    :param onnx_cache_dir: directory to cache the exported model in. A model exported before from the same
+        computation on data with the same shape is reused, only replacing the witness, instead of exporting again
+    :param row_buckets: pad the columns with `MagicNumber` to a bucket size, so that data with different numbers
+        of rows in the same bucket share the model. Must be the same as in `generate_data_commitment`
+    :param float64: calculate the witness from the data in float64 rather than float32 and export the model in
+        float64, so that the witness stays precise for large data and large values, e.g. sums over many rows.
+        The verifier must export its model with the same `float64`
+    """
+    data_tensor_array = _process_data(data_path, selected_columns, sel_data_path, row_buckets, _has_validity_mask(prover_model), float64)
+    # export onnx file
+    private_witness = _export_onnx(prover_model, data_tensor_array, prover_model_path, onnx_cache_dir)
+    # The private witness is the input of the circuit after the data
+    _append_input_data(sel_data_path, private_witness)
+
+
 def prover_gen_settings(
     data_path: str,
     selected_columns: list[str],
@@ -73,6 +145,9 @@ def prover_gen_settings(
     # TODO: should be able to hardcode mode to "resources" or make it default?
     mode: Union[Literal["resources"], Literal["accuracy"]],
     settings_path: str,
+    onnx_cache_dir: Optional[str] = None,
+    row_buckets: Optional[TRowBuckets] = None,
+    float64: bool = False,
 ):
     """
     Generate and calibrate settings for the given model and data.
@@ -84,11 +159,13 @@ def prover_gen_settings(
     :param scale: the scale to use for the computation. It's a list of integer or "default" for default scale
     :param mode: the mode to use for the computation. It's either "resources" or "accuracy"
     :param settings_path: path to store the generated settings file
+    :param onnx_cache_dir: directory to cache the exported model in. A model exported before from the same
+        computation on data with the same shape is reused, only replacing the witness, instead of exporting again
+    :param row_buckets: pad the columns with `MagicNumber` to a bucket size, so that data with different numbers
+        of rows in the same bucket share the model. Must be the same as in `generate_data_commitment`
+    :param float64: calculate the witness and export the model in float64, see `prover_define_calculation`
     """
-    data_tensor_array = _process_data(data_path, selected_columns, sel_data_path)
-
-    # export onnx file
-    _export_onnx(prover_model, data_tensor_array, prover_model_path)
+    prover_define_calculation(data_path, selected_columns, sel_data_path, prover_model, prover_model_path, onnx_cache_dir, row_buckets, float64)
     # gen + calibrate setting
     _gen_settings(sel_data_path, prover_model_path, scale, mode, settings_path)
 
@@ -209,7 +286,7 @@ TCommitmentMap = Mapping[str, str]
 # }
 TCommitmentMaps = Mapping[str, TCommitmentMap]
 
-def verifier_verify(proof_path: str, settings_path: str, vk_path: str, selected_columns: Sequence[str], data_commitment_path: str) -> torch.Tensor:
+def verifier_verify(proof_path: str, settings_path: str, vk_path: str, selected_columns: Sequence[str], data_commitment_path: str, output_sizes: Optional[Sequence[int]] = None) -> Union[list[float], list[list[float]]]:
   """
   Verify the proof and return the result.
 
@@ -218,6 +295,9 @@ def verifier_verify(proof_path: str, settings_path: str, vk_path: str, selected_
   :param vk_path: path to the verification key file
   :param expected_data_commitments: expected data commitments for columns. The i-th commitment should
     be stored in `expected_data_commitments[i]`.
+  :param output_sizes: for a batch model, `State.output_sizes` of the verifier's model. If given, the result
+    is split into a list of results, one for each computation in the batch.
+  :return: the elements of the result, or a list of them for each computation if `output_sizes` is given
   """
 
   # 1. First check the zk proof is valid
@@ -247,8 +327,9 @@ def verifier_verify(proof_path: str, settings_path: str, vk_path: str, selected_
   # 2.1 Check input commitments
   with open(data_commitment_path) as f:
     data_commitment = json.load(f)
-  # All inputs are hashed so are commitments
-  assert len_inputs == len(selected_columns), f"lengths mismatch: {len_inputs=}, {len(selected_columns)=}"
+  # All inputs are hashed so are commitments. The input after the columns is the private witness, if any, which
+  # is not checked: the circuit constrains it, and the number of inputs is fixed by the vk
+  assert len_inputs in (len(selected_columns), len(selected_columns) + 1), f"lengths mismatch: {len_inputs=}, {len(selected_columns)=}"
   # Sanity check
   # Check each commitment is correct
   for i, (actual_commitment, column_name) in enumerate(zip(inputs, selected_columns)):
@@ -267,13 +348,21 @@ def verifier_verify(proof_path: str, settings_path: str, vk_path: str, selected_
   result_arr = []
   for index in range(len(outputs)-1):
     result_arr.append(ezkl.felt_to_float(outputs[index+1], output_scales[1]))
-  return result_arr
+  if output_sizes is None:
+    return result_arr
+  assert sum(output_sizes) == len(result_arr), f"lengths mismatch: {sum(output_sizes)=}, {len(result_arr)=}"
+  results = []
+  start = 0
+  for size in output_sizes:
+    results.append(result_arr[start:start+size])
+    start += size
+  return results
 
 
 # ===================================================================================================
 # ===================================================================================================
 
-def generate_data_commitment(data_path: str, scales: Sequence[int], data_commitment_path: str) -> None:
+def generate_data_commitment(data_path: str, scales: Sequence[int], data_commitment_path: str, row_buckets: Optional[TRowBuckets] = None, validity_mask: bool = False) -> None:
   """
   Generate and store data commitment maps for different scales so that verifiers can verify
   proofs with different scales.
@@ -281,6 +370,10 @@ def generate_data_commitment(data_path: str, scales: Sequence[int], data_commitm
   :param data_path: data file path. The format must be anything defined in `DataExtension`
   :param scales: a list of scales to use for the commitments
   :param data_commitment_path: path to store the generated data commitment maps
+  :param row_buckets: commit to the columns padded to a bucket size, as given to the circuit by
+    `prover_gen_settings` with the same `row_buckets`
+  :param validity_mask: also commit to the validity mask of the rows as `VALIDITY_MASK_COLUMN`, for models
+    with `validity_mask`
   """
 
   # Convert `data_path` to json file `data_json_path`
@@ -292,9 +385,13 @@ def generate_data_commitment(data_path: str, scales: Sequence[int], data_commitm
     data_json = json.load(f)
   data_commitments = {
     str(scale): {
-      k: _get_commitment_for_column(v, scale) for k, v in data_json.items()
+      k: _get_commitment_for_column(_pad_column(v, row_buckets), scale) for k, v in data_json.items()
     } for scale in scales
   }
+  if validity_mask:
+    num_rows = len(next(iter(data_json.values())))
+    for scale in scales:
+      data_commitments[str(scale)][VALIDITY_MASK_COLUMN] = _get_commitment_for_column(_validity_mask(num_rows, row_buckets), scale)
   with open(data_commitment_path, "w") as f:
     json.dump(data_commitments, f)
 
@@ -303,13 +400,39 @@ def generate_data_commitment(data_path: str, scales: Sequence[int], data_commitm
 # Private functions
 # ===================================================================================================
 
-def _export_onnx(model: Type[IModel], data_tensor_array: list[torch.Tensor], model_loc: str) -> None:
+def _export_onnx(model: Type[IModel], data_tensor_array: list[torch.Tensor], model_loc: str, onnx_cache_dir: Optional[str] = None) -> list[tuple[str, torch.Tensor]]:
+  """
+  Export the model to onnx.
+
+  :return: names and values of the private witness, the inputs of the exported model after the data
+  """
   circuit = model()
   try:
     circuit.preprocess(data_tensor_array)
   except AttributeError:
     pass
 
+  witness = circuit.witness_inputs() if isinstance(circuit, IModel) else []
+  private_witness = isinstance(circuit, IModel) and circuit.private_witness()
+  cached_model_path = None
+  if onnx_cache_dir is not None and isinstance(circuit, IModel):
+    fingerprint = circuit.fingerprint()
+    if fingerprint is not None:
+      cached_model_path = Path(onnx_cache_dir) / f"{fingerprint}.onnx"
+      if cached_model_path.exists():
+        print("==== Use cached onnx ====")
+        print(cached_model_path)
+        onnx_model = onnx.load(cached_model_path)
+        if not private_witness:
+          _set_witness_constants(onnx_model, witness)
+        onnx.save(onnx_model, model_loc)
+        return witness if private_witness else []
+  # The witness is given as graph inputs when exporting only if the model is reused for another witness, and then
+  # replaced with constants, or stays an input for a private witness. It's not folded into other constants that
+  # way, so the graph is larger, but the graph doesn't depend on the values of the witness.
+  if cached_model_path is None and not private_witness:
+    witness = []
+
   device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
   # print(device)
@@ -328,6 +451,9 @@ def _export_onnx(model: Type[IModel], data_tensor_array: list[torch.Tensor], mod
     input_names.append(input_index)
   #   dynamic_axes[input_index] = {0 : 'batch_size'}
   # dynamic_axes["output"] = {0 : 'batch_size'}
+  for name, value in witness:
+    data_tensor_tuple += (value,)
+    input_names.append(name)
 
   # Export the model
   torch.onnx.export(circuit,               # model being run
@@ -340,6 +466,73 @@ def _export_onnx(model: Type[IModel], data_tensor_array: list[torch.Tensor], mod
                       output_names = ['output'], # the model's output names
                       # dynamic_axes=dynamic_axes
                       )
+  # Remove redundant nodes before generating settings. Prover and verifier both run it, so their models stay the same.
+  # The witness is still graph inputs here, so nothing depending on its values is removed.
+  print("==== Optimize onnx ====")
+  print(optimize_onnx(model_loc))
+
+  onnx_model = onnx.load(model_loc)
+  if not private_witness:
+    _witness_inputs_to_constants(onnx_model, witness)
+    onnx.save(onnx_model, model_loc)
+  if cached_model_path is not None:
+    cached_model_path.parent.mkdir(parents=True, exist_ok=True)
+    # Written to a temporary file first, so a concurrent or interrupted export never leaves a partial model
+    fd, tmp_path = tempfile.mkstemp(suffix=".onnx", dir=cached_model_path.parent)
+    os.close(fd)
+    try:
+      onnx.save(onnx_model, tmp_path)
+      os.replace(tmp_path, cached_model_path)
+    except BaseException:
+      os.remove(tmp_path)
+      raise
+  return witness if private_witness else []
+
+
+def _append_input_data(sel_data_path: str, inputs: Sequence[tuple[str, torch.Tensor]]) -> None:
+  if len(inputs) == 0:
+    return
+  with open(sel_data_path) as f:
+    input_data = json.load(f)
+  input_data["input_data"].extend(value.detach().reshape(-1).tolist() for _, value in inputs)
+  with open(sel_data_path, "w") as f:
+    json.dump(input_data, f)
+
+
+def _witness_inputs_to_constants(onnx_model: onnx.ModelProto, witness: Sequence[tuple[str, torch.Tensor]]) -> None:
+  # One constant node for each use of the witness, as torch exports constants. ezkl quantizes a constant with
+  # a scale depending on where it's used, so constants shared between nodes can make the circuit unsatisfiable.
+  values = {name: value.detach().cpu().numpy() for name, value in witness}
+  graph = onnx_model.graph
+  inputs = [graph_input for graph_input in graph.input if graph_input.name not in values]
+  del graph.input[:]
+  graph.input.extend(inputs)
+  nodes = []
+  num_uses = {name: 0 for name in values}
+  for node in graph.node:
+    for i, name in enumerate(node.input):
+      if name in values:
+        constant_name = f"{name}.{num_uses[name]}"
+        num_uses[name] += 1
+        nodes.append(onnx.helper.make_node("Constant", [], [constant_name], name=constant_name, value=numpy_helper.from_array(values[name])))
+        node.input[i] = constant_name
+    nodes.append(node)
+  del graph.node[:]
+  graph.node.extend(nodes)
+
+
+def _set_witness_constants(onnx_model: onnx.ModelProto, witness: Sequence[tuple[str, torch.Tensor]]) -> None:
+  values = {name: value.detach().cpu().numpy() for name, value in witness}
+  for node in onnx_model.graph.node:
+    if node.op_type != "Constant" or len(node.output) != 1:
+      continue
+    name = node.output[0].rsplit(".", 1)[0]
+    if name not in values:
+      continue
+    tensor = node.attribute[0].t
+    if tuple(tensor.dims) != values[name].shape:
+      raise Exception(f"witness {name} shape mismatch: {tuple(tensor.dims)=} != {values[name].shape=}")
+    tensor.CopyFrom(numpy_helper.from_array(values[name]))
 
 
 # mode is either "accuracy" or "resources"
@@ -355,7 +548,8 @@ def _gen_settings(
   # Set input to be Poseidon Hash, and param of computation graph to be public
   # Poseidon is not homomorphic additive, maybe consider Pedersens or Dory commitment.
   gip_run_args = ezkl.PyRunArgs()
-  gip_run_args.input_visibility = "hashed"  # one commitment (values hashed) for each column
+  # one commitment (values hashed) for each column, and for the private witness if any, which isn't checked
+  gip_run_args.input_visibility = "hashed"
   gip_run_args.param_visibility = "fixed"  # no parameters shown
   gip_run_args.output_visibility = "public"  # should be `(torch.Tensor(1.0), output)`
 
@@ -425,7 +619,11 @@ def _process_data(
     data_path: Union[str | Path],
     col_array: list[str],
     sel_data_path: list[str],
+    row_buckets: Optional[TRowBuckets] = None,
+    validity_mask: bool = False,
+    float64: bool = False,
   ) -> list[torch.Tensor]:
+    dtype = torch.float64 if float64 else torch.float32
     data_tensor_array=[]
     sel_data = []
     data_path: Path = Path(data_path)
@@ -435,16 +633,34 @@ def _process_data(
     data_onefile = json.loads(open(data_json_path, "r").read())
 
     for col in col_array:
-      data = data_onefile[col]
-      data_tensor = torch.tensor(data, dtype = torch.float32)
+      data = _pad_column(data_onefile[col], row_buckets)
+      data_tensor = torch.tensor(data, dtype = dtype)
       data_tensor_array.append(torch.reshape(data_tensor, (-1,1)))
       sel_data.append(data)
+    if validity_mask:
+      # The last input, after the columns
+      mask = _validity_mask(len(data_onefile[col_array[0]]), row_buckets)
+      data_tensor_array.append(torch.tensor(mask, dtype = dtype).reshape(-1, 1))
+      sel_data.append(mask)
     # Serialize data into file:
     # sel_data comes from `data`
     json.dump(dict(input_data = sel_data), open(sel_data_path, 'w'))
     return data_tensor_array
 
 
+def _pad_column(column: list[float], row_buckets: Optional[TRowBuckets]) -> list[float]:
+  # Padded rows are filtered out by all operations, like rows filtered out with `State.where`
+  return column + [MagicNumber] * (get_bucket_size(len(column), row_buckets) - len(column))
+
+
+def _validity_mask(num_rows: int, row_buckets: Optional[TRowBuckets]) -> list[float]:
+  return [1.0] * num_rows + [0.0] * (get_bucket_size(num_rows, row_buckets) - num_rows)
+
+
+def _has_validity_mask(model: Type[IModel]) -> bool:
+  return issubclass(model, IModel) and model().validity_mask()
+
+
 def _get_commitment_for_column(column: list[float], scale: int) -> str:
   # Ref: https://github.com/zkonduit/ezkl/discussions/633
   # serialized_data = [ezkl.float_to_vecu64(x, scale) for x in column]
@@ -0,0 +1,245 @@
+import math
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+import torch
+from torch.overrides import TorchFunctionMode
+
+from .computation import TComputation, computation_to_model, DEFAULT_ERROR
+from .ops import Moments
+
+
+# Scale assumed when estimating lookup ranges. Same as the scale used in tests.
+DEFAULT_EXPLAIN_SCALE = 7
+# Range of the random values used as dummy data, i.e. "medium" values in the benchmark
+DEFAULT_VALUE_RANGE = (1.0, 100.0)
+# Seed of the dummy data, so that the same query always gets the same estimate
+DEFAULT_EXPLAIN_SEED = 0
+# ezkl lays out elementwise operations in `num_inner_cols` columns (2 in all benchmark settings)
+NUM_INNER_COLS = 2
+# From benchmark/readme.md: the best logrows is the lowest one such that ceil(lookup_range/2^logrows) <= 5
+MAX_LOOKUP_COLUMNS = 5
+
+# Calibration data from benchmark/result/*.ipynb
+# `num_rows` of the settings for one hashed column with n rows. Rows are dominated by poseidon hashing
+# of the inputs, so they are the same for every operation in the benchmark.
+BENCHMARK_HASH_ROWS: dict[int, int] = {
+    50: 3936,
+    100: 6560,
+    300: 14432,
+    600: 26240,
+    1000: 45920,
+}
+# Median proving time in seconds for each logrows over all benchmarked operations.
+BENCHMARK_PROVING_TIME: dict[int, float] = {
+    12: 0.87,
+    13: 1.53,
+    14: 2.82,
+    15: 5.57,
+    16: 10.28,
+    17: 51.95,
+    18: 61.43,
+    19: 171.22,
+    20: 282.36,
+}
+
+# torch function names (as seen by `__torch_function__`) grouped by how ezkl lays them out.
+# Comparisons are range-checked with lookups.
+COMPARISON_FUNCS = {
+    "eq", "ne", "lt", "le", "gt", "ge", "greater", "greater_equal", "less", "less_equal", "not_equal",
+    "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__",
+}
+DIVISION_FUNCS = {
+    "div", "divide", "true_divide", "floor_divide", "reciprocal", "remainder", "fmod",
+    "__truediv__", "__rtruediv__", "__floordiv__", "__rfloordiv__", "__mod__",
+}
+LOG_FUNCS = {"log", "log2", "log10", "log1p"}
+# Other non-linear functions, each element needs a lookup
+OTHER_LOOKUP_FUNCS = {
+    "abs", "__abs__", "sqrt", "rsqrt", "exp", "floor", "ceil", "round", "sign",
+    "min", "max", "amin", "amax", "clamp", "sigmoid", "topk", "sort",
+}
+LOOKUP_FUNCS = COMPARISON_FUNCS | DIVISION_FUNCS | LOG_FUNCS | OTHER_LOOKUP_FUNCS
+
+
+@dataclass
+class OpCost:
+    """
+    Estimated cost of the constraints of one operation.
+    """
+    op: str
+    # number of tensor operations, which is roughly the number of nodes in the exported onnx graph
+    onnx_nodes: int = 0
+    # number of elementwise comparisons
+    comparisons: int = 0
+    # number of elements going through a lookup table, including comparisons, divisions and logs
+    lookups: int = 0
+    # number of elementwise divisions
+    divisions: int = 0
+    # number of elementwise logarithms
+    logs: int = 0
+    # number of cells assigned in the circuit
+    assignments: int = 0
+    # the largest absolute value looked up. Determines the lookup range
+    max_lookup_input: float = 0.0
+    # estimated circuit rows, logrows and proving time of a circuit only containing this operation
+    rows: int = 0
+    logrows: int = 0
+    proving_time: float = 0.0
+
+
+@dataclass
+class CostEstimate:
+    """
+    Estimated cost of the circuit of a computation, before exporting it to onnx.
+    """
+    num_rows: int
+    num_columns: int
+    scale: int
+    ops: list[OpCost] = field(default_factory=list)
+    onnx_nodes: int = 0
+    comparisons: int = 0
+    lookups: int = 0
+    divisions: int = 0
+    logs: int = 0
+    rows: int = 0
+    logrows: int = 0
+    proving_time: float = 0.0
+
+    def __str__(self) -> str:
+        header = ("op", "nodes", "comparisons", "lookups", "divisions", "logs", "rows", "logrows", "time(s)")
+        lines = [
+            (op.op, op.onnx_nodes, op.comparisons, op.lookups, op.divisions, op.logs, op.rows, op.logrows, f"{op.proving_time:.2f}")
+            for op in self.ops
+        ]
+        lines.append(("total", self.onnx_nodes, self.comparisons, self.lookups, self.divisions, self.logs, self.rows, self.logrows, f"{self.proving_time:.2f}"))
+        widths = [max(len(str(row[i])) for row in [header, *lines]) for i in range(len(header))]
+        return "\n".join(
+            [f"data shape: {self.num_rows} rows x {self.num_columns} columns, scale: {self.scale}"] +
+            ["  ".join(str(value).ljust(width) for value, width in zip(row, widths)) for row in [header, *lines]]
+        )
+
+
+class _CostCounter(TorchFunctionMode):
+    """
+    Count the tensor operations executed while the mode is active.
+    """
+    def __init__(self, cost: OpCost):
+        super().__init__()
+        self.cost = cost
+
+    def __torch_function__(self, func: Callable, types, args=(), kwargs=None) -> Any:
+        kwargs = kwargs or {}
+        res = func(*args, **kwargs)
+        # Only operations producing tensors are nodes in the graph. Skip `size()`, `__bool__`, etc.
+        outputs = [t for t in (res if isinstance(res, (tuple, list)) else [res]) if isinstance(t, torch.Tensor)]
+        if len(outputs) == 0:
+            return res
+        name = getattr(func, "__name__", "")
+        inputs = [t for t in (*args, *kwargs.values()) if isinstance(t, torch.Tensor)]
+        numel = max(t.numel() for t in outputs)
+        self.cost.onnx_nodes += 1
+        self.cost.assignments += max([numel, *[t.numel() for t in inputs]])
+        if name in LOOKUP_FUNCS:
+            self.cost.lookups += numel
+            if name in COMPARISON_FUNCS:
+                self.cost.comparisons += numel
+            elif name in DIVISION_FUNCS:
+                self.cost.divisions += numel
+            elif name in LOG_FUNCS:
+                self.cost.logs += numel
+            for t in inputs:
+                finite = t.detach()[torch.isfinite(t.detach())] if t.is_floating_point() else t.detach()
+                if finite.numel() > 0:
+                    self.cost.max_lookup_input = max(self.cost.max_lookup_input, float(finite.abs().max()))
+        return res
+
+
+def explain(
+    computation: TComputation,
+    data_shape: tuple[int, int],
+    error: float = DEFAULT_ERROR,
+    scale: int = DEFAULT_EXPLAIN_SCALE,
+    value_range: tuple[float, float] = DEFAULT_VALUE_RANGE,
+    seed: int = DEFAULT_EXPLAIN_SEED,
+) -> CostEstimate:
+    """
+    Estimate the cost of proving `computation` without exporting it to onnx, calibrating or running setup.
+    The computation is run on random dummy data and the constraints of every operation recorded by `State`
+    are counted. Rows, logrows and proving time are calibrated from the benchmark in `benchmark/result`.
+
+    :param computation: the computation to estimate
+    :param data_shape: a tuple (number of rows, number of columns) of the data
+    :param error: the error tolerance for the computation
+    :param scale: the scale expected to encode the data
+    :param value_range: the range of the dummy values. Lookup ranges grow with the magnitude of the data
+    :param seed: the seed of the dummy data. The estimate is the same for the same computation, shape and seed
+    :return: cost estimate for each operation and for the whole computation
+    """
+    num_rows, num_columns = data_shape
+    low, high = value_range
+    generator = torch.Generator().manual_seed(seed)
+    data = [torch.rand(num_rows, 1, generator=generator) * (high - low) + low for _ in range(num_columns)]
+
+    # Trace the computation as when exporting, then count the constraints of each recorded operation
+    state, model_type = computation_to_model(computation, None, True, error)
+    model = model_type()
+    model.preprocess(data)
+
+    hash_rows = num_columns * _hash_rows(num_rows)
+    estimate = CostEstimate(num_rows=num_rows, num_columns=num_columns, scale=scale)
+    max_lookup_input = 0.0
+    # Count the statistics shared between operations once, for the first operation using them
+    moments = Moments(error)
+    for node in state.graph.operation_nodes:
+        op = state.ops[node.op_index]
+        cost = OpCost(op=type(op).__name__)
+        args = [state.graph.value(ref) for ref in node.args]
+        with torch.no_grad(), _CostCounter(cost):
+            op.ezkl(args, moments)
+        cost.rows = hash_rows + math.ceil(cost.assignments / NUM_INNER_COLS)
+        cost.logrows = _logrows(cost.rows, cost.max_lookup_input, scale)
+        cost.proving_time = _proving_time(cost.logrows)
+        estimate.ops.append(cost)
+        estimate.onnx_nodes += cost.onnx_nodes
+        estimate.comparisons += cost.comparisons
+        estimate.lookups += cost.lookups
+        estimate.divisions += cost.divisions
+        estimate.logs += cost.logs
+        estimate.rows += cost.rows - hash_rows
+        max_lookup_input = max(max_lookup_input, cost.max_lookup_input)
+    estimate.rows += hash_rows
+    estimate.logrows = _logrows(estimate.rows, max_lookup_input, scale)
+    estimate.proving_time = _proving_time(estimate.logrows)
+    return estimate
+
+
+def _hash_rows(num_rows: int) -> int:
+    # Interpolate linearly between benchmarked sizes and extrapolate with the slope of the nearest segment
+    sizes = sorted(BENCHMARK_HASH_ROWS)
+    if num_rows <= sizes[0]:
+        lower, upper = sizes[0], sizes[1]
+    elif num_rows >= sizes[-1]:
+        lower, upper = sizes[-2], sizes[-1]
+    else:
+        upper = next(size for size in sizes if size >= num_rows)
+        lower = sizes[sizes.index(upper) - 1]
+    slope = (BENCHMARK_HASH_ROWS[upper] - BENCHMARK_HASH_ROWS[lower]) / (upper - lower)
+    return max(1, round(BENCHMARK_HASH_ROWS[lower] + slope * (num_rows - lower)))
+
+
+def _logrows(rows: int, max_lookup_input: float, scale: int) -> int:
+    lookup_range = 2 * max_lookup_input * 2**scale
+    logrows_for_rows = math.ceil(math.log2(rows))
+    logrows_for_lookups = math.ceil(math.log2(max(lookup_range / MAX_LOOKUP_COLUMNS, 1)))
+    return max(logrows_for_rows, logrows_for_lookups)
+
+
+def _proving_time(logrows: int) -> float:
+    # Proving time roughly doubles with each logrows outside the benchmarked range
+    min_logrows, max_logrows = min(BENCHMARK_PROVING_TIME), max(BENCHMARK_PROVING_TIME)
+    if logrows < min_logrows:
+        return BENCHMARK_PROVING_TIME[min_logrows] / 2**(min_logrows - logrows)
+    if logrows > max_logrows:
+        return BENCHMARK_PROVING_TIME[max_logrows] * 2**(logrows - max_logrows)
+    return BENCHMARK_PROVING_TIME[logrows]
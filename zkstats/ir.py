@@ -0,0 +1,247 @@
+import hashlib
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Iterator, Optional, Sequence
+
+import torch
+from torch.overrides import TorchFunctionMode
+
+
+class NodeKind(Enum):
+    # an input column of the computation
+    INPUT = "input"
+    # a tensor created outside of the computation, e.g. a global tensor
+    CONSTANT = "constant"
+    # a torch function or tensor method called by the computation
+    CALL = "call"
+    # a statistical operation called through `State`, e.g. `State.mean`
+    OPERATION = "operation"
+    # `State.where`: elements not selected by the mask are filtered out
+    WHERE = "where"
+
+
+@dataclass(frozen=True)
+class Ref:
+    """
+    Reference to a tensor in a `Graph`.
+    """
+    index: int
+
+
+@dataclass
+class Node:
+    """
+    A node in a `Graph`. Tensors in `args` and `kwargs` are replaced with `Ref`s.
+    """
+    kind: NodeKind
+    outputs: tuple[Ref, ...]
+    args: tuple = ()
+    kwargs: dict[str, Any] = field(default_factory=dict)
+    # CALL: the function called
+    func: Optional[Callable] = None
+    # INPUT: the index of the input column
+    input_index: Optional[int] = None
+    # CONSTANT: the value of the tensor
+    value: Optional[torch.Tensor] = None
+    # OPERATION: the index of the operation in `State.ops`
+    op_index: Optional[int] = None
+
+
+# Calls not returning tensors, e.g. `x.size()`, are not recorded, except these since they change their inputs
+_IN_PLACE_FUNCS = {"__setitem__", "__iadd__", "__isub__", "__imul__", "__itruediv__"}
+
+
+class Graph:
+    """
+    Intermediate representation of a computation, traced by running it once with `Graph.trace`. It holds the input
+    columns, the torch calls, `State` operations and `where` masks in the order they are called, and the dataflow
+    between them. Replaying it with `Graph.run` gives the same result as running the computation again, so the
+    computation doesn't have to be run when exporting.
+    """
+    def __init__(self) -> None:
+        self.nodes: list[Node] = []
+        self.output: Any = None
+        # Values of the tensors when tracing, indexed by `Ref.index`. Keeping them also keeps their ids unique.
+        self.values: list[torch.Tensor] = []
+        self._refs: dict[int, Ref] = {}
+        self._recording = False
+
+    @property
+    def input_nodes(self) -> list[Node]:
+        return [node for node in self.nodes if node.kind == NodeKind.INPUT]
+
+    @property
+    def operation_nodes(self) -> list[Node]:
+        return [node for node in self.nodes if node.kind == NodeKind.OPERATION]
+
+    def trace(self, computation: Callable[[list[torch.Tensor]], Any], inputs: Sequence[torch.Tensor]) -> Any:
+        """
+        Run `computation` on `inputs` and record it in the graph.
+
+        :return: the result of the computation
+        """
+        if len(self.nodes) != 0:
+            raise Exception("graph is already traced")
+        inputs = list(inputs)
+        for i, x in enumerate(inputs):
+            self.add_node(NodeKind.INPUT, [x], input_index=i)
+        self._recording = True
+        try:
+            with _Tracer(self):
+                result = computation(inputs)
+        finally:
+            self._recording = False
+        self.output = _map_tensors(result, self.ref)
+        return result
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """
+        Don't record torch calls in this context, e.g. when calculating the witness of an operation.
+        """
+        recording = self._recording
+        self._recording = False
+        try:
+            yield
+        finally:
+            self._recording = recording
+
+    @property
+    def recording(self) -> bool:
+        return self._recording
+
+    def ref(self, tensor: torch.Tensor) -> Ref:
+        """
+        Get the reference to a traced tensor. Tensors not traced are added as constants.
+        """
+        if id(tensor) not in self._refs:
+            self.add_node(NodeKind.CONSTANT, [tensor], value=tensor.detach().clone())
+        return self._refs[id(tensor)]
+
+    def value(self, ref: Ref) -> torch.Tensor:
+        """
+        Get the value of a tensor when tracing.
+        """
+        return self.values[ref.index]
+
+    def add_node(self, kind: NodeKind, outputs: Sequence[torch.Tensor], args: tuple = (), kwargs: Optional[dict[str, Any]] = None, **attributes: Any) -> Node:
+        """
+        Add a node. Tensors in `args` and `kwargs` must be traced already or are added as constants.
+        """
+        args = _map_tensors(args, self.ref)
+        kwargs = _map_tensors(kwargs or {}, self.ref)
+        refs = []
+        for tensor in outputs:
+            ref = Ref(len(self.values))
+            self.values.append(tensor)
+            self._refs[id(tensor)] = ref
+            refs.append(ref)
+        node = Node(kind, tuple(refs), args, kwargs, **attributes)
+        self.nodes.append(node)
+        return node
+
+    def fingerprint(self) -> str:
+        """
+        Hash of the structure of the graph: the nodes, the functions called, the non-tensor arguments, the values
+        of the constants and the shapes of all tensors. Graphs traced from the same computation on data with the
+        same shapes have the same fingerprint, whatever the values of the data are.
+        """
+        h = hashlib.sha256()
+        def update(value: Any) -> None:
+            h.update(repr(value).encode())
+        for node in self.nodes:
+            update((node.kind.value, node.input_index, node.op_index))
+            update([(tuple(self.values[ref.index].shape), str(self.values[ref.index].dtype)) for ref in node.outputs])
+            if node.func is not None:
+                update((getattr(node.func, "__module__", None), getattr(node.func, "__qualname__", repr(node.func))))
+            update(node.args)
+            update(sorted(node.kwargs.items()))
+            if node.value is not None:
+                h.update(node.value.detach().cpu().contiguous().numpy().tobytes())
+        update(self.output)
+        return h.hexdigest()
+
+    def run(
+        self,
+        inputs: Sequence[torch.Tensor],
+        call_operation: Callable[[Node, list[torch.Tensor]], torch.Tensor],
+        call_where: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+    ) -> Any:
+        """
+        Replay the graph on `inputs`.
+
+        :param call_operation: calculate the output of an OPERATION node from its input tensors
+        :param call_where: calculate the output of a WHERE node from its mask and input tensor
+        :return: the result of the computation
+        """
+        env: dict[Ref, torch.Tensor] = {}
+        def resolve(value: Any) -> Any:
+            return _map_refs(value, lambda ref: env[ref])
+        for node in self.nodes:
+            if node.kind == NodeKind.INPUT:
+                outputs = [inputs[node.input_index]]
+            elif node.kind == NodeKind.CONSTANT:
+                outputs = [node.value]
+            elif node.kind == NodeKind.CALL:
+                outputs = _flatten_tensors(node.func(*resolve(node.args), **resolve(node.kwargs)))
+            elif node.kind == NodeKind.OPERATION:
+                outputs = [call_operation(node, resolve(list(node.args)))]
+            elif node.kind == NodeKind.WHERE:
+                outputs = [call_where(*resolve(node.args))]
+            else:
+                raise Exception(f"unknown node kind: {node.kind}")
+            if len(outputs) != len(node.outputs):
+                raise Exception(f"output length mismatch: {node=}, {len(outputs)=}")
+            for ref, output in zip(node.outputs, outputs):
+                env[ref] = output
+        return resolve(self.output)
+
+
+class _Tracer(TorchFunctionMode):
+    """
+    Record the torch calls in the graph while it's recording.
+    """
+    def __init__(self, graph: Graph):
+        super().__init__()
+        self.graph = graph
+
+    def __torch_function__(self, func: Callable, types, args=(), kwargs=None) -> Any:
+        kwargs = kwargs or {}
+        res = func(*args, **kwargs)
+        if not self.graph.recording:
+            return res
+        outputs = _flatten_tensors(res)
+        name = getattr(func, "__name__", "")
+        if len(outputs) > 0 or name in _IN_PLACE_FUNCS:
+            self.graph.add_node(NodeKind.CALL, outputs, args, kwargs, func=func)
+        return res
+
+
+def _map_tensors(value: Any, fn: Callable[[torch.Tensor], Any]) -> Any:
+    if isinstance(value, torch.Tensor):
+        return fn(value)
+    if isinstance(value, (list, tuple)) and not hasattr(value, "_fields"):
+        return type(value)(_map_tensors(v, fn) for v in value)
+    if isinstance(value, dict):
+        return {k: _map_tensors(v, fn) for k, v in value.items()}
+    return value
+
+
+def _map_refs(value: Any, fn: Callable[[Ref], Any]) -> Any:
+    if isinstance(value, Ref):
+        return fn(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_map_refs(v, fn) for v in value)
+    if isinstance(value, dict):
+        return {k: _map_refs(v, fn) for k, v in value.items()}
+    return value
+
+
+def _flatten_tensors(value: Any) -> list[torch.Tensor]:
+    # Flatten the tensors in the result of a call, including named tuples like the result of `torch.max(x, dim)`
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [t for v in value for t in _flatten_tensors(v)]
+    return []
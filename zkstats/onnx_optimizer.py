@@ -0,0 +1,249 @@
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper
+
+
+# Operations that must not be merged even if their inputs and attributes are the same
+NON_DETERMINISTIC_OPS = {"RandomNormal", "RandomNormalLike", "RandomUniform", "RandomUniformLike", "Multinomial", "Bernoulli"}
+# Operations broadcasting their inputs elementwise, so the rank of the output is the largest rank of the inputs
+ELEMENTWISE_OPS = {
+    "Add", "Sub", "Mul", "Div", "Where", "Equal", "Greater", "GreaterOrEqual", "Less", "LessOrEqual",
+    "Not", "And", "Or", "Abs", "Neg",
+}
+
+
+@dataclass
+class OnnxOptimizationReport:
+    """
+    Number of nodes in the onnx graph before and after the optimization.
+    """
+    nodes_before: int
+    nodes_after: int
+    op_counts_before: dict[str, int] = field(default_factory=dict)
+    op_counts_after: dict[str, int] = field(default_factory=dict)
+
+    def __str__(self) -> str:
+        lines = [f"onnx nodes: {self.nodes_before} -> {self.nodes_after}"]
+        for op_type in sorted(self.op_counts_before):
+            before = self.op_counts_before[op_type]
+            after = self.op_counts_after.get(op_type, 0)
+            if before != after:
+                lines.append(f"  {op_type}: {before} -> {after}")
+        return "\n".join(lines)
+
+
+def optimize_onnx(model_path: str, optimized_model_path: Optional[str] = None) -> OnnxOptimizationReport:
+    """
+    Optimize the onnx model in `model_path` with `optimize_graph`.
+
+    :param model_path: path to the onnx model
+    :param optimized_model_path: path to store the optimized model. Overwrites `model_path` if None
+    :return: node counts before and after the optimization
+    """
+    model = onnx.load(model_path)
+    report = optimize_graph(model.graph)
+    onnx.save(model, optimized_model_path if optimized_model_path is not None else model_path)
+    return report
+
+
+def optimize_graph(graph: onnx.GraphProto) -> OnnxOptimizationReport:
+    """
+    Remove redundant nodes from `graph` in place. Every node becomes constraints in the circuit, so fewer nodes
+    means fewer rows. The computed outputs are not changed:
+    - identity arithmetic, e.g. adding a scalar 0, multiplying by a scalar 1 or `And` with a scalar true, is removed.
+      Scalars computed as `Sub(a, a)` indexed with `Gather`, e.g. `(x[0]-x[0])[0][0]` connecting a result to the
+      inputs, count as a scalar 0
+    - duplicate nodes, i.e. the same operation on the same inputs or constants with the same value, e.g. repeated
+      `x==MagicNumber` comparisons, are merged into one
+    - `Where` masks are folded: `Where(Not(c), a, b)` becomes `Where(c, b, a)`, and a `Where` nested in a branch
+      of another `Where` with the same condition is replaced with its branch
+    - nodes not contributing to the graph outputs are removed. Identity arithmetic producing a graph output is
+      replaced with `Identity` instead
+
+    :param graph: the onnx graph to optimize
+    :return: node counts before and after the optimization
+    """
+    op_counts_before = Counter(node.op_type for node in graph.node)
+    nodes_before = len(graph.node)
+
+    graph_outputs = {output.name for output in graph.output}
+    constants = {initializer.name: numpy_helper.to_array(initializer) for initializer in graph.initializer}
+    # tensor name -> the name of the tensor it's replaced with
+    replaced: dict[str, str] = {}
+    # tensor name -> the node producing it
+    producers: dict[str, onnx.NodeProto] = {}
+    # node key -> outputs of the first node with the key
+    seen: dict[tuple, list[str]] = {}
+    # constant name -> its value, to compare inputs by value rather than by name
+    constant_keys: dict[str, bytes] = {}
+    # tensor name -> its rank (None if unknown), for tensors known to be all zeros
+    zeros: dict[str, Optional[int]] = {}
+    ranks = {
+        graph_input.name: len(graph_input.type.tensor_type.shape.dim)
+        for graph_input in graph.input if graph_input.type.tensor_type.HasField("shape")
+    }
+    nodes: list[onnx.NodeProto] = []
+
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            node.input[i] = replaced.get(name, name)
+        if node.op_type == "Where":
+            _fold_where(node, producers)
+        _track_zeros(node, zeros, ranks, constants)
+        # Don't remove nodes producing the graph outputs, since the output names must be kept
+        removable = not any(output in graph_outputs for output in node.output)
+        if removable:
+            kept_input = _identity_input(node, constants, zeros)
+            if kept_input is not None:
+                replaced[node.output[0]] = kept_input
+                continue
+            key = _node_key(node, constant_keys)
+            if key is not None and key in seen:
+                for output, seen_output in zip(node.output, seen[key]):
+                    replaced[output] = seen_output
+                continue
+            if key is not None:
+                seen[key] = list(node.output)
+        elif node.op_type != "Identity":
+            # Keep the output name, but drop the inputs the identity arithmetic depends on
+            kept_input = _identity_input(node, constants, zeros)
+            if kept_input is not None:
+                node = helper.make_node("Identity", [kept_input], list(node.output), name=node.name)
+        if node.op_type == "Constant" and len(node.attribute) == 1 and node.attribute[0].name == "value":
+            constants[node.output[0]] = numpy_helper.to_array(node.attribute[0].t)
+            constant_keys[node.output[0]] = _attribute_bytes(node.attribute[0])
+        for output in node.output:
+            producers[output] = node
+        nodes.append(node)
+
+    nodes = _remove_dead_nodes(nodes, graph_outputs)
+    used = {name for node in nodes for name in node.input} | graph_outputs
+    initializers = [initializer for initializer in graph.initializer if initializer.name in used]
+    tensors = used | {output for node in nodes for output in node.output}
+    value_info = [info for info in graph.value_info if info.name in tensors]
+
+    del graph.node[:]
+    graph.node.extend(nodes)
+    del graph.initializer[:]
+    graph.initializer.extend(initializers)
+    del graph.value_info[:]
+    graph.value_info.extend(value_info)
+
+    return OnnxOptimizationReport(
+        nodes_before=nodes_before,
+        nodes_after=len(graph.node),
+        op_counts_before=dict(op_counts_before),
+        op_counts_after=dict(Counter(node.op_type for node in graph.node)),
+    )
+
+
+def _node_key(node: onnx.NodeProto, constant_keys: dict[str, bytes]) -> Optional[tuple]:
+    # Constants are not merged, since ezkl quantizes each constant with a scale depending on where it's used.
+    # Nodes using constants with the same values are merged instead.
+    if node.op_type == "Constant" or node.op_type in NON_DETERMINISTIC_OPS:
+        return None
+    # Subgraphs can refer to outer tensors which are not in the inputs
+    if any(attribute.type in (onnx.AttributeProto.GRAPH, onnx.AttributeProto.GRAPHS) for attribute in node.attribute):
+        return None
+    attributes = tuple(sorted((attribute.name, _attribute_bytes(attribute)) for attribute in node.attribute))
+    inputs = tuple(("constant", constant_keys[name]) if name in constant_keys else name for name in node.input)
+    return (node.domain, node.op_type, inputs, attributes, len(node.output))
+
+
+def _attribute_bytes(attribute: onnx.AttributeProto) -> bytes:
+    if attribute.type != onnx.AttributeProto.TENSOR:
+        return attribute.SerializeToString()
+    # The name of a constant tensor doesn't change its value
+    tensor = onnx.TensorProto()
+    tensor.CopyFrom(attribute.t)
+    tensor.name = ""
+    return tensor.SerializeToString()
+
+
+def _is_scalar(constants: dict[str, np.ndarray], name: str, value: float) -> bool:
+    # Only scalars (rank 0) broadcast to any shape without changing it
+    return name in constants and constants[name].ndim == 0 and bool(constants[name] == value)
+
+
+def _is_zero_scalar(constants: dict[str, np.ndarray], zeros: dict[str, Optional[int]], name: str) -> bool:
+    return _is_scalar(constants, name, 0) or zeros.get(name, None) == 0
+
+
+def _track_zeros(node: onnx.NodeProto, zeros: dict[str, Optional[int]], ranks: dict[str, int], constants: dict[str, np.ndarray]) -> None:
+    if node.domain not in ("", "ai.onnx") or len(node.output) != 1:
+        return
+    if node.op_type in ELEMENTWISE_OPS:
+        input_ranks = [constants[name].ndim if name in constants else ranks.get(name) for name in node.input]
+        if None not in input_ranks:
+            ranks[node.output[0]] = max(input_ranks)
+    if node.op_type == "Reshape" and node.input[1] in constants:
+        ranks[node.output[0]] = constants[node.input[1]].size
+    elif node.op_type == "Sub" and len(node.input) == 2 and node.input[0] == node.input[1]:
+        # a - a == 0 for the field elements in the circuit
+        zeros[node.output[0]] = ranks.get(node.input[0])
+    elif node.op_type == "Gather" and node.input[0] in zeros and node.input[1] in constants:
+        rank = zeros[node.input[0]]
+        zeros[node.output[0]] = None if rank is None else rank + constants[node.input[1]].ndim - 1
+
+
+def _identity_input(node: onnx.NodeProto, constants: dict[str, np.ndarray], zeros: dict[str, Optional[int]]) -> Optional[str]:
+    """
+    If `node` outputs one of its inputs unchanged, return the name of that input.
+    """
+    if node.domain not in ("", "ai.onnx") or len(node.output) != 1:
+        return None
+    inputs = list(node.input)
+    if node.op_type == "Identity":
+        return inputs[0]
+    if len(inputs) != 2:
+        return None
+    a, b = inputs
+    if node.op_type == "Add":
+        if _is_zero_scalar(constants, zeros, b):
+            return a
+        if _is_zero_scalar(constants, zeros, a):
+            return b
+    elif node.op_type == "Sub":
+        if _is_zero_scalar(constants, zeros, b):
+            return a
+    elif node.op_type == "Mul":
+        if _is_scalar(constants, b, 1):
+            return a
+        if _is_scalar(constants, a, 1):
+            return b
+    elif node.op_type == "Div":
+        if _is_scalar(constants, b, 1):
+            return a
+    elif node.op_type == "And":
+        if _is_scalar(constants, b, True):
+            return a
+        if _is_scalar(constants, a, True):
+            return b
+    return None
+
+
+def _fold_where(node: onnx.NodeProto, producers: dict[str, onnx.NodeProto]) -> None:
+    condition, x, y = node.input
+    # Where(Not(c), x, y) == Where(c, y, x)
+    while condition in producers and producers[condition].op_type == "Not":
+        condition, x, y = producers[condition].input[0], y, x
+    # Where(c, Where(c, a, b), y) == Where(c, a, y), and Where(c, x, Where(c, a, b)) == Where(c, x, b)
+    while x in producers and producers[x].op_type == "Where" and producers[x].input[0] == condition:
+        x = producers[x].input[1]
+    while y in producers and producers[y].op_type == "Where" and producers[y].input[0] == condition:
+        y = producers[y].input[2]
+    node.input[0], node.input[1], node.input[2] = condition, x, y
+
+
+def _remove_dead_nodes(nodes: list[onnx.NodeProto], graph_outputs: set[str]) -> list[onnx.NodeProto]:
+    needed = set(graph_outputs)
+    alive = []
+    for node in reversed(nodes):
+        if any(output in needed for output in node.output):
+            alive.append(node)
+            needed.update(node.input)
+    return list(reversed(alive))
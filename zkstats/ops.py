@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod, abstractclassmethod
+from fractions import Fraction
 import statistics
-from typing import Optional
+from typing import ClassVar, Iterator, Optional, Sequence
 
 import numpy as np
 import torch
@@ -8,47 +9,282 @@ import torch
 # boolean: either 1.0 or 0.0
 IsResultPrecise = torch.Tensor
 MagicNumber = 99.999
+# Validity masks of the columns an operation is created from: nonzero for the elements not filtered out. Columns
+# with no mask, or all columns if None, are compared with `MagicNumber` instead.
+TMasks = Optional[Sequence[Optional[torch.Tensor]]]
+
+
+class Moments:
+    """
+    Sufficient statistics of the columns, computed once in the circuit and shared by the constraints of all
+    operations: the validity mask, the count and the sum of each column, its deviations from the mean and their
+    sum of squares, and the sum of the cross products of deviations for each pair of columns. Columns are
+    identified by the tensor object, the same way `State` identifies repeated operations.
+
+    Elements filtered out are excluded by multiplying with the validity mask, so each column is compared with
+    `MagicNumber` at most once, or never if its mask is given with `set_mask`. A column filtered with `filter`
+    is a view of the column it's filtered from: operations read the values of that column with `values` and
+    exclude the elements filtered out with the mask, so the filtered column is not materialized in the circuit.
+
+    Order statistics are read from the column sorted once in the circuit, which constrains the sort: elements
+    filtered out are replaced with a value less than all others, so they come first and the element of rank k
+    among the others is at index `n - count + k`.
+
+    Deviations are taken from the mean witness of the first operation asking for a column, and that mean
+    is constrained here once. Mean witnesses of later operations are only checked against it. Deviations are used
+    rather than raw sums of squares since fixed point `sum(x*x) - n*mean*mean` loses too much precision at small
+    scales.
+    """
+    def __init__(self, error: float):
+        self.error = error
+        # Keep the columns alive so that their ids are not reused by other tensors
+        self._columns: dict[int, torch.Tensor] = {}
+        self._mask: dict[int, torch.Tensor] = {}
+        # id of a filtered column -> the column it's filtered from
+        self._source: dict[int, torch.Tensor] = {}
+        # (id of the filter, id of the mask of the column filtered) -> mask of the filtered column
+        self._filter_masks: dict[tuple[int, int], torch.Tensor] = {}
+        self._count: dict[int, torch.Tensor] = {}
+        self._sum: dict[int, torch.Tensor] = {}
+        # id -> (filler, filled column)
+        self._filled: dict[int, tuple[torch.Tensor, torch.Tensor]] = {}
+        self._sorted: dict[int, torch.Tensor] = {}
+        # id -> (mean, mean constraint, deviations)
+        self._centered: dict[int, tuple[torch.Tensor, IsResultPrecise, torch.Tensor]] = {}
+        self._sum_sq: dict[int, torch.Tensor] = {}
+        self._cross: dict[tuple[int, int], torch.Tensor] = {}
+
+    def _key(self, x: torch.Tensor) -> int:
+        self._columns[id(x)] = x
+        return id(x)
+
+    def set_mask(self, x: torch.Tensor, mask: torch.Tensor) -> None:
+        """
+        Give the validity mask of `x`, e.g. the mask input of the circuit or the filter of `State.where`, so that
+        it's not derived from `MagicNumber`.
+
+        :param mask: 1.0 for the elements of `x` that are not filtered out, 0.0 otherwise. Same shape as `x`
+        """
+        self._mask[self._key(x)] = mask
+
+    def mask(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Validity mask of `x`: 1.0 for the elements that are not filtered out, 0.0 otherwise.
+        """
+        key = self._key(x)
+        if key not in self._mask:
+            self._mask[key] = torch.where(x!=MagicNumber, 1.0, 0.0)
+        return self._mask[key]
+
+    def filter(self, _filter: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+        """
+        Filter `x` as `State.where` does. The mask of the result is shared by all columns with the same mask
+        filtered by the same `_filter`, and its values are read from `x`.
+
+        :param _filter: A boolean tensor, True for the elements kept
+        :return: `x` with the elements filtered out replaced with `MagicNumber`
+        """
+        result = torch.where(_filter, x, x-x+MagicNumber)
+        mask = self.mask(x)
+        key = (self._key(_filter), self._key(mask))
+        if key not in self._filter_masks:
+            self._filter_masks[key] = torch.where(_filter, mask, torch.tensor(0.0, dtype=mask.dtype))
+        self.set_mask(result, self._filter_masks[key])
+        self._source[self._key(result)] = self.values(x)
+        return result
+
+    def values(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Tensor with the same elements as `x` where they are not filtered out: the column `x` is filtered from, if
+        any. Elements filtered out must be excluded with the mask of `x`.
+        """
+        return self._source.get(id(x), x)
+
+    def count(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Number of elements in `x` that are not filtered out.
+        """
+        key = self._key(x)
+        if key not in self._count:
+            self._count[key] = torch.sum(self.mask(x))
+        return self._count[key]
+
+    def sum(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Sum of the elements in `x` that are not filtered out.
+        """
+        key = self._key(x)
+        if key not in self._sum:
+            self._sum[key] = torch.sum(self.values(x)*self.mask(x))
+        return self._sum[key]
+
+    def _get_filled(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        key = self._key(x)
+        if key not in self._filled:
+            mask = self.mask(x)
+            values = self.values(x)
+            filler = torch.min(values)-1
+            self._filled[key] = (filler, values*mask+filler*(1-mask))
+        return self._filled[key]
+
+    def filler(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Value less than all elements of `x`, replacing the elements filtered out in `filled` and `sorted`.
+        """
+        return self._get_filled(x)[0]
+
+    def filled(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        `x` with the elements filtered out replaced with `filler`.
+        """
+        return self._get_filled(x)[1]
+
+    def sorted(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Elements of `filled` in ascending order, as a 1d tensor. The sort is constrained by the circuit.
+        """
+        key = self._key(x)
+        if key not in self._sorted:
+            filled = self.filled(x).reshape(-1)
+            self._sorted[key] = torch.topk(filled, filled.size()[0], largest=False).values
+        return self._sorted[key]
+
+    def order_statistic(self, x: torch.Tensor, rank: torch.Tensor) -> torch.Tensor:
+        """
+        Elements of `x` with the ranks `rank` in ascending order among the elements not filtered out, read from
+        `sorted` with one lookup for all ranks.
+
+        :param rank: 0-based ranks less than the count of `x`, a scalar or a 1d tensor
+        :return: the elements, with the same shape as `rank`
+        """
+        sorted_x = self.sorted(x)
+        index = sorted_x.size()[0]-self.count(x)+rank
+        return torch.gather(sorted_x, 0, index.reshape(-1).long()).reshape(rank.shape)
+
+    def _get_centered(self, x: torch.Tensor, mean: torch.Tensor) -> tuple[torch.Tensor, IsResultPrecise, torch.Tensor]:
+        key = self._key(x)
+        if key not in self._centered:
+            size = self.count(x)
+            mean_cons = torch.abs(self.sum(x)-size*mean)<=torch.abs(self.error*mean*size)
+            deviations = (self.values(x)-mean)*self.mask(x)
+            self._centered[key] = (mean, mean_cons, deviations)
+        return self._centered[key]
+
+    def mean_constraint(self, x: torch.Tensor, mean: torch.Tensor) -> IsResultPrecise:
+        """
+        Whether the mean of `x` that deviations are taken from is precise.
+
+        :param mean: the mean witness, used if `x` has no mean yet. Otherwise it's constrained to agree with the
+            mean deviations are taken from, so that no operation carries an unchecked mean witness
+        """
+        shared_mean, mean_cons, _ = self._get_centered(x, mean)
+        if mean is shared_mean:
+            return mean_cons
+        return torch.logical_and(mean_cons, torch.abs(mean-shared_mean)<=torch.abs(self.error*shared_mean))
+
+    def deviations(self, x: torch.Tensor, mean: torch.Tensor) -> torch.Tensor:
+        """
+        Deviations of the elements of `x` from its mean, 0 for elements filtered out.
+
+        :param mean: the mean witness, used if `x` has no mean yet
+        """
+        return self._get_centered(x, mean)[2]
+
+    def sum_sq(self, x: torch.Tensor, mean: torch.Tensor) -> torch.Tensor:
+        """
+        Sum of squared deviations of `x` from its mean.
+
+        :param mean: the mean witness, used if `x` has no mean yet
+        """
+        key = self._key(x)
+        if key not in self._sum_sq:
+            deviations = self.deviations(x, mean)
+            self._sum_sq[key] = torch.sum(deviations*deviations)
+        return self._sum_sq[key]
+
+    def cross(self, x: torch.Tensor, x_mean: torch.Tensor, y: torch.Tensor, y_mean: torch.Tensor) -> torch.Tensor:
+        """
+        Sum of the products of deviations of `x` and `y` from their means.
+
+        :param x_mean: the mean witness of `x`, used if `x` has no mean yet
+        :param y_mean: the mean witness of `y`, used if `y` has no mean yet
+        """
+        key = (self._key(x), self._key(y))
+        if (key[1], key[0]) in self._cross:
+            return self._cross[(key[1], key[0])]
+        if key not in self._cross:
+            self._cross[key] = torch.sum(self.deviations(x, x_mean)*self.deviations(y, y_mean))
+        return self._cross[key]
 
 
 class Operation(ABC):
+    # Identifies the operation type in the precalculated witness file. Never reuse or change an id.
+    witness_type_id: ClassVar[int]
+    # Attributes calculated by the prover in `create` and given to the verifier through `from_witness`.
+    witness_fields: ClassVar[tuple[str, ...]] = ("result",)
+
     def __init__(self, result: torch.Tensor, error: float):
         self.result = torch.nn.Parameter(data=result, requires_grad=False)
         self.error = error
 
     @abstractclassmethod
-    def create(cls, x: list[torch.Tensor], error: float) -> 'Operation':
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'Operation':
+        """
+        Create the operation with the witness calculated from the data `x`.
+
+        :param masks: validity masks of `x`, the same as the circuit uses, e.g. the validity mask input of the model
+        """
         ...
 
+    @classmethod
+    def from_witness(cls, witness: Sequence[torch.Tensor], error: float) -> 'Operation':
+        """
+        Create the operation from the precalculated witness, without the data.
+
+        :param witness: values of `witness_fields`, in the same order
+        :param error: the error tolerance
+        """
+        if len(witness) != len(cls.witness_fields):
+            raise Exception(f"witness length mismatch: {len(witness)=} != {len(cls.witness_fields)=}")
+        op = cls.__new__(cls)
+        op.error = error
+        for name, value in zip(cls.witness_fields, witness):
+            setattr(op, name, torch.nn.Parameter(data=value, requires_grad=False))
+        return op
+
+    def get_witness(self) -> tuple[torch.Tensor, ...]:
+        """
+        Get the values of `witness_fields`, in the same order.
+        """
+        return tuple(getattr(self, name).data for name in self.witness_fields)
+
     @abstractmethod
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        """
+        Constraints that the witness is precise for the data `x`.
+
+        :param moments: statistics of the columns shared with other operations. A new one is used if None.
+        """
         ...
 
 
 
 class Mean(Operation):
+    witness_type_id = 0
+
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float, precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None ) -> 'Mean':
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'Mean':
         # support where statement, hopefully we can use 'nan' once onnx.isnan() is supported
-        if precal_witness is None:
-            # this is prover
-            # print('provvv')
-            return cls(torch.mean(x[0][x[0]!=MagicNumber]), error)
-        else:
-            # this is verifier
-            # print('verrrr')
-            if op_dict is None:
-                return cls(torch.tensor(precal_witness['Mean_0'][0]), error)
-            elif 'Mean' not in op_dict:
-                return cls(torch.tensor(precal_witness['Mean_0'][0]), error)
-            else:
-                return cls(torch.tensor(precal_witness['Mean_'+str(op_dict['Mean'])][0]), error)
+        moments = RunningMoments.of([x[0]], masks=_column_masks(masks, 1))
+        if moments.count < 1:
+            raise statistics.StatisticsError("mean requires at least one data point")
+        return cls(moments.mean_witness(), error)
 
-
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         x = x[0]
-        size = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        x = torch.where(x==MagicNumber, 0.0, x)
-        return torch.abs(torch.sum(x)-size*self.result)<=torch.abs(self.error*self.result*size)
+        size = moments.count(x)
+        return torch.abs(moments.sum(x)-size*self.result)<=torch.abs(self.error*self.result*size)
 
 
 def to_1d(x: torch.Tensor) -> torch.Tensor:
@@ -62,114 +298,364 @@ def to_1d(x: torch.Tensor) -> torch.Tensor:
         raise Exception(f"Unsupported shape: {x_shape=}")
 
 
+def valid(x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Whether the elements of `x` are not filtered out: where `mask` is nonzero if given, otherwise where `x` is
+    not `MagicNumber`.
+    """
+    if mask is None:
+        return x!=MagicNumber
+    return mask.reshape(x.shape)!=0
+
+
+def _column_masks(masks: TMasks, num_columns: int) -> list[Optional[torch.Tensor]]:
+    return [None]*num_columns if masks is None else list(masks)
+
+
+# Elements of a column the prover reads at once when calculating the witness
+CHUNK_SIZE = 1 << 20
+
+
+def valid_chunks(columns: Sequence[torch.Tensor], chunk_size: Optional[int] = None, masks: TMasks = None) -> Iterator[list[np.ndarray]]:
+    """
+    Elements of the columns not filtered out, chunk by chunk: the same rows of every column, as float64 arrays.
+    Only one chunk of each column is copied at a time, so the witness can be calculated from columns larger than
+    memory, e.g. memory-mapped with `torch.from_numpy(np.load(path, mmap_mode="c"))`.
+
+    :param chunk_size: rows in a chunk. `CHUNK_SIZE` if None
+    :param masks: validity masks of the columns, see `valid`
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    columns_1d = [x.reshape(-1) for x in columns]
+    masks_1d = [None if mask is None else mask.reshape(-1) for mask in _column_masks(masks, len(columns))]
+    num_rows = max(len(x_1d) for x_1d in columns_1d)
+    for start in range(0, num_rows, chunk_size):
+        chunks = []
+        for x_1d, mask_1d in zip(columns_1d, masks_1d):
+            chunk = x_1d[start:start+chunk_size]
+            chunk_mask = None if mask_1d is None else mask_1d[start:start+chunk_size]
+            chunks.append(chunk[valid(chunk, chunk_mask)].to(torch.float64).numpy())
+        yield chunks
+
+
+def _valid_rows(columns: Sequence[torch.Tensor], chunk_size: Optional[int] = None, masks: TMasks = None) -> Iterator[list[np.ndarray]]:
+    # `valid_chunks` of columns filtered the same way
+    for chunks in valid_chunks(columns, chunk_size, masks):
+        if any(len(chunk) != len(chunks[0]) for chunk in chunks):
+            raise statistics.StatisticsError("the columns must have the same number of data points")
+        yield chunks
+
+
+class RunningMoments:
+    """
+    Count, means and co-moments, i.e. the sums of the products of deviations from the means, of columns, calculated
+    by the prover chunk by chunk in float64. Each chunk is centered on its own mean and merged with Chan's parallel
+    update of Welford's algorithm, so the rounding error doesn't grow with the number of rows like running sums of
+    squares do. All operations take the mean of a column from here, so operations on the same column have the same
+    mean witness. Mean witnesses have the dtype of the columns.
+    """
+    def __init__(self, num_columns: int, dtype: torch.dtype = torch.float32):
+        self.dtype = dtype
+        self.count = 0
+        self.mean = np.zeros(num_columns)
+        self.comoments = np.zeros((num_columns, num_columns))
+
+    @classmethod
+    def of(cls, columns: Sequence[torch.Tensor], chunk_size: Optional[int] = None, masks: TMasks = None) -> 'RunningMoments':
+        """
+        Moments of the elements of `columns` not filtered out. The columns must be filtered the same way.
+
+        :param masks: validity masks of the columns, see `valid`
+        """
+        moments = cls(len(columns), columns[0].dtype)
+        for chunks in _valid_rows(columns, chunk_size, masks):
+            moments.update(chunks)
+        return moments
+
+    def update(self, chunks: Sequence[np.ndarray]) -> None:
+        """
+        Add the same rows of every column.
+
+        :param chunks: the rows of each column, 1d arrays of the same length
+        """
+        count = len(chunks[0])
+        if count == 0:
+            return
+        # Means of the 1d columns rather than of the rows, so that the mean of a column doesn't depend on the others
+        mean = np.array([np.mean(chunk) for chunk in chunks])
+        centered = np.column_stack(chunks)-mean
+        delta = mean-self.mean
+        total = self.count+count
+        self.comoments += centered.T@centered+np.outer(delta, delta)*(self.count*count/total)
+        self.mean += delta*(count/total)
+        self.count = total
+
+    def mean_witness(self, column: int = 0) -> torch.Tensor:
+        return torch.tensor(self.mean[column], dtype=self.dtype)
+
+
+def order_statistics_f64(x: torch.Tensor, ranks: Sequence[int], chunk_size: Optional[int] = None, mask: Optional[torch.Tensor] = None) -> list[float]:
+    """
+    Elements of the column `x` with the 0-based `ranks` in ascending order among the elements not filtered out,
+    selected without sorting the column: each pass over the chunks counts the elements in bins of the range that
+    holds a rank and narrows the range to the bin holding it, until the elements in the range fit in a chunk and
+    are sorted.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    num_bins = 1024
+    # Range of all elements: the elements within [lo, hi) are the candidates, and `below` elements are less than lo
+    count, lo, high = 0, np.inf, -np.inf
+    for (chunk,) in valid_chunks([x], chunk_size, [mask]):
+        if len(chunk) > 0:
+            count, lo, high = count+len(chunk), min(lo, chunk.min()), max(high, chunk.max())
+    if any(not 0 <= rank < count for rank in ranks):
+        raise ValueError(f"ranks must be less than the number of data points: {ranks=}, {count=}")
+    results = []
+    for rank in ranks:
+        candidates_lo, candidates_hi, num_candidates, below = lo, np.nextafter(high, np.inf), count, 0
+        while num_candidates > chunk_size and np.nextafter(candidates_lo, np.inf) < candidates_hi:
+            edges = np.linspace(candidates_lo, candidates_hi, num_bins+1)
+            edges[-1] = candidates_hi
+            counts = np.zeros(num_bins, dtype=np.int64)
+            for (chunk,) in valid_chunks([x], chunk_size, [mask]):
+                candidates = chunk[(chunk>=candidates_lo)&(chunk<candidates_hi)]
+                counts += np.bincount(np.searchsorted(edges, candidates, side="right")-1, minlength=num_bins)
+            cumulative = np.cumsum(counts)
+            selected = int(np.searchsorted(cumulative, rank-below, side="right"))
+            below += int(cumulative[selected-1]) if selected > 0 else 0
+            num_candidates = int(counts[selected])
+            candidates_lo, candidates_hi = edges[selected], edges[selected+1]
+        if num_candidates > chunk_size:
+            # The range can't be narrowed anymore, so all candidates are equal
+            results.append(float(candidates_lo))
+            continue
+        candidates = np.concatenate([
+            chunk[(chunk>=candidates_lo)&(chunk<candidates_hi)] for (chunk,) in valid_chunks([x], chunk_size, [mask])
+        ])
+        results.append(float(np.sort(candidates)[rank-below]))
+    return results
+
+
+def least_squares_f64(xs: Sequence[torch.Tensor], y: torch.Tensor, chunk_size: Optional[int] = None, masks: TMasks = None) -> np.ndarray:
+    """
+    Ordinary least squares fit of `y` on the columns `xs` and an intercept, calculated by the prover chunk by chunk
+    from the R factor of the QR decomposition of the rows [xs, 1, y]: decomposing R stacked on the next chunk gives
+    the R of all rows so far, so only R and one chunk are in memory. Solving with R is as stable as
+    `np.linalg.lstsq` on all rows, unlike the normal equations when the regressors are correlated.
+
+    :param masks: validity masks of `xs` and `y`, see `valid`
+    :return: the slopes of the regressors in order, then the intercept
+    """
+    num_coefficients = len(xs)+1
+    r = np.zeros((0, num_coefficients+1))
+    for chunks in _valid_rows([*xs, y], chunk_size, masks):
+        rows = np.column_stack((*chunks[:-1], np.ones(len(chunks[0])), chunks[-1]))
+        r = np.linalg.qr(np.vstack((r, rows)), mode="r")
+    return np.linalg.lstsq(r[:num_coefficients, :num_coefficients], r[:num_coefficients, -1], rcond=None)[0]
+
+
 class Median(Operation):
-    def __init__(self, x: torch.Tensor, error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None ):
-        if precal_witness is None:
+    witness_type_id = 1
+    witness_fields = ("result", "lower", "upper")
+
+    def __init__(self, x: torch.Tensor, error: float, mask: Optional[torch.Tensor] = None):
         # NOTE: To ensure `lower` and `upper` are a scalar, `x` must be a 1d array.
         # Otherwise, if `x` is a 3d array, `lower` and `upper` will be 2d array, which are not what
         # we want in our context. However, we tend to have x as a `[1, len(x), 1]`. In this case,
         # we need to flatten `x` to 1d array to get the correct `lower` and `upper`.
-            x_1d = to_1d(x)
-            x_1d = x_1d[x_1d!=MagicNumber]
-            super().__init__(torch.tensor(np.median(x_1d)), error)
-            sorted_x = np.sort(x_1d)
-            len_x = len(x_1d)
-            self.lower = torch.nn.Parameter(data = torch.tensor(sorted_x[int(len_x/2)-1], dtype = torch.float32), requires_grad=False)
-            self.upper = torch.nn.Parameter(data = torch.tensor(sorted_x[int(len_x/2)], dtype = torch.float32), requires_grad=False)
-        else:
-            if op_dict is None:
-                super().__init__(torch.tensor(precal_witness['Median_0'][0]), error)
-                self.lower = torch.nn.Parameter(data = torch.tensor(precal_witness['Median_0'][1]), requires_grad=False)
-                self.upper = torch.nn.Parameter(data = torch.tensor(precal_witness['Median_0'][2]), requires_grad=False)             
-            elif 'Median' not in op_dict:
-                super().__init__(torch.tensor(precal_witness['Median_0'][0]), error)
-                self.lower = torch.nn.Parameter(data = torch.tensor(precal_witness['Median_0'][1]), requires_grad=False)
-                self.upper = torch.nn.Parameter(data = torch.tensor(precal_witness['Median_0'][2]), requires_grad=False)
-            else:
-                super().__init__(torch.tensor(precal_witness['Median_'+str(op_dict['Median'])][0]), error)
-                self.lower = torch.nn.Parameter(data = torch.tensor(precal_witness['Median_'+str(op_dict['Median'])][1]), requires_grad=False)
-                self.upper = torch.nn.Parameter(data = torch.tensor(precal_witness['Median_'+str(op_dict['Median'])][2]), requires_grad=False)
-
+        x_1d = to_1d(x)
+        len_x = sum(len(chunk) for (chunk,) in valid_chunks([x_1d], masks=[mask]))
+        if len_x < 1:
+            raise statistics.StatisticsError("no median for empty data")
+        # The middle elements, the same one if the length is odd
+        lower, upper = order_statistics_f64(x_1d, [(len_x-1)//2, len_x//2], mask=mask)
+        super().__init__(torch.tensor((lower+upper)/2, dtype=x.dtype), error)
+        self.lower = torch.nn.Parameter(data = torch.tensor(lower, dtype = x.dtype), requires_grad=False)
+        self.upper = torch.nn.Parameter(data = torch.tensor(upper, dtype = x.dtype), requires_grad=False)
 
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None ) -> 'Median':
-        return cls(x[0],error, precal_witness, op_dict)
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'Median':
+        return cls(x[0], error, _column_masks(masks, 1)[0])
 
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         x = x[0]
-        old_size = x.size()[0]
-        size = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        min_x = torch.min(x)
-        x = torch.where(x==MagicNumber,min_x-1, x)
-
-        # since within 1%, we regard as same value
-        count_less = torch.sum(torch.where(x < self.result, 1.0, 0.0))-(old_size-size)
-        count_equal = torch.sum(torch.where(x==self.result, 1.0, 0.0))
-        half_size = torch.floor(torch.div(size, 2))
-        # print('hhhh: ', half_size)
-        less_cons = count_less<half_size+size%2
-        more_cons = count_less+count_equal>half_size
-
-        # For count_equal == 0
-        lower_exist = torch.sum(torch.where(x==self.lower, 1.0, 0.0))>0
-        lower_cons = torch.sum(torch.where(x>self.lower, 1.0, 0.0))==half_size
-        upper_exist = torch.sum(torch.where(x==self.upper, 1.0, 0.0))>0
-        upper_cons = torch.sum(torch.where(x<self.upper, 1.0, 0.0))==half_size
-        bound = count_less== half_size
+        size = moments.count(x)
+        lower_cons = moments.order_statistic(x, torch.floor(torch.div(size-1, 2)))==self.lower
+        upper_cons = moments.order_statistic(x, torch.floor(torch.div(size, 2)))==self.upper
         # 0.02 since 2*0.01
         bound_avg = (torch.abs(self.lower+self.upper-2*self.result)<=torch.abs(2*self.error*self.result))
+        return torch.logical_and(torch.logical_and(lower_cons, upper_cons), bound_avg)
+
+
+class Quantiles(Operation):
+    """
+    Quantiles at the probabilities `qs`, interpolated linearly between the order statistics like `numpy.quantile`,
+    or `statistics.quantiles` with `method="inclusive"` for evenly spaced probabilities. All quantiles are read from
+    the sorted column with one lookup, so each one only adds a few constraints.
+    """
+    witness_type_id = 13
+    witness_fields = ("result", "ranks")
+
+    def __init__(self, x: torch.Tensor, error: float, qs: Sequence[float], mask: Optional[torch.Tensor] = None):
+        if len(qs) == 0 or any(not 0 <= q <= 1 for q in qs):
+            raise ValueError(f"qs must be probabilities between 0 and 1: {qs=}")
+        self.qs = tuple(qs)
+        x_1d = to_1d(x)
+        x_1d = x_1d[valid(x_1d, mask)]
+        if len(x_1d) < 1:
+            raise statistics.StatisticsError("quantiles require at least one data point")
+        sorted_x = torch.sort(x_1d).values.to(torch.float64)
+        # (len_x-1)*q = rank + remainder/denominator, with q = numerator/denominator
+        len_x = len(x_1d)
+        fractions = self._fractions()
+        ranks = [(len_x-1)*f.numerator//f.denominator for f in fractions]
+        remainders = [(len_x-1)*f.numerator-rank*f.denominator for f, rank in zip(fractions, ranks)]
+        result = [
+            sorted_x[rank]+(sorted_x[min(rank+1, len_x-1)]-sorted_x[rank])*remainder/f.denominator
+            for f, rank, remainder in zip(fractions, ranks, remainders)
+        ]
+        super().__init__(torch.stack(result).to(x.dtype), error)
+        self.ranks = torch.nn.Parameter(data=torch.tensor(ranks, dtype=x.dtype), requires_grad=False)
+
+    def _fractions(self) -> list[Fraction]:
+        # Integers rather than probabilities in the circuit, since a probability like 0.1 isn't precise as a
+        # constant at the scale of the circuit
+        return [Fraction(q).limit_denominator(1000) for q in self.qs]
+
+    @classmethod
+    def create(cls, x: list[torch.Tensor], error: float, qs: Sequence[float], masks: TMasks = None) -> 'Quantiles':
+        return cls(x[0], error, qs, _column_masks(masks, 1)[0])
+
+    @classmethod
+    def from_witness(cls, witness: Sequence[torch.Tensor], error: float, qs: Sequence[float]) -> 'Quantiles':
+        op = super().from_witness(witness, error)
+        op.qs = tuple(qs)
+        return op
+
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
+        x = x[0]
+        size = moments.count(x)
+        fractions = self._fractions()
+        numerators = torch.tensor([f.numerator for f in fractions], dtype=self.result.dtype)
+        denominators = torch.tensor([f.denominator for f in fractions], dtype=self.result.dtype)
+        # The ranks are the integer parts of (size-1)*q
+        remainders = (size-1)*numerators-self.ranks*denominators
+        ranks_cons = torch.sum(torch.logical_and(remainders>=0, remainders<denominators).float())==len(fractions)
+        lower = moments.order_statistic(x, self.ranks)
+        upper = moments.order_statistic(x, self.ranks+torch.where(remainders>0, 1.0, 0.0))
+        interpolated = denominators*lower+(upper-lower)*remainders
+        bound = torch.abs(self.error*denominators*self.result)
+        # Compared on both sides rather than with `torch.abs`, which ezkl can't evaluate on the data
+        result_cons = torch.logical_and(denominators*self.result-interpolated<=bound, interpolated-denominators*self.result<=bound)
+        return torch.logical_and(ranks_cons, torch.sum(result_cons.float())==len(fractions))
+
+
+class Histogram(Operation):
+    """
+    Number of elements in each bin between consecutive `edges`, like `numpy.histogram`: a bin includes its lower edge,
+    and the last bin its upper edge too. Elements outside the edges are not counted. Each edge is located once in
+    the sorted column, by the rank of the first element not below it, so the counts only add a few constraints per
+    bin on top of the sort, which is shared with the other order statistics of the column.
+    """
+    witness_type_id = 18
+    witness_fields = ("result", "ranks")
+
+    def __init__(self, x: torch.Tensor, error: float, edges: Sequence[float], mask: Optional[torch.Tensor] = None):
+        if len(edges) < 2 or any(lower >= upper for lower, upper in zip(edges, edges[1:])):
+            raise ValueError(f"edges must be increasing, with at least 2 edges: {edges=}")
+        self.edges = tuple(edges)
+        x_1d = to_1d(x)
+        x_1d = x_1d[valid(x_1d, mask)]
+        sorted_x = torch.sort(x_1d).values
+        edges_1d = torch.tensor(self.edges, dtype=x.dtype)
+        # ranks[i] is the number of elements less than edges[i], or not greater than the last edge
+        ranks = torch.cat((
+            torch.searchsorted(sorted_x, edges_1d[:-1]),
+            torch.searchsorted(sorted_x, edges_1d[-1:], right=True),
+        )).to(x.dtype)
+        super().__init__(ranks[1:]-ranks[:-1], error)
+        self.ranks = torch.nn.Parameter(data=ranks, requires_grad=False)
+
+    @classmethod
+    def create(cls, x: list[torch.Tensor], error: float, edges: Sequence[float], masks: TMasks = None) -> 'Histogram':
+        return cls(x[0], error, edges, _column_masks(masks, 1)[0])
+
+    @classmethod
+    def from_witness(cls, witness: Sequence[torch.Tensor], error: float, edges: Sequence[float]) -> 'Histogram':
+        op = super().from_witness(witness, error)
+        op.edges = tuple(edges)
+        return op
 
-        median_in_cons = torch.logical_and(less_cons, more_cons)
-        median_out_cons = torch.logical_and(torch.logical_and(bound, bound_avg), torch.logical_and(torch.logical_and(lower_cons, upper_cons), torch.logical_and(lower_exist, upper_exist)))
-        return torch.where(count_equal==0.0, median_out_cons, median_in_cons)
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
+        x = x[0]
+        size = moments.count(x)
+        sorted_x = moments.sorted(x)
+        num_edges = len(self.edges)
+        edges = torch.tensor(self.edges, dtype=self.ranks.dtype)
+        # The element before the rank of an edge is below the edge and the element at the rank isn't, unless the
+        # rank is the first or past the last element. Both are read with one lookup each for all edges
+        index = (sorted_x.size()[0]-size+self.ranks).long()
+        before = torch.gather(torch.cat((sorted_x[:1], sorted_x)), 0, index)
+        at = torch.gather(torch.cat((sorted_x, sorted_x[-1:])), 0, index)
+        first = self.ranks==0
+        last = self.ranks==size
+        # The last edge is included in the last bin
+        lower_cons = torch.logical_and(
+            torch.logical_or(first[:-1], before[:-1]<edges[:-1]),
+            torch.logical_or(last[:-1], at[:-1]>=edges[:-1]),
+        )
+        upper_cons = torch.logical_and(
+            torch.logical_or(first[-1], before[-1]<=edges[-1]),
+            torch.logical_or(last[-1], at[-1]>edges[-1]),
+        )
+        ranks_cons = torch.sum(torch.where(torch.logical_and(self.ranks>=0, self.ranks<=size), 1.0, 0.0))==num_edges
+        counts_cons = torch.sum(torch.where(self.result==self.ranks[1:]-self.ranks[:-1], 1.0, 0.0))==num_edges-1
+        return torch.logical_and(
+            torch.logical_and(torch.sum(torch.where(lower_cons, 1.0, 0.0))==num_edges-1, upper_cons),
+            torch.logical_and(ranks_cons, counts_cons),
+        )
 
 
 class GeometricMean(Operation):
+    witness_type_id = 2
+
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'GeometricMean':
-        if precal_witness is None:
-            x_1d = to_1d(x[0])
-            x_1d = x_1d[x_1d!=MagicNumber]
-            result = torch.exp(torch.mean(torch.log(x_1d)))
-            return cls(result, error)
-        else:
-            if op_dict is None:
-                return cls(torch.tensor(precal_witness['GeometricMean_0'][0]), error)
-            elif 'GeometricMean' not in op_dict:
-                return cls(torch.tensor(precal_witness['GeometricMean_0'][0]), error)
-            else:
-                return cls(torch.tensor(precal_witness['GeometricMean_'+str(op_dict['GeometricMean'])][0]), error)
-
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'GeometricMean':
+        x_1d = to_1d(x[0])
+        x_1d = x_1d[valid(x_1d, _column_masks(masks, 1)[0])]
+        result = torch.exp(torch.mean(torch.log(x_1d)))
+        return cls(result, error)
+
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         # Assume x is [n, 1]
         x = x[0]
-        size = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        x = torch.where(x==MagicNumber, 1.0, x)
-        return torch.abs((torch.log(self.result)*size)-torch.sum(torch.log(x)))<=size*torch.log(torch.tensor(1+self.error))
+        size = moments.count(x)
+        mask = moments.mask(x)
+        # log(1) = 0 for elements filtered out
+        x = moments.values(x)*mask+(1-mask)
+        return torch.abs((torch.log(self.result)*size)-torch.sum(torch.log(x)))<=size*torch.log(torch.tensor(1+self.error, dtype=self.result.dtype))
 
 
 class HarmonicMean(Operation):
+    witness_type_id = 3
+
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float, precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'HarmonicMean':
-        if precal_witness is None:
-            x_1d = to_1d(x[0])
-            x_1d = x_1d[x_1d!=MagicNumber]
-            result = torch.div(1.0,torch.mean(torch.div(1.0, x_1d)))
-            return cls(result, error)
-        else:
-            if op_dict is None:
-                return cls(torch.tensor(precal_witness['HarmonicMean_0'][0]), error)
-            elif 'HarmonicMean' not in op_dict:
-                return cls(torch.tensor(precal_witness['HarmonicMean_0'][0]), error)
-            else:
-                return cls(torch.tensor(precal_witness['HarmonicMean_'+str(op_dict['HarmonicMean'])][0]), error)
-     
-
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'HarmonicMean':
+        x_1d = to_1d(x[0])
+        x_1d = x_1d[valid(x_1d, _column_masks(masks, 1)[0])]
+        result = torch.div(1.0,torch.mean(torch.div(1.0, x_1d)))
+        return cls(result, error)
+
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         # Assume x is [n, 1]
         x = x[0]
-        size = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        return torch.abs((self.result*torch.sum(torch.where(x==MagicNumber, 0.0, torch.div(1.0, x)))) - size)<=torch.abs(self.error*size)
+        size = moments.count(x)
+        return torch.abs((self.result*torch.sum(moments.mask(x)*torch.div(1.0, x))) - size)<=torch.abs(self.error*size)
 
 
 def mode_within(data_array: torch.Tensor, error: float) -> torch.Tensor:
@@ -179,403 +665,523 @@ def mode_within(data_array: torch.Tensor, error: float) -> torch.Tensor:
     :param error: The error that allows the data point to be considered the same.
        For example, if error = 0.01, then 0.999 and 1.000 are considered the same.
     """
-    max_sum_freq = 0
-    mode = data_array[0]
-    # print("arrrrr: ", data_array)
-    # print("seetttt: ", torch.unique(data_array))
-    for check_val in data_array:
-        sum_freq = sum(1 for ele in data_array if abs(ele - check_val) <= abs(error * check_val))
-        if sum_freq > max_sum_freq:
-            mode = check_val
-            max_sum_freq = sum_freq
-    return mode
-
-
-# TODO: Add class Mode_within , different from traditional mode
-# class Mode_(Operation):
-    # @classmethod
-    # def create(cls, x: list[torch.Tensor], error: float) -> 'Mode':
-    #     x_1d = to_1d(x[0])
-    #     #  Mode has no result_error, just num_error which is the
-    #     # deviation that two numbers are considered the same. (Make sense because
-    #     # if some dataset has all different data, mode will be trivial if this is not the case)
-    #     # This value doesn't depend on any scale, but on the dataset itself, and the intention
-    #     # the evaluator. For example 0.01 means that data is counted as the same within 1% value range.
-
-    #     # If wanting the strict definition of Mode, can just put this error to be 0
-    #     result = torch.tensor(mode_within(x_1d, error))
-    #     return cls(result, error)
-
-    # def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
-    #     # Assume x is [1, n, 1]
-    #     x = x[0]
-    #     size = x.size()[1]
-    #     count_equal = torch.sum((torch.abs(x-self.result)<=torch.abs(self.error*self.result)).float())
-    #     _result = torch.tensor([
-    #         torch.sum((torch.abs(x-ele[0])<=torch.abs(self.error*ele[0])).float())<= count_equal
-    #         for ele in x[0]
-    #     ], dtype = torch.float32)
-    #     return torch.sum(_result) == size
+    radius = torch.abs(error*data_array)
+    sorted_data = torch.sort(data_array).values
+    # Number of data points within the error of each data point, found with binary search in the sorted data
+    sum_freq = torch.searchsorted(sorted_data, data_array+radius, right=True)-torch.searchsorted(sorted_data, data_array-radius)
+    # The first data point with the most frequent count wins, as argmax returns the first maximum
+    return data_array[torch.argmax(sum_freq)]
+
+
+class ModeWithin(Operation):
+    """
+    Mode where data points within `error` of a value, relative to the value, count as the same value. Unlike
+    the other operations, `error` is not the tolerance of the result, which is always one of the data points.
+    For example, with 0.01, data is counted as the same within 1% value range.
+    """
+    witness_type_id = 12
+    witness_fields = ("result", "lo", "hi")
+
+    def __init__(self, x: torch.Tensor, error: float, mask: Optional[torch.Tensor] = None):
+        if error <= 0:
+            raise ValueError(f"error must be positive, use Mode for the exact mode: {error=}")
+        x_1d = to_1d(x)
+        size = len(x_1d)
+        x_1d = x_1d[valid(x_1d, mask)]
+        super().__init__(mode_within(x_1d, error).clone(), error)
+        # Elements filtered out are sorted first in the circuit, and the window of data points within the error
+        # of each sorted element is sorted_x[lo:hi], excluding them
+        num_filtered = size-len(x_1d)
+        sorted_x = torch.sort(x_1d).values
+        radius = torch.abs(error*sorted_x)
+        lo = num_filtered+torch.searchsorted(sorted_x, sorted_x-radius)
+        hi = num_filtered+torch.searchsorted(sorted_x, sorted_x+radius, right=True)
+        # Any valid indices for the elements filtered out, which are not checked
+        lo = torch.cat((torch.zeros(num_filtered), lo)).to(x.dtype).reshape(-1, 1)
+        hi = torch.cat((torch.ones(num_filtered), hi)).to(x.dtype).reshape(-1, 1)
+        self.lo = torch.nn.Parameter(data=lo, requires_grad=False)
+        self.hi = torch.nn.Parameter(data=hi, requires_grad=False)
+
+    @classmethod
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'ModeWithin':
+        return cls(x[0], error, _column_masks(masks, 1)[0])
+
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
+        # Assume x is [n, 1]
+        x = x[0]
+        old_size = x.size()[0]
+        num_filtered = old_size-moments.count(x)
+        filled = moments.filled(x)
+        # Differences are multiplied by 1/error rather than values by error, since a small error like 0.01 isn't
+        # precise as a constant at the scale of the circuit, while 1/error is usually an integer
+        inverse_error = 1/self.error
+        result_size = torch.abs(self.result)
+        # Compared on both sides rather than with `torch.abs`, which ezkl can't evaluate on the masked data
+        within_result = torch.logical_and((filled-self.result)*inverse_error<=result_size, (self.result-filled)*inverse_error<=result_size)
+        # Elements filtered out hold the filler, which can be within the error of the result too
+        count_within = torch.sum(torch.where(within_result, 1.0, 0.0)*moments.mask(x))
+
+        # The sort is constrained by the circuit, so each window sorted_x[lo:hi] is checked by its boundaries:
+        # sorted_x[lo] is within the error and sorted_x[lo-1] isn't, and the same for sorted_x[hi-1] and sorted_x[hi]
+        sorted_x = moments.sorted(x)
+        sorted_size = torch.where(sorted_x<0, -sorted_x, sorted_x)
+        lo = self.lo.reshape(-1)
+        hi = self.hi.reshape(-1)
+        before_lo = torch.gather(torch.cat((sorted_x[:1], sorted_x)), 0, lo.long())
+        at_lo = torch.gather(sorted_x, 0, lo.long())
+        at_hi = torch.gather(torch.cat((sorted_x, sorted_x[-1:])), 0, hi.long())
+        before_hi = torch.gather(sorted_x, 0, (hi-1).long())
+        lo_cons = torch.logical_and(
+            torch.logical_and(
+                torch.logical_or(lo==num_filtered, (sorted_x-before_lo)*inverse_error>sorted_size),
+                (sorted_x-at_lo)*inverse_error<=sorted_size,
+            ),
+            lo>=num_filtered,
+        )
+        hi_cons = torch.logical_and(
+            torch.logical_or(hi==old_size, (at_hi-sorted_x)*inverse_error>sorted_size),
+            (before_hi-sorted_x)*inverse_error<=sorted_size,
+        )
+        filtered_out = sorted_x==moments.filler(x)
+        windows_cons = torch.sum(torch.logical_or(torch.logical_and(lo_cons, hi_cons), filtered_out).float())==old_size
+        # No value has more data points within the error than the result, except the elements filtered out
+        count_cons = torch.sum(torch.logical_or(hi-lo<=count_within, filtered_out).float())==old_size
+        return torch.logical_and(windows_cons, count_cons)
 
 
 class Mode(Operation):
+    witness_type_id = 4
+    witness_fields = ("result", "runs")
+
+    def __init__(self, x: torch.Tensor, error: float, mask: Optional[torch.Tensor] = None):
+        x_1d = to_1d(x)
+        size = len(x_1d)
+        x_1d = x_1d[valid(x_1d, mask)]
+        # Here is traditional definition of Mode, can just put this num_error to be 0
+        super().__init__(torch.tensor(mode_within(x_1d, 0)), error)
+        # Elements filtered out are sorted first in the circuit, as a value less than all others
+        sorted_x = torch.cat((torch.full((size-len(x_1d),), -torch.inf), torch.sort(x_1d).values))
+        # runs[i] is how many times sorted_x[i] occurs in sorted_x[:i+1]
+        index = torch.arange(size)
+        starts = torch.cat((torch.tensor([True]), sorted_x[1:]!=sorted_x[:-1]))
+        run_start = torch.cummax(torch.where(starts, index, 0), dim=0).values
+        runs = (index-run_start+1).to(x.dtype).reshape(-1, 1)
+        self.runs = torch.nn.Parameter(data=runs, requires_grad=False)
+
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'Mode':
-        if precal_witness is None:
-            x_1d = to_1d(x[0])
-            x_1d = x_1d[x_1d!=MagicNumber]
-            # Here is traditional definition of Mode, can just put this num_error to be 0
-            result = torch.tensor(mode_within(x_1d, 0))
-            return cls(result, error)
-        else:
-            if op_dict is None:
-                return cls(torch.tensor(precal_witness['Mode_0'][0]), error)
-            elif 'Mode' not in op_dict:
-                return cls(torch.tensor(precal_witness['Mode_0'][0]), error)
-            else:
-                return cls(torch.tensor(precal_witness['Mode_'+str(op_dict['Mode'])][0]), error)
-     
-
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'Mode':
+        return cls(x[0], error, _column_masks(masks, 1)[0])
+
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         # Assume x is [n, 1]
         x = x[0]
-        min_x = torch.min(x)
         old_size = x.size()[0]
-        x = torch.where(x==MagicNumber, min_x-1, x)
-        count_equal = torch.sum(torch.where(x==self.result, 1.0, 0.0))
+        count_equal = torch.sum(torch.where(moments.filled(x)==self.result, 1.0, 0.0))
 
-        count_check = 0
-        for ele in x:
-            bool1 = torch.sum(torch.where(x==ele[0], 1.0, 0.0))<=count_equal
-            bool2 = ele[0]==min_x-1
-            count_check += torch.logical_or(bool1, bool2)
-        return count_check ==old_size
+        # The sort is constrained by the circuit, so `runs` only has to be checked against neighbours: it counts
+        # up within a run of equal values and restarts from 1 at a new value
+        sorted_x = moments.sorted(x).reshape(-1, 1)
+        same_as_prev = torch.where(sorted_x[1:]==sorted_x[:-1], 1.0, 0.0)
+        first_cons = self.runs[0][0]==1.0
+        runs_cons = torch.sum(torch.where(self.runs[1:]==self.runs[:-1]*same_as_prev+1, 1.0, 0.0))==old_size-1
+        # No value occurs more often than the result, except the elements filtered out
+        count_check = torch.sum(torch.logical_or(self.runs<=count_equal, sorted_x==moments.filler(x)).float())
+        return torch.logical_and(torch.logical_and(first_cons, runs_cons), count_check==old_size)
 
 
 class PStdev(Operation):
-    def __init__(self, x: torch.Tensor, error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None):
-        if precal_witness is None:
-            x_1d = to_1d(x)
-            x_1d = x_1d[x_1d!=MagicNumber]
-            self.data_mean = torch.nn.Parameter(data=torch.mean(x_1d), requires_grad=False)
-            result = torch.sqrt(torch.var(x_1d, correction = 0))
-            super().__init__(result, error)
-        else:
-            if op_dict is None:
-                super().__init__(torch.tensor(precal_witness['PStdev_0'][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['PStdev_0'][1]), requires_grad=False)
-            elif 'PStdev' not in op_dict:
-                super().__init__(torch.tensor(precal_witness['PStdev_0'][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['PStdev_0'][1]), requires_grad=False)
-            else:
-                super().__init__(torch.tensor(precal_witness['PStdev_'+str(op_dict['PStdev'])][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['PStdev_'+str(op_dict['PStdev'])][1]), requires_grad=False)
+    witness_type_id = 5
+    witness_fields = ("result", "data_mean")
 
+    def __init__(self, x: torch.Tensor, error: float, mask: Optional[torch.Tensor] = None):
+        moments = RunningMoments.of([to_1d(x)], masks=[mask])
+        if moments.count < 1:
+            raise statistics.StatisticsError("pstdev requires at least one data point")
+        self.data_mean = torch.nn.Parameter(data=moments.mean_witness(), requires_grad=False)
+        result = torch.tensor(np.sqrt(moments.comoments[0, 0]/moments.count), dtype = moments.dtype)
+        super().__init__(result, error)
 
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float, precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'PStdev':
-        return cls(x[0], error, precal_witness, op_dict)
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'PStdev':
+        return cls(x[0], error, _column_masks(masks, 1)[0])
 
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         x = x[0]
-        x_fil_0 = torch.where(x==MagicNumber, 0.0, x)
-        size = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        x_mean_cons = torch.abs(torch.sum(x_fil_0)-size*(self.data_mean))<=torch.abs(self.error*self.data_mean*size)
-        x_adj_mean = torch.where(x==MagicNumber, 0.0, x-self.data_mean)
+        size = moments.count(x)
+        x_mean_cons = moments.mean_constraint(x, self.data_mean)
         return torch.logical_and(
-            torch.abs(torch.sum((x_adj_mean)*(x_adj_mean))-self.result*self.result*size)<=torch.abs(2*self.error*self.result*self.result*size),x_mean_cons
+            torch.abs(moments.sum_sq(x, self.data_mean)-self.result*self.result*size)<=torch.abs(2*self.error*self.result*self.result*size),x_mean_cons
         )
 
 
 class PVariance(Operation):
-    def __init__(self, x: torch.Tensor, error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None):
-        if precal_witness is None:
-            x_1d = to_1d(x)
-            x_1d = x_1d[x_1d!=MagicNumber]
-            self.data_mean = torch.nn.Parameter(data=torch.mean(x_1d), requires_grad=False)
-            result = torch.var(x_1d, correction = 0)
-            super().__init__(result, error)
-        else:
-            if op_dict is None:
-                super().__init__(torch.tensor(precal_witness['PVariance_0'][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['PVariance_0'][1]), requires_grad=False)
-            elif 'PVariance' not in op_dict:
-                super().__init__(torch.tensor(precal_witness['PVariance_0'][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['PVariance_0'][1]), requires_grad=False)
-            else:
-                super().__init__(torch.tensor(precal_witness['PVariance_'+str(op_dict['PVariance'])][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['PVariance_'+str(op_dict['PVariance'])][1]), requires_grad=False)
+    witness_type_id = 6
+    witness_fields = ("result", "data_mean")
+
+    def __init__(self, x: torch.Tensor, error: float, mask: Optional[torch.Tensor] = None):
+        moments = RunningMoments.of([to_1d(x)], masks=[mask])
+        if moments.count < 1:
+            raise statistics.StatisticsError("pvariance requires at least one data point")
+        self.data_mean = torch.nn.Parameter(data=moments.mean_witness(), requires_grad=False)
+        result = torch.tensor(moments.comoments[0, 0]/moments.count, dtype = moments.dtype)
+        super().__init__(result, error)
 
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'PVariance':
-        return cls(x[0], error, precal_witness, op_dict)
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'PVariance':
+        return cls(x[0], error, _column_masks(masks, 1)[0])
 
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         x = x[0]
-        x_fil_0 = torch.where(x==MagicNumber, 0.0, x)
-        size = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        x_mean_cons = torch.abs(torch.sum(x_fil_0)-size*(self.data_mean))<=torch.abs(self.error*self.data_mean*size)
-        x_adj_mean = torch.where(x==MagicNumber, 0.0, x-self.data_mean)
+        size = moments.count(x)
+        x_mean_cons = moments.mean_constraint(x, self.data_mean)
         return torch.logical_and(
-            torch.abs(torch.sum((x_adj_mean)*(x_adj_mean))-self.result*size)<=torch.abs(self.error*self.result*size), x_mean_cons
+            torch.abs(moments.sum_sq(x, self.data_mean)-self.result*size)<=torch.abs(self.error*self.result*size), x_mean_cons
         )
 
 
 
 class Stdev(Operation):
-    def __init__(self, x: torch.Tensor, error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None):
-        if precal_witness is None:
-            x_1d = to_1d(x)
-            x_1d = x_1d[x_1d!=MagicNumber]
-            self.data_mean = torch.nn.Parameter(data=torch.mean(x_1d), requires_grad=False)
-            result = torch.sqrt(torch.var(x_1d, correction = 1))
-            super().__init__(result, error)
-        else:
-            if op_dict is None:
-                super().__init__(torch.tensor(precal_witness['Stdev_0'][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Stdev_0'][1]), requires_grad=False)
-            elif 'Stdev' not in op_dict:
-                super().__init__(torch.tensor(precal_witness['Stdev_0'][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Stdev_0'][1]), requires_grad=False)
-            else:
-                super().__init__(torch.tensor(precal_witness['Stdev_'+str(op_dict['Stdev'])][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Stdev_'+str(op_dict['Stdev'])][1]), requires_grad=False)
+    witness_type_id = 7
+    witness_fields = ("result", "data_mean")
 
+    def __init__(self, x: torch.Tensor, error: float, mask: Optional[torch.Tensor] = None):
+        moments = RunningMoments.of([to_1d(x)], masks=[mask])
+        if moments.count < 2:
+            raise statistics.StatisticsError("stdev requires at least two data points")
+        self.data_mean = torch.nn.Parameter(data=moments.mean_witness(), requires_grad=False)
+        result = torch.tensor(np.sqrt(moments.comoments[0, 0]/(moments.count-1)), dtype = moments.dtype)
+        super().__init__(result, error)
 
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'Stdev':
-        return cls(x[0], error, precal_witness, op_dict)
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'Stdev':
+        return cls(x[0], error, _column_masks(masks, 1)[0])
 
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         x = x[0]
-        x_fil_0 = torch.where(x==MagicNumber, 0.0, x)
-        size = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        x_mean_cons = torch.abs(torch.sum(x_fil_0)-size*(self.data_mean))<=torch.abs(self.error*self.data_mean*size)
-        x_adj_mean = torch.where(x==MagicNumber, 0.0, x-self.data_mean)
+        size = moments.count(x)
+        x_mean_cons = moments.mean_constraint(x, self.data_mean)
         return torch.logical_and(
-            torch.abs(torch.sum((x_adj_mean)*(x_adj_mean))-self.result*self.result*(size - 1))<=torch.abs(2*self.error*self.result*self.result*(size - 1)), x_mean_cons
+            torch.abs(moments.sum_sq(x, self.data_mean)-self.result*self.result*(size - 1))<=torch.abs(2*self.error*self.result*self.result*(size - 1)), x_mean_cons
         )
 
 
 class Variance(Operation):
-    def __init__(self, x: torch.Tensor, error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None):
-        if precal_witness is None:
-            x_1d = to_1d(x)
-            x_1d = x_1d[x_1d!=MagicNumber]
-            self.data_mean = torch.nn.Parameter(data=torch.mean(x_1d), requires_grad=False)
-            result = torch.var(x_1d, correction = 1)
-            super().__init__(result, error)
-        else:
-            if op_dict is None:
-                super().__init__(torch.tensor(precal_witness['Variance_0'][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Variance_0'][1]), requires_grad=False)         
-            elif 'Variance' not in op_dict:
-                super().__init__(torch.tensor(precal_witness['Variance_0'][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Variance_0'][1]), requires_grad=False)
-            else:
-                super().__init__(torch.tensor(precal_witness['Variance_'+str(op_dict['Variance'])][0]), error)
-                self.data_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Variance_'+str(op_dict['Variance'])][1]), requires_grad=False)
+    witness_type_id = 8
+    witness_fields = ("result", "data_mean")
 
+    def __init__(self, x: torch.Tensor, error: float, mask: Optional[torch.Tensor] = None):
+        moments = RunningMoments.of([to_1d(x)], masks=[mask])
+        if moments.count < 2:
+            raise statistics.StatisticsError("variance requires at least two data points")
+        self.data_mean = torch.nn.Parameter(data=moments.mean_witness(), requires_grad=False)
+        result = torch.tensor(moments.comoments[0, 0]/(moments.count-1), dtype = moments.dtype)
+        super().__init__(result, error)
 
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'Variance':
-        return cls(x[0], error, precal_witness, op_dict)
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'Variance':
+        return cls(x[0], error, _column_masks(masks, 1)[0])
 
-    def ezkl(self, x: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, x: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         x = x[0]
-        x_fil_0 = torch.where(x==MagicNumber, 0.0, x)
-        size = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        x_mean_cons = torch.abs(torch.sum(x_fil_0)-size*(self.data_mean))<=torch.abs(self.error*self.data_mean*size)
-        x_adj_mean = torch.where(x==MagicNumber, 0.0, x-self.data_mean)
+        size = moments.count(x)
+        x_mean_cons = moments.mean_constraint(x, self.data_mean)
         return torch.logical_and(
-            torch.abs(torch.sum((x_adj_mean)*(x_adj_mean))-self.result*(size - 1))<=torch.abs(self.error*self.result*(size - 1)), x_mean_cons
+            torch.abs(moments.sum_sq(x, self.data_mean)-self.result*(size - 1))<=torch.abs(self.error*self.result*(size - 1)), x_mean_cons
         )
 
 
 
 
 class Covariance(Operation):
-    def __init__(self, x: torch.Tensor, y: torch.Tensor, error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None):
-        if precal_witness is None: 
-            x_1d = to_1d(x)
-            x_1d = x_1d[x_1d!=MagicNumber]
-            y_1d = to_1d(y)
-            y_1d = y_1d[y_1d!=MagicNumber]
-            x_1d_list = x_1d.tolist()
-            y_1d_list = y_1d.tolist()
-
-            self.x_mean = torch.nn.Parameter(data=torch.tensor(statistics.mean(x_1d_list), dtype = torch.float32), requires_grad=False)
-            self.y_mean = torch.nn.Parameter(data=torch.tensor(statistics.mean(y_1d_list), dtype = torch.float32), requires_grad=False)
-            result = torch.tensor(statistics.covariance(x_1d_list, y_1d_list), dtype = torch.float32)
-
-            super().__init__(result, error)
-        else:
-            if op_dict is None:
-                super().__init__(torch.tensor(precal_witness['Covariance_0'][0]), error)
-                self.x_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Covariance_0'][1]), requires_grad=False)
-                self.y_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Covariance_0'][2]), requires_grad=False)  
-            elif 'Covariance' not in op_dict:
-                super().__init__(torch.tensor(precal_witness['Covariance_0'][0]), error)
-                self.x_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Covariance_0'][1]), requires_grad=False)
-                self.y_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Covariance_0'][2]), requires_grad=False)
-            else:
-                super().__init__(torch.tensor(precal_witness['Covariance_'+str(op_dict['Covariance'])][0]), error)
-                self.x_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Covariance_'+str(op_dict['Covariance'])][1]), requires_grad=False)
-                self.y_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Covariance_'+str(op_dict['Covariance'])][2]), requires_grad=False)
+    witness_type_id = 9
+    witness_fields = ("result", "x_mean", "y_mean")
+
+    def __init__(self, x: torch.Tensor, y: torch.Tensor, error: float, masks: TMasks = None):
+        moments = RunningMoments.of([to_1d(x), to_1d(y)], masks=masks)
+        if moments.count < 2:
+            raise statistics.StatisticsError("covariance requires at least two data points")
+
+        self.x_mean = torch.nn.Parameter(data=moments.mean_witness(0), requires_grad=False)
+        self.y_mean = torch.nn.Parameter(data=moments.mean_witness(1), requires_grad=False)
+        result = torch.tensor(moments.comoments[0, 1]/(moments.count-1), dtype = moments.dtype)
+
+        super().__init__(result, error)
 
     @classmethod
-    def create(cls, x: list[torch.Tensor], error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'Covariance':
-        return cls(x[0], x[1], error, precal_witness, op_dict)
+    def create(cls, x: list[torch.Tensor], error: float, masks: TMasks = None) -> 'Covariance':
+        return cls(x[0], x[1], error, masks)
 
-    def ezkl(self, args: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, args: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         x, y = args[0], args[1]
-        x_fil_0 = torch.where(x==MagicNumber, 0.0, x)
-        y_fil_0 = torch.where(y==MagicNumber, 0.0, y)
-        size_x = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        size_y = torch.sum(torch.where(y!=MagicNumber, 1.0, 0.0))
-        x_mean_cons = torch.abs(torch.sum(x_fil_0)-size_x*(self.x_mean))<=torch.abs(self.error*self.x_mean*size_x)
-        y_mean_cons = torch.abs(torch.sum(y_fil_0)-size_y*(self.y_mean))<=torch.abs(self.error*self.y_mean*size_y)
-        x_adj_mean = torch.where(x==MagicNumber, 0.0, x-self.x_mean)
-        y_adj_mean = torch.where(y==MagicNumber, 0.0, y-self.y_mean)
+        size_x = moments.count(x)
+        size_y = moments.count(y)
+        x_mean_cons = moments.mean_constraint(x, self.x_mean)
+        y_mean_cons = moments.mean_constraint(y, self.y_mean)
+        cross = moments.cross(x, self.x_mean, y, self.y_mean)
 
         return torch.logical_and(
             torch.logical_and(size_x==size_y,torch.logical_and(x_mean_cons,y_mean_cons)),
-            torch.abs(torch.sum((x_adj_mean)*(y_adj_mean))-(size_x-1)*self.result)<=torch.abs(self.error*self.result*(size_x-1))
+            torch.abs(cross-(size_x-1)*self.result)<=torch.abs(self.error*self.result*(size_x-1))
         )
 
 # refer other constraints to correlation function, not put here since will be repetitive
-def stdev_for_corr(x_adj_mean:torch.Tensor, size_x:torch.Tensor, x_std: torch.Tensor, error: float) -> torch.Tensor:
+def stdev_for_corr(x_sum_sq:torch.Tensor, size_x:torch.Tensor, x_std: torch.Tensor, error: float) -> torch.Tensor:
     return (
-            torch.abs(torch.sum((x_adj_mean)*(x_adj_mean))-x_std*x_std*(size_x - 1))<=torch.abs(2*error*x_std*x_std*(size_x - 1))
+            torch.abs(x_sum_sq-x_std*x_std*(size_x - 1))<=torch.abs(2*error*x_std*x_std*(size_x - 1))
         , x_std)
 # refer other constraints to correlation function, not put here since will be repetitive
-def covariance_for_corr(x_adj_mean: torch.Tensor,y_adj_mean: torch.Tensor,size_x:torch.Tensor, cov: torch.Tensor,  error: float) -> torch.Tensor:
+def covariance_for_corr(cross: torch.Tensor,size_x:torch.Tensor, cov: torch.Tensor,  error: float) -> torch.Tensor:
         return (
-            torch.abs(torch.sum((x_adj_mean)*(y_adj_mean))-(size_x-1)*cov)<=torch.abs(error*cov*(size_x-1))
+            torch.abs(cross-(size_x-1)*cov)<=torch.abs(error*cov*(size_x-1))
         , cov)
 
 
 class Correlation(Operation):
-    def __init__(self, x: torch.Tensor, y: torch.Tensor, error: float, precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None):
-        if precal_witness is None:
-            x_1d = to_1d(x)
-            x_1d = x_1d[x_1d!=MagicNumber]
-            y_1d = to_1d(y)
-            y_1d = y_1d[y_1d!=MagicNumber]
-            x_1d_list = x_1d.tolist()
-            y_1d_list = y_1d.tolist()
-            self.x_mean = torch.nn.Parameter(data=torch.mean(x_1d), requires_grad=False)
-            self.y_mean = torch.nn.Parameter(data=torch.mean(y_1d), requires_grad = False)
-            self.x_std = torch.nn.Parameter(data=torch.sqrt(torch.var(x_1d, correction = 1)), requires_grad = False)
-            self.y_std = torch.nn.Parameter(data=torch.sqrt(torch.var(y_1d, correction = 1)), requires_grad=False)
-            self.cov = torch.nn.Parameter(data=torch.tensor(statistics.covariance(x_1d_list, y_1d_list), dtype = torch.float32), requires_grad=False)
-            result = torch.tensor(statistics.correlation(x_1d_list, y_1d_list), dtype = torch.float32)
-
-            super().__init__(result, error)
-        else:
-            if op_dict is None:
-                super().__init__(torch.tensor(precal_witness['Correlation_0'][0]), error)
-                self.x_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][1]), requires_grad=False)
-                self.y_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][2]), requires_grad=False)
-                self.x_std = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][3]), requires_grad=False)
-                self.y_std = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][4]), requires_grad=False)
-                self.cov = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][5]), requires_grad=False)       
-            elif 'Correlation' not in op_dict:
-                super().__init__(torch.tensor(precal_witness['Correlation_0'][0]), error)
-                self.x_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][1]), requires_grad=False)
-                self.y_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][2]), requires_grad=False)
-                self.x_std = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][3]), requires_grad=False)
-                self.y_std = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][4]), requires_grad=False)
-                self.cov = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_0'][5]), requires_grad=False)
-            else:
-                super().__init__(torch.tensor(precal_witness['Correlation_'+str(op_dict['Correlation'])][0]), error)
-                self.x_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_'+str(op_dict['Correlation'])][1]), requires_grad=False)
-                self.y_mean = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_'+str(op_dict['Correlation'])][2]), requires_grad=False)
-                self.x_std = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_'+str(op_dict['Correlation'])][3]), requires_grad=False)
-                self.y_std = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_'+str(op_dict['Correlation'])][4]), requires_grad=False)
-                self.cov = torch.nn.Parameter(data = torch.tensor(precal_witness['Correlation_'+str(op_dict['Correlation'])][5]), requires_grad=False)
-
+    witness_type_id = 10
+    witness_fields = ("result", "x_mean", "y_mean", "x_std", "y_std", "cov")
+
+    def __init__(self, x: torch.Tensor, y: torch.Tensor, error: float, masks: TMasks = None):
+        moments = RunningMoments.of([to_1d(x), to_1d(y)], masks=masks)
+        if moments.count < 2:
+            raise statistics.StatisticsError("correlation requires at least two data points")
+        cross = moments.comoments[0, 1]
+        x_sum_sq = moments.comoments[0, 0]
+        y_sum_sq = moments.comoments[1, 1]
+        if x_sum_sq == 0 or y_sum_sq == 0:
+            raise statistics.StatisticsError("at least one of the inputs is constant")
+        self.x_mean = torch.nn.Parameter(data=moments.mean_witness(0), requires_grad=False)
+        self.y_mean = torch.nn.Parameter(data=moments.mean_witness(1), requires_grad = False)
+        self.x_std = torch.nn.Parameter(data=torch.tensor(np.sqrt(x_sum_sq/(moments.count-1)), dtype = moments.dtype), requires_grad = False)
+        self.y_std = torch.nn.Parameter(data=torch.tensor(np.sqrt(y_sum_sq/(moments.count-1)), dtype = moments.dtype), requires_grad=False)
+        self.cov = torch.nn.Parameter(data=torch.tensor(cross/(moments.count-1), dtype = moments.dtype), requires_grad=False)
+        result = torch.tensor(cross/np.sqrt(x_sum_sq*y_sum_sq), dtype = moments.dtype)
+
+        super().__init__(result, error)
 
     @classmethod
-    def create(cls, args: list[torch.Tensor], error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'Correlation':
-        return cls(args[0], args[1], error, precal_witness, op_dict)
+    def create(cls, args: list[torch.Tensor], error: float, masks: TMasks = None) -> 'Correlation':
+        return cls(args[0], args[1], error, masks)
 
-    def ezkl(self, args: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, args: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
         x, y = args[0], args[1]
-        x_fil_0 = torch.where(x==MagicNumber, 0.0, x)
-        y_fil_0 = torch.where(y==MagicNumber, 0.0, y)
-        size_x = torch.sum(torch.where(x!=MagicNumber, 1.0, 0.0))
-        size_y = torch.sum(torch.where(y!=MagicNumber, 1.0, 0.0))
-        x_mean_cons = torch.abs(torch.sum(x_fil_0)-size_x*(self.x_mean))<=torch.abs(self.error*self.x_mean*size_x)
-        y_mean_cons = torch.abs(torch.sum(y_fil_0)-size_y*(self.y_mean))<=torch.abs(self.error*self.y_mean*size_y)
-        x_adj_mean = torch.where(x==MagicNumber, 0.0, x-self.x_mean)
-        y_adj_mean = torch.where(y==MagicNumber, 0.0, y-self.y_mean)
+        size_x = moments.count(x)
+        size_y = moments.count(y)
+        x_mean_cons = moments.mean_constraint(x, self.x_mean)
+        y_mean_cons = moments.mean_constraint(y, self.y_mean)
 
         miscel_cons = torch.logical_and(size_x==size_y, torch.logical_and(x_mean_cons, y_mean_cons))
-        bool1, cov = covariance_for_corr(x_adj_mean,y_adj_mean,size_x, self.cov, self.error)
-        bool2, x_std = stdev_for_corr( x_adj_mean, size_x, self.x_std, self.error)
-        bool3, y_std = stdev_for_corr( y_adj_mean, size_y, self.y_std, self.error)
+        bool1, cov = covariance_for_corr(moments.cross(x, self.x_mean, y, self.y_mean), size_x, self.cov, self.error)
+        bool2, x_std = stdev_for_corr(moments.sum_sq(x, self.x_mean), size_x, self.x_std, self.error)
+        bool3, y_std = stdev_for_corr(moments.sum_sq(y, self.y_mean), size_y, self.y_std, self.error)
         # this is correlation constraint
         bool4 = torch.abs(cov - self.result*x_std*y_std)<=torch.abs(self.error*cov)
         return torch.logical_and(torch.logical_and(torch.logical_and(bool1, bool2),torch.logical_and(bool3, bool4)), miscel_cons)
 
 
-def stacked_x(args: list[float]):
-    return np.column_stack((*args, np.ones_like(args[0])))
-
-
 class Regression(Operation):
-    def __init__(self, xs: list[torch.Tensor], y: torch.Tensor, error: float,  precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None):
-        if precal_witness is None:
-            x_1ds = [to_1d(i) for i in xs]
-            fil_x_1ds=[]
-            for x_1 in x_1ds:
-                fil_x_1ds.append((x_1[x_1!=MagicNumber]).tolist())
-            x_1ds = fil_x_1ds
-
-            y_1d = to_1d(y)
-            y_1d = (y_1d[y_1d!=MagicNumber]).tolist()
-
-            x_one = stacked_x(x_1ds)
-            result_1d = np.matmul(np.matmul(np.linalg.inv(np.matmul(x_one.transpose(), x_one)), x_one.transpose()), y_1d)
-            # result = torch.tensor(result_1d, dtype = torch.float32).reshape(1, -1, 1)
-            result = torch.tensor(result_1d, dtype = torch.float32).reshape(-1,1)
-            super().__init__(result, error)
-            # print('result regression: ', result)
-        else:
-            if op_dict is None:
-                # result = torch.tensor(precal_witness['Regression_0']).reshape(1,-1,1)
-                result = torch.tensor(precal_witness['Regression_0']).reshape(-1,1)
-            elif 'Regression' not in op_dict:
-                # result = torch.tensor(precal_witness['Regression_0']).reshape(1,-1,1)
-                result = torch.tensor(precal_witness['Regression_0']).reshape(-1,1)
-            else:
-                # result = torch.tensor(precal_witness['Regression_'+str(op_dict['Regression'])]).reshape(1,-1,1)
-                result = torch.tensor(precal_witness['Regression_'+str(op_dict['Regression'])]).reshape(-1,1)
-
-            # for ele in precal_witness['Regression']:
-            #     precal_witness_arr.append(torch.tensor(ele))
-            # print('resultopppp: ', result)
-            super().__init__(result,error)
-            
+    witness_type_id = 11
+
+    def __init__(self, xs: list[torch.Tensor], y: torch.Tensor, error: float, masks: TMasks = None):
+        # Solved with least squares rather than inverting the Gram matrix, which is fragile when the regressors
+        # are correlated. The result is the slopes of the regressors in order, then the intercept
+        result_1d = least_squares_f64([to_1d(x) for x in xs], to_1d(y), masks=masks)
+        result = torch.tensor(result_1d, dtype = y.dtype).reshape(-1,1)
+        super().__init__(result, error)
 
     @classmethod
-    def create(cls, args: list[torch.Tensor], error: float, precal_witness:Optional[dict] = None, op_dict:Optional[dict[str,int]] = None) -> 'Regression':
+    def create(cls, args: list[torch.Tensor], error: float, masks: TMasks = None) -> 'Regression':
         xs = args[:-1]
         y = args[-1]
-        return cls(xs, y, error, precal_witness, op_dict)
+        return cls(xs, y, error, masks)
 
-    def ezkl(self, args: list[torch.Tensor]) -> IsResultPrecise:
+    def ezkl(self, args: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
          # infer y from the last parameter
         y = args[-1]
-        y = torch.where(y==MagicNumber,0.0, y)
-        x_one = torch.cat((*args[:-1], torch.ones_like(args[0])), dim = 1)
-        x_one = torch.where((x_one[:,0] ==MagicNumber).unsqueeze(-1), torch.tensor([0.0]*x_one.size()[1]), x_one)
+        y = moments.values(y)*moments.mask(y)
+        x_one = torch.cat((*[moments.values(x) for x in args[:-1]], torch.ones_like(args[0])), dim = 1)
+        # Rows filtered out in x are zeros
+        x_one = x_one*moments.mask(args[0])
         x_t = torch.transpose(x_one, 0, 1)
 
-        left = x_t @ x_one @ self.result - x_t @ y
-        right = self.error*x_t @ y
+        # Normal equations, with the Gram matrix of the regressors and the intercept built once: one row per
+        # coefficient, so the check after the Gram matrix is independent of the number of rows
+        gram = x_t @ x_one
+        x_t_y = x_t @ y
+        left = gram @ self.result - x_t_y
         abs_left = torch.where(left>=0, left, -left)
-        abs_right = torch.where(right>=0, right, -right)
-        return torch.where(torch.sum(torch.where(abs_left<=abs_right, 1.0, 0.0))==torch.tensor(2.0), 1.0, 0.0)
+        # Relative to the terms of each sum before they cancel out rather than to Xᵀy, which is about 0 when
+        # e.g. the data is centered
+        abs_x_one = torch.where(x_one>=0, x_one, -x_one)
+        abs_result = torch.where(self.result>=0, self.result, -self.result)
+        abs_y = torch.where(y>=0, y, -y)
+        abs_right = self.error*(torch.transpose(abs_x_one, 0, 1) @ (abs_x_one @ abs_result + abs_y))
+        num_coefficients = x_one.size()[1]
+        return torch.where(torch.sum(torch.where(abs_left<=abs_right, 1.0, 0.0))==torch.tensor(float(num_coefficients)), 1.0, 0.0)
+
+
 
+class GroupBy(Operation):
+    """
+    Aggregate of the values for every group of rows with the same key, all groups in one pass: the key column is
+    compared with all keys at once, and the aggregates of the groups are read from that one-hot matrix, so the
+    circuit grows with the number of rows times the number of groups rather than with a filter per group.
+
+    The keys are the distinct keys of the key column in ascending order, and the circuit checks that every row not
+    filtered out has one of them. If the keys are given, rows with other keys are left out instead, and the circuit
+    doesn't depend on how many distinct keys the data has.
+    """
+    witness_fields = ("result", "keys")
+
+    def __init__(self, key_column: torch.Tensor, values: torch.Tensor, error: float, keys: Optional[Sequence[float]], masks: TMasks = None):
+        keys_1d = to_1d(key_column)
+        values_1d = to_1d(values)
+        key_mask, values_mask = _column_masks(masks, 2)
+        in_groups = torch.logical_and(valid(keys_1d, key_mask), valid(values_1d, values_mask))
+        keys_1d = keys_1d[in_groups].to(torch.float64).numpy()
+        values_1d = values_1d[in_groups].to(torch.float64).numpy()
+        if keys is None:
+            group_keys = np.unique(keys_1d)
+        else:
+            group_keys = torch.tensor(keys, dtype=key_column.dtype).to(torch.float64).numpy()
+            if len(np.unique(group_keys)) != len(group_keys):
+                raise ValueError(f"keys must be distinct: {keys=}")
+        if len(group_keys) == 0:
+            raise statistics.StatisticsError("group_by requires at least one group")
+        self.given_keys = None if keys is None else tuple(keys)
+        self.keys = torch.nn.Parameter(data=torch.tensor(group_keys, dtype=key_column.dtype), requires_grad=False)
+        one_hot = (keys_1d.reshape(-1, 1)==group_keys.reshape(1, -1)).astype(np.float64)
+        super().__init__(torch.tensor(self._aggregate(one_hot, values_1d), dtype=self.keys.dtype), error)
+
+    @abstractmethod
+    def _aggregate(self, one_hot: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """
+        Aggregates of the groups in float64, from the one-hot matrix of the rows in the groups, [n, groups]. Other
+        witness fields are set here too.
+        """
+        ...
+
+    @abstractmethod
+    def _check(self, one_hot: torch.Tensor, values: torch.Tensor, counts: torch.Tensor) -> IsResultPrecise:
+        """
+        Constraints that the aggregates are precise.
+
+        :param one_hot: 1.0 where the row is in the group, [n, groups]. Rows filtered out are in no group
+        :param values: the values, [n, 1]
+        :param counts: the number of rows in each group, [groups]
+        """
+        ...
+
+    @classmethod
+    def create(cls, args: list[torch.Tensor], error: float, keys: Optional[Sequence[float]] = None, masks: TMasks = None) -> 'GroupBy':
+        return cls(args[0], args[1], error, keys, masks)
+
+    @classmethod
+    def from_witness(cls, witness: Sequence[torch.Tensor], error: float, keys: Optional[Sequence[float]] = None) -> 'GroupBy':
+        op = super().from_witness(witness, error)
+        op.given_keys = None if keys is None else tuple(keys)
+        return op
+
+    def ezkl(self, args: list[torch.Tensor], moments: Optional[Moments] = None) -> IsResultPrecise:
+        moments = moments or Moments(self.error)
+        key_column, values = args[0], args[1]
+        old_size = key_column.size()[0]
+        num_groups = self.keys.size()[0]
+        mask = moments.mask(key_column)*moments.mask(values)
+        one_hot = torch.where(moments.values(key_column)==self.keys.reshape(1, -1), 1.0, 0.0)*mask
+        counts = torch.sum(one_hot, dim=0)
+        if self.given_keys is not None:
+            given_keys = torch.tensor(self.given_keys, dtype=self.keys.dtype)
+            keys_cons = torch.sum(torch.where(self.keys==given_keys, 1.0, 0.0))==num_groups
+        else:
+            # Every row not filtered out is in exactly one group, and every group has a row. The keys are ascending,
+            # so they're distinct and their order is fixed
+            in_one_group = torch.sum(torch.where(torch.sum(one_hot, dim=1, keepdim=True)==mask, 1.0, 0.0))==old_size
+            non_empty = torch.sum(torch.where(counts>=1, 1.0, 0.0))==num_groups
+            keys_cons = torch.logical_and(in_one_group, non_empty)
+            if num_groups > 1:
+                ascending = torch.sum(torch.where(self.keys[1:]>self.keys[:-1], 1.0, 0.0))==num_groups-1
+                keys_cons = torch.logical_and(keys_cons, ascending)
+        return torch.logical_and(keys_cons, self._check(one_hot, moments.values(values), counts))
+
+
+class GroupCount(GroupBy):
+    witness_type_id = 14
+
+    def _aggregate(self, one_hot: np.ndarray, values: np.ndarray) -> np.ndarray:
+        return np.sum(one_hot, axis=0)
+
+    def _check(self, one_hot: torch.Tensor, values: torch.Tensor, counts: torch.Tensor) -> IsResultPrecise:
+        num_groups = self.keys.size()[0]
+        return torch.sum(torch.where(counts==self.result, 1.0, 0.0))==num_groups
+
+
+class GroupSum(GroupBy):
+    witness_type_id = 15
+
+    def _aggregate(self, one_hot: np.ndarray, values: np.ndarray) -> np.ndarray:
+        return values@one_hot
+
+    def _check(self, one_hot: torch.Tensor, values: torch.Tensor, counts: torch.Tensor) -> IsResultPrecise:
+        num_groups = self.keys.size()[0]
+        sums = torch.sum(values*one_hot, dim=0)
+        bound = torch.abs(self.error*self.result)
+        # Compared on both sides rather than with `torch.abs`, which ezkl can't evaluate on the masked data
+        sums_cons = torch.logical_and(sums-self.result<=bound, self.result-sums<=bound)
+        return torch.sum(torch.where(sums_cons, 1.0, 0.0))==num_groups
+
+
+class GroupMean(GroupBy):
+    witness_type_id = 16
+
+    def _aggregate(self, one_hot: np.ndarray, values: np.ndarray) -> np.ndarray:
+        counts = np.sum(one_hot, axis=0)
+        if np.any(counts<1):
+            raise statistics.StatisticsError("mean requires at least one data point in every group")
+        return (values@one_hot)/counts
+
+    def _check(self, one_hot: torch.Tensor, values: torch.Tensor, counts: torch.Tensor) -> IsResultPrecise:
+        num_groups = self.keys.size()[0]
+        sums = torch.sum(values*one_hot, dim=0)
+        bound = torch.abs(self.error*self.result)*counts
+        means_cons = torch.logical_and(sums-counts*self.result<=bound, counts*self.result-sums<=bound)
+        return torch.sum(torch.where(means_cons, 1.0, 0.0))==num_groups
+
+
+class GroupVariance(GroupBy):
+    """
+    Sample variance of every group, like `Variance`: deviations are taken from the mean witness of each group,
+    which is checked like `GroupMean`.
+    """
+    witness_type_id = 17
+    witness_fields = ("result", "keys", "means")
+
+    def _aggregate(self, one_hot: np.ndarray, values: np.ndarray) -> np.ndarray:
+        counts = np.sum(one_hot, axis=0)
+        if np.any(counts<2):
+            raise statistics.StatisticsError("variance requires at least two data points in every group")
+        means = (values@one_hot)/counts
+        self.means = torch.nn.Parameter(data=torch.tensor(means, dtype=self.keys.dtype), requires_grad=False)
+        deviations = values-one_hot@means
+        return (deviations*deviations)@one_hot/(counts-1)
+
+    def _check(self, one_hot: torch.Tensor, values: torch.Tensor, counts: torch.Tensor) -> IsResultPrecise:
+        num_groups = self.keys.size()[0]
+        sums = torch.sum(values*one_hot, dim=0)
+        means_bound = torch.abs(self.error*self.means)*counts
+        means_cons = torch.logical_and(sums-counts*self.means<=means_bound, counts*self.means-sums<=means_bound)
+        # Deviations from the mean of the group of every row, 0 for rows in no group
+        in_group = torch.sum(one_hot, dim=1, keepdim=True)
+        deviations = (values-torch.sum(one_hot*self.means.reshape(1, -1), dim=1, keepdim=True))*in_group
+        sum_sq = torch.sum(deviations*deviations*one_hot, dim=0)
+        bound = torch.abs(self.error*self.result)*(counts-1)
+        variance_cons = torch.logical_and(sum_sq-(counts-1)*self.result<=bound, (counts-1)*self.result-sum_sq<=bound)
+        return torch.sum(torch.where(torch.logical_and(means_cons, variance_cons), 1.0, 0.0))==num_groups
@@ -0,0 +1,180 @@
+import struct
+from dataclasses import dataclass
+from typing import Sequence, Type
+
+import numpy as np
+import torch
+
+from .ops import Operation
+
+
+# File layout, all little-endian:
+#   header: magic, format version, number of operations
+#   op table, one entry per operation in the order they are called:
+#       witness type id, number of fields, then for each field: ndim followed by ndim dims
+#   values: all fields of all operations, flattened and packed as float64
+MAGIC = b"ZKSW"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sHI")
+_OP_ENTRY = struct.Struct("<HB")
+_NDIM = struct.Struct("<B")
+_DIM = struct.Struct("<I")
+_VALUE_DTYPE = np.dtype("<f8")
+
+
+def _all_op_types() -> list[Type[Operation]]:
+    types: list[Type[Operation]] = []
+    pending = list(Operation.__subclasses__())
+    while pending:
+        op_type = pending.pop(0)
+        types.append(op_type)
+        pending.extend(op_type.__subclasses__())
+    return types
+
+
+def get_op_types() -> dict[int, Type[Operation]]:
+    """
+    Get the operation types by their witness type id.
+    """
+    op_types: dict[int, Type[Operation]] = {}
+    for op_type in _all_op_types():
+        witness_type_id = getattr(op_type, "witness_type_id", None)
+        if witness_type_id is None:
+            continue
+        if witness_type_id in op_types and op_types[witness_type_id] is not op_type:
+            raise ValueError(f"duplicate witness type id {witness_type_id}: {[op_types[witness_type_id], op_type]}")
+        op_types[witness_type_id] = op_type
+    return op_types
+
+
+def get_op_type(witness_type_id: int) -> Type[Operation]:
+    """
+    Get the operation type with `witness_type_id`.
+    """
+    op_types = get_op_types()
+    if witness_type_id not in op_types:
+        raise ValueError(f"unknown witness type id: {witness_type_id}")
+    return op_types[witness_type_id]
+
+
+def _unpack_from(fmt: struct.Struct, data: bytes, offset: int) -> tuple:
+    if offset + fmt.size > len(data):
+        raise ValueError("invalid precalculated witness: file is truncated")
+    return fmt.unpack_from(data, offset)
+
+
+@dataclass(frozen=True, eq=False)
+class WitnessEntry:
+    """
+    The precalculated witness of one operation: the operation type and the values of its `witness_fields`.
+    """
+    op_type: Type[Operation]
+    values: tuple[np.ndarray, ...]
+
+    def to_tensors(self, dtype: torch.dtype = torch.float32) -> tuple[torch.Tensor, ...]:
+        """
+        Values as tensors of `dtype`, the dtype of the data the operation is called on.
+        """
+        return tuple(torch.tensor(v, dtype=dtype) for v in self.values)
+
+
+class PrecalWitness(Sequence[WitnessEntry]):
+    """
+    Precalculated witness of all operations in a computation, in the order the operations are called.
+    It's written by the prover and read by the verifier to build the same model without the data.
+    Entries are immutable, so one instance can be shared by all operations.
+    """
+    def __init__(self, entries: Sequence[WitnessEntry]) -> None:
+        self._entries = tuple(entries)
+
+    @classmethod
+    def from_ops(cls, ops: Sequence[Operation]) -> 'PrecalWitness':
+        entries = []
+        for op in ops:
+            values = []
+            for tensor in op.get_witness():
+                value = tensor.detach().cpu().numpy().astype(_VALUE_DTYPE)
+                value.setflags(write=False)
+                values.append(value)
+            entries.append(WitnessEntry(type(op), tuple(values)))
+        return cls(entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getitem__(self, index: int) -> WitnessEntry:
+        return self._entries[index]
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, PrecalWitness) or len(self) != len(other):
+            return False
+        return all(
+            a.op_type is b.op_type and len(a.values) == len(b.values) and all(np.array_equal(x, y) for x, y in zip(a.values, b.values))
+            for a, b in zip(self._entries, other._entries)
+        )
+
+    def to_bytes(self) -> bytes:
+        table = [_HEADER.pack(MAGIC, FORMAT_VERSION, len(self._entries))]
+        values = []
+        for entry in self._entries:
+            table.append(_OP_ENTRY.pack(entry.op_type.witness_type_id, len(entry.values)))
+            for value in entry.values:
+                table.append(_NDIM.pack(value.ndim))
+                table.extend(_DIM.pack(dim) for dim in value.shape)
+                values.append(value.reshape(-1))
+        packed = np.concatenate(values).astype(_VALUE_DTYPE) if values else np.empty(0, _VALUE_DTYPE)
+        return b"".join(table) + packed.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'PrecalWitness':
+        if len(data) < _HEADER.size:
+            raise ValueError("invalid precalculated witness: file is too short")
+        magic, version, num_ops = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"invalid precalculated witness: {magic=}")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"unsupported precalculated witness version: {version}, expected {FORMAT_VERSION}")
+        offset = _HEADER.size
+        op_types = get_op_types()
+        layout: list[tuple[Type[Operation], list[tuple[int, ...]]]] = []
+        for _ in range(num_ops):
+            type_id, num_fields = _unpack_from(_OP_ENTRY, data, offset)
+            offset += _OP_ENTRY.size
+            if type_id not in op_types:
+                raise ValueError(f"unknown witness type id: {type_id}")
+            op_type = op_types[type_id]
+            if num_fields != len(op_type.witness_fields):
+                raise ValueError(f"invalid precalculated witness: {op_type.__name__} has {num_fields} fields, expected {len(op_type.witness_fields)}")
+            shapes = []
+            for _ in range(num_fields):
+                (ndim,) = _unpack_from(_NDIM, data, offset)
+                offset += _NDIM.size
+                shapes.append(tuple(_unpack_from(_DIM, data, offset + i * _DIM.size)[0] for i in range(ndim)))
+                offset += ndim * _DIM.size
+            layout.append((op_type, shapes))
+        if (len(data) - offset) % _VALUE_DTYPE.itemsize != 0:
+            raise ValueError("invalid precalculated witness: values are truncated")
+        packed = np.frombuffer(data, dtype=_VALUE_DTYPE, offset=offset)
+        expected = sum(int(np.prod(shape)) for _, shapes in layout for shape in shapes)
+        if len(packed) != expected:
+            raise ValueError(f"invalid precalculated witness: {len(packed)} values, expected {expected}")
+        entries = []
+        start = 0
+        for op_type, shapes in layout:
+            values = []
+            for shape in shapes:
+                size = int(np.prod(shape))
+                # `np.frombuffer` over bytes is read-only already
+                values.append(packed[start:start + size].reshape(shape))
+                start += size
+            entries.append(WitnessEntry(op_type, tuple(values)))
+        return cls(entries)
+
+    def dump(self, path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str) -> 'PrecalWitness':
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())